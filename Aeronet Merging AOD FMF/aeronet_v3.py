@@ -1,35 +1,62 @@
 import os
+import sys
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import ingest_cache
+import ground_store
+
+# === Columns Read From Each File ===
+# AERONET files have dozens of columns; only these are parsed.
+AOD_COLUMNS = {
+    "Date(dd:mm:yyyy)": str,
+    "Time(hh:mm:ss)": str,
+    "AOD_500nm": "float64",
+    "440-870_Angstrom_Exponent": "float64",
+}
+SDA_COLUMNS = {
+    "Date_(dd:mm:yyyy)": str,
+    "Time_(hh:mm:ss)": str,
+    "FineModeFraction_500nm[eta]": "float64",
+}
 
 # === Functions ===
 
 def find_header_line(filepath, keyword):
-    """Finds the header line by searching for the keyword."""
+    """Finds the header line by searching for the keyword. Stops reading at the first match."""
     with open(filepath, "r") as file:
-        lines = file.readlines()
-        for idx, line in enumerate(lines):
+        for idx, line in enumerate(file):
             if keyword in line:
                 return idx
     return None  # not found
 
-def load_aod_file(aod_path):
-    header_line = find_header_line(aod_path, "Date(dd:mm:yyyy)")
-    if header_line is None:
-        raise ValueError(f"Cannot find AOD header in {aod_path}")
-    aod = pd.read_csv(aod_path, skiprows=header_line)
 
-    # Try converting date+time safely
+def parse_datetime(dates, times):
+    """
+    Builds datetimes from dd:mm:yyyy and hh:mm:ss strings.
+
+    Dates repeat for every measurement of a day, so they are parsed once per
+    unique value (cache=True) and the times are added as offsets.
+    """
     try:
-        aod["Date"] = aod["Date(dd:mm:yyyy)"].astype(str).str.strip()
-        aod["Time"] = aod["Time(hh:mm:ss)"].astype(str).str.strip()
-        aod["datetime"] = pd.to_datetime(
-            aod["Date"] + " " + aod["Time"], format="%d:%m:%Y %H:%M:%S"
-        )
+        return pd.to_datetime(dates.str.strip(), format="%d:%m:%Y", cache=True) + \
+               pd.to_timedelta(times.str.strip())
     except Exception:
         # fallback if date column is Excel-style float
-        aod["datetime"] = pd.to_datetime(aod["Date(dd:mm:yyyy)"], unit="D", origin="1899-12-30") + \
-                          pd.to_timedelta(pd.to_datetime(aod["Time(hh:mm:ss)"]).dt.strftime("%H:%M:%S"))
+        return pd.to_datetime(pd.to_numeric(dates), unit="D", origin="1899-12-30") + \
+               pd.to_timedelta(pd.to_datetime(times).dt.strftime("%H:%M:%S"))
+
+
+def read_columns(path, keyword, columns, label):
+    header_line = find_header_line(path, keyword)
+    if header_line is None:
+        raise ValueError(f"Cannot find {label} header in {path}")
+    return pd.read_csv(path, skiprows=header_line, usecols=list(columns), dtype=columns)
+
+
+def load_aod_file(aod_path):
+    aod = read_columns(aod_path, "Date(dd:mm:yyyy)", AOD_COLUMNS, "AOD")
+    aod["datetime"] = parse_datetime(aod["Date(dd:mm:yyyy)"], aod["Time(hh:mm:ss)"])
 
     aod_clean = aod[["datetime", "AOD_500nm", "440-870_Angstrom_Exponent", "Date(dd:mm:yyyy)", "Time(hh:mm:ss)"]].copy()
     aod_clean.columns = ["datetime", "AOD", "AE", "Date", "Time"]
@@ -38,21 +65,8 @@ def load_aod_file(aod_path):
 
 
 def load_sda_file(sda_path):
-    header_line = find_header_line(sda_path, "Date_(dd:mm:yyyy)")
-    if header_line is None:
-        raise ValueError(f"Cannot find SDA header in {sda_path}")
-    sda = pd.read_csv(sda_path, skiprows=header_line)
-
-    # Try converting date+time safely
-    try:
-        sda["Date"] = sda["Date_(dd:mm:yyyy)"].astype(str).str.strip()
-        sda["Time"] = sda["Time_(hh:mm:ss)"].astype(str).str.strip()
-        sda["datetime"] = pd.to_datetime(
-            sda["Date"] + " " + sda["Time"], format="%d:%m:%Y %H:%M:%S"
-        )
-    except Exception:
-        sda["datetime"] = pd.to_datetime(sda["Date_(dd:mm:yyyy)"], unit="D", origin="1899-12-30") + \
-                          pd.to_timedelta(pd.to_datetime(sda["Time_(hh:mm:ss)"]).dt.strftime("%H:%M:%S"))
+    sda = read_columns(sda_path, "Date_(dd:mm:yyyy)", SDA_COLUMNS, "SDA")
+    sda["datetime"] = parse_datetime(sda["Date_(dd:mm:yyyy)"], sda["Time_(hh:mm:ss)"])
 
     sda_clean = sda[["datetime", "FineModeFraction_500nm[eta]"]].copy()
     sda_clean.columns = ["datetime", "FMF"]
@@ -60,6 +74,84 @@ def load_sda_file(sda_path):
     return sda_clean
 
 
+def station_name_of(station_folder):
+    """Extracts the station name from a folder name (e.g. Chiayi from 1_Taiwan_Chiayi)."""
+    return station_folder.split("_", 2)[-1]
+
+
+def find_station_files(station_folder, aod_root, sda_root):
+    """Returns the (AOD, SDA) file paths of a station folder, or None if either is missing."""
+    aod_folder = os.path.join(aod_root, station_folder)
+    sda_folder = os.path.join(sda_root, station_folder)
+    if not os.path.isdir(sda_folder):
+        return None
+
+    aod_files = [f for f in os.listdir(aod_folder) if f.endswith(".lev20")]
+    sda_files = [f for f in os.listdir(sda_folder) if f.endswith(".ONEILL_lev20")]
+    if not aod_files or not sda_files:
+        return None
+    return os.path.join(aod_folder, aod_files[0]), os.path.join(sda_folder, sda_files[0])
+
+
+def process_station(station_folder, aod_path, sda_path):
+    """
+    Loads, merges and cleans the AOD and SDA files of one station.
+    Returns (merged DataFrame or None, log message); runs in a worker process.
+    """
+    try:
+        station_name = station_name_of(station_folder)
+
+        # Load and merge
+        aod_clean = load_aod_file(aod_path)
+        sda_clean = load_sda_file(sda_path)
+        merged = pd.merge(aod_clean, sda_clean, on="datetime", how="inner")
+        merged.dropna(subset=["AOD", "AE", "FMF"], inplace=True)
+
+        # Filter invalids
+        invalid_mask = (merged["AOD"] < 0) | (merged["AE"] < 0) | (merged["FMF"] < 0)
+        merged = merged[~invalid_mask]
+
+        # Add station info
+        lat, lon = station_coords.get(station_name, (np.nan, np.nan))
+        merged["latitude"] = lat
+        merged["longitude"] = lon
+        merged["station"] = station_name  # 🆕 Add station name for context
+
+        return merged, f"✅ Processed: {station_name} with {len(merged)} rows"
+
+    except Exception as e:
+        return None, f"❌ Error processing {station_folder}: {e}"
+
+
+def parse_stations(jobs, workers):
+    """
+    Runs process_station for {station_folder: (aod_path, sda_path)}, on a
+    pool of worker processes when workers > 1. Returns {station_folder: DataFrame or None}.
+    """
+    results = {}
+    if workers > 1 and len(jobs) > 1:
+        workers = min(workers, len(jobs))
+        print(f"⚙️ Loading {len(jobs)} station(s) with {workers} workers")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(process_station, station_folder, aod_path, sda_path): station_folder
+                for station_folder, (aod_path, sda_path) in jobs.items()
+            }
+            for future in as_completed(futures):
+                station_folder = futures[future]
+                try:
+                    results[station_folder], message = future.result()
+                except Exception as e:
+                    # The worker itself died (e.g. out of memory), not just the parsing.
+                    results[station_folder], message = None, f"❌ Worker failed on {station_folder}: {e}"
+                print(message)
+    else:
+        for station_folder, (aod_path, sda_path) in jobs.items():
+            results[station_folder], message = process_station(station_folder, aod_path, sda_path)
+            print(message)
+    return results
+
+
 # === Constants ===
 station_coords = {
     "Chiayi": (23.452, 120.255),
@@ -88,70 +180,96 @@ station_coords = {
     "Lumbini": (27.490, 83.279)
 }
 
-# === Directories ===
-os.chdir(r"D:\TE\Major Project\AOD\Optimized Approach\Aeronet Merging AOD FMF")
+# === Settings ===
+project_folder = r"D:\TE\Major Project\AOD\Optimized Approach\Aeronet Merging AOD FMF"
 aod_root = "./AOD/"
 sda_root = "./FMF/"
 output_root = "./Merged Ground Truth/"
-os.makedirs(output_root, exist_ok=True)
-
-# === Find all stations ===
-stations = os.listdir(aod_root)
-stations = [s for s in stations if os.path.isdir(os.path.join(aod_root, s))]
+cache_root = "./Ingest Cache/"
+use_cache = True  # Keep each station's merged rows so reruns only parse stations whose files changed (see ingest_cache.py)
+write_ground_store = True  # Also write the binary, station-indexed copy of the combined file (see ground_store.py)
+ground_store_folder = "./Merged Ground Truth/ground_truth_store/"
+num_workers = os.cpu_count() or 1  # Stations loaded in parallel; pass a number on the command line to change it
 
-# === Initialize a list to collect all merged data === 🗃️
-all_merged_data = []
 
-for station_folder in stations:
-    try:
-        station_name = station_folder.split("_", 2)[-1]
-        
-        # 🔁 Skip per-station file output — we'll save one combined file later
-        aod_folder = os.path.join(aod_root, station_folder)
-        sda_folder = os.path.join(sda_root, station_folder)
+def main(workers=num_workers):
+    os.chdir(project_folder)
+    os.makedirs(output_root, exist_ok=True)
 
-        aod_files = [f for f in os.listdir(aod_folder) if f.endswith(".lev20")]
-        sda_files = [f for f in os.listdir(sda_folder) if f.endswith(".ONEILL_lev20")]
+    # === Find all stations ===
+    stations = os.listdir(aod_root)
+    stations = [s for s in stations if os.path.isdir(os.path.join(aod_root, s))]
 
-        if not aod_files or not sda_files:
+    manifest = ingest_cache.load_manifest(cache_root) if use_cache else {"stations": {}}
+    fingerprints, jobs, cached = {}, {}, []
+    for station_folder in stations:
+        files = find_station_files(station_folder, aod_root, sda_root)
+        if files is None:
             print(f"⚠️ Missing files for {station_folder}, skipping...")
+            if use_cache:
+                ingest_cache.drop_part(cache_root, manifest, station_folder)
             continue
+        if use_cache:
+            # === Reuse stations whose files did not change ===
+            coords = station_coords.get(station_name_of(station_folder), (np.nan, np.nan))
+            previous = manifest["stations"].get(station_folder)
+            fingerprints[station_folder] = ingest_cache.station_fingerprint(*files, coords, previous)
+            if ingest_cache.same_sources(previous, fingerprints[station_folder]) and \
+                    os.path.exists(ingest_cache.part_path(cache_root, station_folder)):
+                manifest["stations"][station_folder] = fingerprints[station_folder]
+                cached.append(station_folder)
+                continue
+        jobs[station_folder] = tuple(os.path.abspath(path) for path in files)
+    if use_cache:
+        print(f"🗄️ {len(cached)} station(s) unchanged since the last run, {len(jobs)} to parse")
 
-        aod_path = os.path.join(aod_folder, aod_files[0])
-        sda_path = os.path.join(sda_folder, sda_files[0])
+    # === Load every changed station === 🗃️
+    results = parse_stations(jobs, workers)
+    if use_cache:
+        for station_folder, merged in results.items():
+            if merged is None:
+                ingest_cache.drop_part(cache_root, manifest, station_folder)
+            else:
+                ingest_cache.write_part(cache_root, station_folder, merged)
+                manifest["stations"][station_folder] = fingerprints[station_folder]
+        # Stations whose folders were removed
+        for station_folder in set(manifest["stations"]) - set(stations):
+            ingest_cache.drop_part(cache_root, manifest, station_folder)
+        ingest_cache.save_manifest(cache_root, manifest)
 
-        # Load and merge
-        aod_clean = load_aod_file(aod_path)
-        sda_clean = load_sda_file(sda_path)
-        merged = pd.merge(aod_clean, sda_clean, on="datetime", how="inner")
-        merged.dropna(subset=["AOD", "AE", "FMF"], inplace=True)
-
-        # Filter invalids
-        invalid_mask = (merged["AOD"] < 0) | (merged["AE"] < 0) | (merged["FMF"] < 0)
-        merged = merged[~invalid_mask]
-
-        # Add station info
-        lat, lon = station_coords.get(station_name, (np.nan, np.nan))
-        merged["latitude"] = lat
-        merged["longitude"] = lon
-        merged["station"] = station_name  # 🆕 Add station name for context
-
-        # 🔁 Append to master list
-        all_merged_data.append(merged)
+    # 🔁 Skip per-station file output — we save one combined file, in station
+    # listing order so its rows come out the same however many workers run.
+    included = [s for s in stations if s in cached or results.get(s) is not None]
+    output_path = os.path.join(output_root, "AERONET_groundtruth_ALL.csv")
+    store_missing = write_ground_store and not os.path.exists(os.path.join(ground_store_folder, ground_store.INDEX_NAME))
+    if use_cache and included and not store_missing and ingest_cache.output_is_current(manifest, output_path, included):
+        print(f"\n⏭️ No station changed, {output_path} is up to date")
+        print("\n🎯 All stations processed!")
+        return
 
-        print(f"✅ Processed: {station_name} with {len(merged)} rows")
+    all_merged_data = [
+        results[s] if results.get(s) is not None else ingest_cache.read_part(cache_root, s)
+        for s in included
+    ]
 
-    except Exception as e:
-        print(f"❌ Error processing {station_folder}: {e}")
+    # === Combine and Save All Data ===
+    if all_merged_data:
+        final_df = pd.concat(all_merged_data, ignore_index=True)
+        final_df.to_csv(output_path, index=False)
+        print(f"\n🎉 Combined data saved to: {output_path}")
+        if write_ground_store:
+            ground_store.write_store(final_df, ground_store_folder)
+            print(f"🗃️ Binary ground-truth store saved to: {ground_store_folder}")
+        if use_cache:
+            manifest["output"] = ingest_cache.output_fingerprint(output_path, manifest, included)
+            ingest_cache.save_manifest(cache_root, manifest)
+    else:
+        print("\n⚠️ No valid data found to merge.")
 
-# === Combine and Save All Data ===
-if all_merged_data:
-    final_df = pd.concat(all_merged_data, ignore_index=True)
-    output_path = os.path.join(output_root, "AERONET_groundtruth_ALL.csv")
-    final_df.to_csv(output_path, index=False)
-    print(f"\n🎉 Combined data saved to: {output_path}")
-else:
-    print("\n⚠️ No valid data found to merge.")
+    print("\n🎯 All stations processed!")
 
 
-print("\n🎯 All stations processed!")
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        num_workers = int(sys.argv[1])
+    main(num_workers)
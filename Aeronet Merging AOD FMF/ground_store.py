@@ -0,0 +1,129 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+# === Binary Ground-Truth Store ===
+# Written by aeronet_v3.py next to AERONET_groundtruth_ALL.csv, for scripts
+# that only need some stations or time ranges:
+#
+#   times.npy            int64 epoch seconds (UTC), sorted by (station, time)
+#   AOD.npy, AE.npy,     float32, same row order
+#   FMF.npy
+#   index.json           station -> offset, length, latitude, longitude
+#
+# Files are opened memory-mapped, so reading one station's time range only
+# touches those rows, whatever the size of the store.
+
+STORE_VERSION = 1
+VALUE_COLUMNS = ["AOD", "AE", "FMF"]
+INDEX_NAME = "index.json"
+
+
+def write_store(ground_df, store_folder):
+    """
+    Writes a merged ground-truth DataFrame (the columns of the combined CSV)
+    as a store. The new store replaces the old one only once fully written.
+    """
+    df = ground_df.sort_values(["station", "datetime"], kind="stable")
+    tmp_folder = f"{store_folder.rstrip('/')}.{os.getpid()}.tmp"
+    os.makedirs(tmp_folder, exist_ok=True)
+    try:
+        times = pd.to_datetime(df["datetime"]).to_numpy(dtype="datetime64[s]").astype("int64")
+        np.save(os.path.join(tmp_folder, "times.npy"), times)
+        for col in VALUE_COLUMNS:
+            np.save(os.path.join(tmp_folder, f"{col}.npy"), df[col].to_numpy(dtype="float32"))
+
+        stations = {}
+        names = df["station"].to_numpy()
+        starts = np.flatnonzero(np.r_[True, names[1:] != names[:-1]]) if len(df) else np.array([], dtype="int64")
+        ends = np.r_[starts[1:], len(df)]
+        for start, end in zip(starts, ends):
+            lat, lon = df["latitude"].iat[start], df["longitude"].iat[start]
+            stations[str(names[start])] = {
+                "offset": int(start),
+                "length": int(end - start),
+                "latitude": None if pd.isna(lat) else float(lat),
+                "longitude": None if pd.isna(lon) else float(lon),
+            }
+        with open(os.path.join(tmp_folder, INDEX_NAME), "w") as f:
+            json.dump({"version": STORE_VERSION, "rows": len(df), "stations": stations}, f, indent=1)
+
+        if os.path.exists(store_folder):
+            shutil.rmtree(store_folder)
+        os.replace(tmp_folder, store_folder)
+    finally:
+        if os.path.exists(tmp_folder):
+            shutil.rmtree(tmp_folder)
+    return store_folder
+
+
+def open_store(store_folder):
+    """Loads the index and memory-maps the columns: {"stations": {...}, "times": array, "AOD": array, ...}."""
+    index_path = os.path.join(store_folder, INDEX_NAME)
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(f"No ground-truth store at {store_folder}; run aeronet_v3.py to write it")
+    with open(index_path) as f:
+        index = json.load(f)
+    if index.get("version") != STORE_VERSION:
+        raise ValueError(f"Ground-truth store at {store_folder} has version {index.get('version')}, expected {STORE_VERSION}; run aeronet_v3.py again")
+
+    store = {"stations": index["stations"]}
+    for name in ["times"] + VALUE_COLUMNS:
+        store[name] = np.load(os.path.join(store_folder, f"{name}.npy"), mmap_mode="r")
+    return store
+
+
+def station_rows(store, station, start=None, end=None):
+    """
+    The row range (first, stop) of one station, narrowed to start <= time <= end
+    (datetime-likes, None for no bound). Stations not in the store give an empty range.
+    """
+    entry = store["stations"].get(station)
+    if entry is None:
+        return 0, 0
+    first, stop = entry["offset"], entry["offset"] + entry["length"]
+    times = store["times"][first:stop]
+    if start is not None:
+        first += int(np.searchsorted(times, pd.Timestamp(start).value // 10**9, side="left"))
+    if end is not None:
+        stop = entry["offset"] + int(np.searchsorted(times, pd.Timestamp(end).value // 10**9, side="right"))
+    return first, max(first, stop)
+
+
+def read_station(store, station, start=None, end=None, columns=VALUE_COLUMNS):
+    """
+    One station's rows as {"times": datetime64[s] array, column: float32 array}.
+    The arrays are views of the memory-mapped files.
+    """
+    first, stop = station_rows(store, station, start, end)
+    rows = {"times": store["times"][first:stop].view("datetime64[s]")}
+    for col in columns:
+        rows[col] = store[col][first:stop]
+    return rows
+
+
+def read_frame(store_folder, stations=None, start=None, end=None, columns=VALUE_COLUMNS):
+    """
+    Reads the store into a DataFrame with the columns of the combined CSV
+    (datetime, the value columns, latitude, longitude, station), for the
+    given stations (None = all) and time range.
+    """
+    store = open_store(store_folder)
+    frames = []
+    for station in (store["stations"] if stations is None else stations):
+        rows = read_station(store, station, start, end, columns)
+        if len(rows["times"]) == 0:
+            continue
+        entry = store["stations"][station]
+        frame = pd.DataFrame({"datetime": rows["times"].astype("datetime64[ns]")})
+        for col in columns:
+            frame[col] = np.asarray(rows[col])
+        frame["latitude"] = np.nan if entry["latitude"] is None else entry["latitude"]
+        frame["longitude"] = np.nan if entry["longitude"] is None else entry["longitude"]
+        frame["station"] = station
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=["datetime", *columns, "latitude", "longitude", "station"])
+    return pd.concat(frames, ignore_index=True)
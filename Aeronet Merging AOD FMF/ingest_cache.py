@@ -0,0 +1,143 @@
+import os
+import json
+import math
+import hashlib
+import duckdb
+
+# === Per-Station Ingest Cache ===
+# aeronet_v3.py keeps every station's cleaned, merged frame as a Parquet part,
+# so a rerun only parses the stations whose files changed:
+#
+#   <cache>/<station folder>.parquet   one part per station (written with DuckDB)
+#   <cache>/manifest.json              per station: fingerprint of its sources
+#
+# A fingerprint holds the path, size, mtime and SHA-256 of the AOD and SDA
+# files plus the station's coordinates. The hash is only recomputed when size
+# or mtime changed, so a file that was copied or unzipped again with the same
+# content keeps its part.
+
+MANIFEST_NAME = "manifest.json"
+CACHE_VERSION = 1  # Bump when the cleaning in aeronet_v3.py changes, so every station is parsed again
+HASH_BLOCK = 1 << 20
+
+
+def _sql_path(path):
+    return path.replace("\\", "/").replace("'", "''")
+
+
+def part_path(cache_root, station_folder):
+    return os.path.join(cache_root, f"{station_folder}.parquet")
+
+
+def load_manifest(cache_root):
+    path = os.path.join(cache_root, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"version": CACHE_VERSION, "stations": {}, "output": None}
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != CACHE_VERSION:
+        print("♻️ Ingest cache was written by another version of the cleaning, parsing every station again")
+        return {"version": CACHE_VERSION, "stations": {}, "output": None}
+    return manifest
+
+
+def save_manifest(cache_root, manifest):
+    os.makedirs(cache_root, exist_ok=True)
+    path = os.path.join(cache_root, MANIFEST_NAME)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+# --- Fingerprints ---
+def file_fingerprint(path, previous=None):
+    """
+    {path, size, mtime_ns, sha256} of a source file. The hash of `previous`
+    is reused when path, size and mtime still match it.
+    """
+    stat = os.stat(path)
+    fingerprint = {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if previous and all(previous.get(key) == value for key, value in fingerprint.items()):
+        fingerprint["sha256"] = previous["sha256"]
+        return fingerprint
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            digest.update(block)
+    fingerprint["sha256"] = digest.hexdigest()
+    return fingerprint
+
+
+def station_fingerprint(aod_path, sda_path, coords, previous=None):
+    previous = previous or {}
+    return {
+        "aod": file_fingerprint(aod_path, previous.get("aod")),
+        "sda": file_fingerprint(sda_path, previous.get("sda")),
+        "coords": [None if math.isnan(value) else value for value in coords],
+    }
+
+
+def same_sources(a, b):
+    """True if two station fingerprints describe the same files and coordinates (mtimes may differ)."""
+    if a is None or b is None or a["coords"] != b["coords"]:
+        return False
+    return all(
+        a[kind][key] == b[kind][key]
+        for kind in ("aod", "sda")
+        for key in ("path", "size", "sha256")
+    )
+
+
+# --- Parts ---
+def write_part(cache_root, station_folder, frame):
+    """Writes one station's merged frame as its Parquet part."""
+    os.makedirs(cache_root, exist_ok=True)
+    out_path = part_path(cache_root, station_folder)
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+
+    con = duckdb.connect()
+    try:
+        con.register("station", frame)
+        con.execute(f"COPY station TO '{_sql_path(tmp_path)}' (FORMAT PARQUET, COMPRESSION ZSTD)")
+        os.replace(tmp_path, out_path)
+    finally:
+        con.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return out_path
+
+
+def read_part(cache_root, station_folder):
+    con = duckdb.connect()
+    try:
+        return con.execute(f"SELECT * FROM read_parquet('{_sql_path(part_path(cache_root, station_folder))}')").df()
+    finally:
+        con.close()
+
+
+def drop_part(cache_root, manifest, station_folder):
+    """Forgets a station (its files are gone or failed to parse) and deletes its part."""
+    manifest["stations"].pop(station_folder, None)
+    path = part_path(cache_root, station_folder)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+# --- Combined Output ---
+def output_fingerprint(output_path, manifest, stations):
+    """The combined file's size and mtime, with the sources of every station it was built from."""
+    stat = os.stat(output_path)
+    sources = [
+        [station_folder, entry["aod"]["sha256"], entry["sda"]["sha256"], entry["coords"]]
+        for station_folder, entry in ((s, manifest["stations"][s]) for s in stations)
+    ]
+    return {"path": os.path.abspath(output_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sources": sources}
+
+
+def output_is_current(manifest, output_path, stations):
+    """True if `output_path` is the file last built from exactly these stations, with their current sources."""
+    recorded = manifest.get("output")
+    if not recorded or not os.path.exists(output_path):
+        return False
+    return recorded == output_fingerprint(output_path, manifest, stations)
@@ -1,5 +1,10 @@
 import pandas as pd
+import numpy as np
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../Aeronet Merging AOD FMF"))
+import ground_store
 
 # --- NEW: FILTERS TO REDUCE FILE COUNT ---
 # 1. Filter by daylight hours
@@ -23,17 +28,71 @@ AOD_THRESHOLD = 0.4
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
 GROUND_DATA_FILE = os.path.join(SCRIPT_DIR, "../../Aeronet Merging AOD FMF/Merged Ground Truth/AERONET_groundtruth_ALL.csv")
+# "csv" reads GROUND_DATA_FILE; "store" reads the binary ground-truth store
+# written by aeronet_v3.py (no CSV parsing, AOD kept as float32).
+GROUND_DATA_FORMAT = "csv"
+GROUND_STORE_FOLDER = os.path.join(SCRIPT_DIR, "../../Aeronet Merging AOD FMF/Merged Ground Truth/ground_truth_store")
 OUTPUT_FILE = "himawari_timestamps_to_download_total.txt"
+# Which stations, and how many of their ground records, fall within the window
+# of each slot in OUTPUT_FILE: one timestamp,station,ground_records row per pair.
+SLOT_STATIONS_FILE = "himawari_slot_stations.csv"
 SATELLITE_INTERVAL_MINUTES = 10 # Himawari's 10-minute interval
 
 
-def generate_required_timestamps(csv_path):
+def load_ground_times(csv_path):
+    """The datetime, AOD and station columns of the ground data, from the CSV or the binary store."""
+    if GROUND_DATA_FORMAT == "store":
+        print(f"🔄 Reading ground data from: {GROUND_STORE_FOLDER}")
+        return ground_store.read_frame(GROUND_STORE_FOLDER, columns=["AOD"])[["datetime", "AOD", "station"]]
+
     print(f"🔄 Reading ground data from: {csv_path}")
     if not os.path.exists(csv_path):
         print(f"❌ ERROR: File not found at '{csv_path}'")
+        return None
+    return pd.read_csv(csv_path, usecols=['datetime', 'AOD', 'station'], parse_dates=['datetime'])
+
+
+def required_slots(times_ns, station_codes, time_delta_minutes, interval_minutes):
+    """
+    Finds every satellite slot within +/- time_delta_minutes of each ground
+    record, without a Python loop over the records.
+
+    Slots are multiples of the interval since the epoch, like Timestamp.ceil(),
+    so the first slot of a window is ceil((t - delta) / interval) and the last
+    floor((t + delta) / interval). Times are int64 nanoseconds.
+
+    Returns (slots, stations, records): one entry per (slot, station code)
+    pair, sorted by slot, with the number of ground records backing it.
+    Slots are given in units of the interval since the epoch.
+    """
+    step = np.int64(interval_minutes * 60 * 10**9)
+    delta = np.int64(time_delta_minutes * 60 * 10**9)
+
+    # Records of one station at the same time need the same slots: expand each pair once.
+    pairs, pair_records = np.unique(np.column_stack([times_ns, station_codes]), axis=0, return_counts=True)
+    times, codes = pairs[:, 0], pairs[:, 1]
+    n_stations = np.int64(station_codes.max()) + 1
+
+    first = -((delta - times) // step)
+    last = (times + delta) // step
+    offsets = np.arange(int((last - first).max()) + 1, dtype="int64")
+    slots = first[:, None] + offsets
+    inside = slots <= last[:, None]
+    slots = slots[inside]
+    codes = np.broadcast_to(codes[:, None], inside.shape)[inside]
+    records = np.broadcast_to(pair_records[:, None], inside.shape)[inside]
+
+    slot_keys, inverse = np.unique(slots * n_stations + codes, return_inverse=True)
+    records = np.bincount(inverse.ravel(), weights=records).astype("int64")
+    slots, stations = np.divmod(slot_keys, n_stations)
+    return slots, stations, records
+
+
+def generate_required_timestamps(csv_path):
+    df = load_ground_times(csv_path)
+    if df is None:
         return
 
-    df = pd.read_csv(csv_path, usecols=['datetime', 'AOD'], parse_dates=['datetime'])
     df.dropna(subset=['datetime', 'AOD'], inplace=True)
     print(f"Initial records found: {len(df)}")
 
@@ -54,28 +113,34 @@ def generate_required_timestamps(csv_path):
     print(f"Found {len(unique_ground_times)} unique ground timestamps after filtering.")
 
     time_delta_minutes = NEW_TIME_DELTA_MINUTES if REDUCE_TIME_WINDOW else 30
-    time_delta = pd.Timedelta(minutes=time_delta_minutes)
-    satellite_freq = f"{SATELLITE_INTERVAL_MINUTES}min"
-    required_timestamps = set()
 
     print(f"⚙️  Calculating required satellite timestamps with a +/- {time_delta_minutes} min window...")
-    for ground_time in unique_ground_times:
-        start_window = ground_time - time_delta
-        end_window = ground_time + time_delta
-        first_satellite_slot = start_window.ceil(satellite_freq)
-        required_range = pd.date_range(start=first_satellite_slot, end=end_window, freq=satellite_freq)
-        required_timestamps.update(required_range)
+    station_codes, station_names = pd.factorize(df['station'].fillna('unknown'), sort=True)
+    times_ns = df['datetime'].to_numpy(dtype='datetime64[ns]').astype('int64')
+    slots, stations, records = required_slots(times_ns, station_codes.astype('int64'), time_delta_minutes, SATELLITE_INTERVAL_MINUTES)
 
-    print(f"✅ Found {len(required_timestamps)} unique satellite timestamps to download.")
+    step_ns = SATELLITE_INTERVAL_MINUTES * 60 * 10**9
+    unique_slots, first_rows = np.unique(slots, return_index=True)
+    print(f"✅ Found {len(unique_slots)} unique satellite timestamps to download.")
+
+    slot_names = pd.to_datetime(unique_slots * step_ns, unit='ns').strftime('%Y%m%d_%H%M')
+    formatted_timestamps = sorted(slot_names)
 
-    formatted_timestamps = sorted([ts.strftime('%Y%m%d_%H%M') for ts in required_timestamps])
-    
     with open(OUTPUT_FILE, 'w') as f:
         for ts in formatted_timestamps:
             f.write(f"{ts}\n")
 
     print(f"💾 Saved filtered list to: {OUTPUT_FILE}")
 
+    # Slots are sorted, so each slot's pairs start at its first_rows entry.
+    slot_support = pd.DataFrame({
+        'timestamp': np.repeat(np.asarray(slot_names), np.diff(np.r_[first_rows, len(slots)])),
+        'station': np.asarray(station_names)[stations],
+        'ground_records': records,
+    })
+    slot_support.to_csv(SLOT_STATIONS_FILE, index=False)
+    print(f"💾 Saved stations behind each timestamp to: {SLOT_STATIONS_FILE}")
+
 
 # --- Run the script ---
 if __name__ == "__main__":
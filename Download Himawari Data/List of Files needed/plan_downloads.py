@@ -0,0 +1,175 @@
+import os
+import sys
+import heapq
+import sqlite3
+import numpy as np
+import pandas as pd
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "../jaxa_download_scripts"))
+from download_state import STATE_DB
+
+# --- Match-Yield Download Planner ---
+# Instead of keeping every Nth timestamp (subsample_list.py), ranks the slots
+# of himawari_slot_stations.csv (written by generate_himawari_list.py) by how
+# many stations have ground records within their window, per downloaded byte,
+# and keeps the best TIMESTAMP_BUDGET of them. The queue is a plain timestamp
+# list in rank order, which the downloaders read like the filtered list.
+
+# --- Configuration ---
+SLOT_STATIONS_FILE = "himawari_slot_stations.csv"
+OUTPUT_FILE = "himawari_download_queue.txt"
+REPORT_FILE = "himawari_download_plan.csv"  # Rank, stations and estimated size of every queued timestamp
+
+TIMESTAMP_BUDGET = 24170  # Timestamps to queue (a main and a cloud file each); None ranks every slot
+
+# Balance constraints (None = off)
+MAX_SLOTS_PER_STATION = None  # A station stops adding value to further slots once it is in this many
+MAX_SEASON_SHARE = None  # e.g. 0.3: no season (DJF, MAM, JJA, SON) takes more than 30% of the budget
+
+# Slot sizes are estimated from the raw file sizes already recorded in the
+# download state database, per time of day (night files compress better).
+# Without any recorded sizes every slot counts the same.
+USE_RECORDED_SIZES = True
+
+SEASONS = {12: "DJF", 1: "DJF", 2: "DJF", 3: "MAM", 4: "MAM", 5: "MAM",
+           6: "JJA", 7: "JJA", 8: "JJA", 9: "SON", 10: "SON", 11: "SON"}
+
+
+def load_slots(path):
+    """
+    Groups the slot/station pairs by slot. Returns (timestamps, members,
+    ground_records, station_names): members[i] holds the station codes of slot i.
+    """
+    pairs = pd.read_csv(path, dtype={"timestamp": str, "station": str, "ground_records": "int64"})
+    timestamps, slot_index = np.unique(pairs["timestamp"].to_numpy(), return_inverse=True)
+    codes, station_names = pd.factorize(pairs["station"], sort=True)
+
+    order = np.argsort(slot_index, kind="stable")
+    bounds = np.r_[0, np.cumsum(np.bincount(slot_index, minlength=len(timestamps)))]
+    codes = codes[order]
+    members = [codes[bounds[i]:bounds[i + 1]] for i in range(len(timestamps))]
+    ground_records = np.bincount(slot_index, weights=pairs["ground_records"].to_numpy(), minlength=len(timestamps))
+    return timestamps, members, ground_records.astype("int64"), list(station_names)
+
+
+def estimate_slot_bytes(timestamps, state_db=STATE_DB):
+    """
+    Estimated main + cloud bytes of each timestamp: the median recorded size
+    at the same time of day, else the median over all recorded timestamps.
+    Returns None when no sizes are recorded yet.
+    """
+    if not os.path.exists(state_db):
+        return None
+    with sqlite3.connect(state_db) as db:
+        sizes = pd.read_sql_query(
+            "SELECT timestamp, SUM(raw_bytes) AS bytes FROM downloads "
+            "WHERE raw_bytes IS NOT NULL GROUP BY timestamp HAVING COUNT(*) = 2",
+            db,
+        )
+    if sizes.empty:
+        return None
+    by_time_of_day = sizes.groupby(sizes["timestamp"].str[-4:])["bytes"].median()
+    fallback = sizes["bytes"].median()
+    time_of_day = pd.Series(timestamps).str[-4:]
+    return time_of_day.map(by_time_of_day).fillna(fallback).to_numpy(dtype="float64")
+
+
+def plan_queue(members, slot_bytes, ground_records, timestamps, budget,
+               max_per_station=None, max_season_share=None):
+    """
+    Greedily picks slots by new station matches per byte, best first.
+
+    A station counts towards a slot's matches until it is in max_per_station
+    picked slots, so slots only lose value as others are picked: a lazy
+    greedy re-scores the best slot when it comes up and only takes it if it
+    still beats the next one. Ties go to more ground records, then earlier
+    timestamps. Returns [(slot, matches at pick time)] in rank order.
+    """
+    n_stations = 1 + max((int(m.max()) for m in members if len(m)), default=-1)
+    station_slots = np.zeros(n_stations, dtype="int64")
+    budget = len(members) if budget is None else min(budget, len(members))
+
+    seasons = [SEASONS[int(ts[4:6])] for ts in timestamps]
+    season_cap = None if max_season_share is None else int(np.floor(max_season_share * budget))
+    season_slots = dict.fromkeys(SEASONS.values(), 0)
+
+    def gain(i):
+        if max_per_station is None:
+            return len(members[i])
+        return int(np.count_nonzero(station_slots[members[i]] < max_per_station))
+
+    heap = [(-gain(i) / slot_bytes[i], -ground_records[i], timestamps[i], i) for i in range(len(members))]
+    heapq.heapify(heap)
+    picked = []
+    while heap and len(picked) < budget:
+        _, neg_records, ts, i = heapq.heappop(heap)
+        if season_cap is not None and season_slots[seasons[i]] >= season_cap:
+            continue
+        matches = gain(i)
+        if matches == 0:
+            continue
+        entry = (-matches / slot_bytes[i], neg_records, ts, i)
+        if heap and entry > heap[0]:
+            heapq.heappush(heap, entry)  # Lost value since it was scored; retry in its new place
+            continue
+        picked.append((i, matches))
+        station_slots[members[i]] += 1
+        season_slots[seasons[i]] += 1
+    return picked
+
+
+def main():
+    print(f"🔄 Reading slot stations from: {SLOT_STATIONS_FILE}")
+    if not os.path.exists(SLOT_STATIONS_FILE):
+        print(f"❌ ERROR: File not found at '{SLOT_STATIONS_FILE}'. Run generate_himawari_list.py first.")
+        return
+    timestamps, members, ground_records, station_names = load_slots(SLOT_STATIONS_FILE)
+    print(f"Found {len(timestamps)} candidate timestamps covering {len(station_names)} stations.")
+
+    slot_bytes = estimate_slot_bytes(timestamps) if USE_RECORDED_SIZES else None
+    sizes_known = slot_bytes is not None
+    if not sizes_known:
+        print("📏 No recorded file sizes, every timestamp counts as the same size.")
+        slot_bytes = np.ones(len(timestamps))
+    else:
+        print(f"📏 Estimated sizes from {os.path.basename(STATE_DB)}: {slot_bytes.min() / 1e6:.0f}-{slot_bytes.max() / 1e6:.0f} MB per timestamp")
+
+    print("⚙️  Ranking timestamps by station matches per byte...")
+    picked = plan_queue(members, slot_bytes, ground_records, timestamps, TIMESTAMP_BUDGET,
+                        MAX_SLOTS_PER_STATION, MAX_SEASON_SHARE)
+    if not picked:
+        print("❌ No timestamp adds any station match. Exiting.")
+        return
+
+    if TIMESTAMP_BUDGET is not None and len(picked) < TIMESTAMP_BUDGET:
+        print(f"⚠️ Only {len(picked)} timestamps add station matches under the balance constraints.")
+
+    slots = np.array([i for i, _ in picked])
+    with open(OUTPUT_FILE, "w") as f:
+        for i in slots:
+            f.write(f"{timestamps[i]}\n")
+    print(f"💾 Saved ranked queue of {len(slots)} timestamps to: {OUTPUT_FILE}")
+
+    report = pd.DataFrame({
+        "rank": np.arange(1, len(slots) + 1),
+        "timestamp": timestamps[slots],
+        "stations": [";".join(station_names[c] for c in members[i]) for i in slots],
+        "new_matches": [matches for _, matches in picked],
+        "ground_records": ground_records[slots],
+        "estimated_bytes": slot_bytes[slots] if sizes_known else np.nan,
+    })
+    report.to_csv(REPORT_FILE, index=False)
+    print(f"💾 Saved plan details to: {REPORT_FILE}")
+
+    # Every-Nth subsampling with the same number of timestamps, for comparison
+    step = max(1, int(np.ceil(len(timestamps) / len(slots))))
+    every_nth = sum(len(members[i]) for i in range(0, len(timestamps), step))
+    planned = sum(len(members[i]) for i in slots)
+    print(f"📈 Station matches: {planned} planned vs {every_nth} taking every {step}th timestamp "
+          f"({planned / len(slots):.2f} vs {every_nth / len(range(0, len(timestamps), step)):.2f} per timestamp)")
+
+
+# --- Run the script ---
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 import os
 import sys
 import json
-from ftplib import FTP
+import contextlib
+import threading
 import xarray as xr
 from datetime import datetime
 from tqdm import tqdm
@@ -12,7 +13,8 @@ load_dotenv()
 # 🔐 FTP Credentials
 USERNAME = os.getenv("FTP_USERNAME")
 PASSWORD = os.getenv("FTP_PWD")
-FTP_SERVER = "ftp.ptree.jaxa.jp"
+FTP_SERVER = os.getenv("FTP_SERVER", "ftp.ptree.jaxa.jp")  # Override to test against a local stand-in
+FTP_PORT = int(os.getenv("FTP_PORT", "21"))
 
 # 🔑 Pointer key for this script
 POINTER_KEY = "main"
@@ -22,9 +24,18 @@ DELETE_ORIGINAL_AFTER_TRIM = True
 # --- Get the absolute path to the directory where this script is located ---
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
-TIMESTAMPS_FILE = os.path.join(SCRIPT_DIR, "../List of Files needed/himawari_timestamps_to_download_filtered.txt")
+from timestamp_lists import TIMESTAMPS_FILE, list_identity, adopt_list  # Which list to download, set in timestamp_lists.py
 PROGRESS_FILE = os.path.join(SCRIPT_DIR, "download_progress.json")
 OUTPUT_DIR = os.path.join(SCRIPT_DIR, "../../TOA reflectance and Cloud/Himawari Data")
+LISTING_CACHE_FILE = os.path.join(SCRIPT_DIR, "ftp_listing_cache.json")
+PERSIST_LISTING_CACHE = True  # Keep remote day listings between sessions (False = this session only)
+
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "../../TOA reflectance and Cloud"))
+from file_index import scan_timestamps
+from ftp_pool import connect, close_quietly, retrieve
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "../../Pixels Close To Stations"))
+import station_chips
+import trim_encoding
 
 # 🌍 Region of Interest
 REGION = {
@@ -34,6 +45,26 @@ REGION = {
     "lon_max": 130
 }
 
+# 📦 What each trimmed file keeps: "region" (the whole REGION box) or "chips"
+# (only a small window around every station, see station_chips.py; needs MASKS_PATH)
+STORAGE_MODE = "region"
+MASKS_PATH = os.path.join(SCRIPT_DIR, "../../Pixels Close To Stations/precomputed_masks")
+
+# 🧾 Variables kept in the trimmed files (None keeps everything); main_v3.py reads these
+KEEP_VARIABLES = (
+    [f"albedo_0{i}" for i in range(1, 7)]
+    + [f"tbb_{i:02}" for i in range(7, 17)]
+    + ["SOZ", "SAA", "SOA", "SAZ"]
+)
+
+# 🗜️ Store albedo and brightness temperature as int16 (see trim_encoding.py), with
+# this maximum absolute error per variable; every packed file is checked against it
+PACK_TO_INT16 = False
+PACK_MAX_ERROR = {
+    **{f"albedo_0{i}": 1e-4 for i in range(1, 7)},
+    **{f"tbb_{i:02}": 0.01 for i in range(7, 17)},  # Kelvin
+}
+
 
 # --- Progress Management Functions ---
 def load_progress(filepath):
@@ -76,40 +107,128 @@ def load_and_split_timestamps(filepath):
     return timestamps_by_year
 
 
+# --- Remote Day Listing Cache ---
+# The queue holds ~20 timestamps per day, and they all live in the same
+# /jma/netcdf/YYYYMM/DD/ folder, so each folder is listed once and the
+# full-disk names are reused (and saved for later sessions when persisted).
+FULL_DISK_SUFFIX = "06001_06001.nc"
+
+_listing_cache = {}  # ftp_dir -> sorted full-disk filenames
+_listed_this_session = set()  # folders listed live, never worth re-listing
+_listing_lock = threading.Lock()
+
+
+def load_listing_cache(filepath):
+    """Loads day listings saved by earlier sessions."""
+    if not os.path.exists(filepath):
+        return
+    with open(filepath, 'r') as f:
+        cached = json.load(f)
+    with _listing_lock:
+        for ftp_dir, names in cached.items():
+            _listing_cache.setdefault(ftp_dir, names)
+
+
+def save_listing_cache(filepath):
+    """Saves the day listings (written to a temp file first, then renamed)."""
+    with _listing_lock:
+        snapshot = dict(_listing_cache)
+    tmp_path = f"{filepath}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f, sort_keys=True)
+    os.replace(tmp_path, filepath)
+
+
+def list_day_folder(ftp, ftp_dir, refresh=False):
+    """Returns the full-disk filenames in `ftp_dir`, listing it only if not cached."""
+    with _listing_lock:
+        cached = _listing_cache.get(ftp_dir)
+    if cached is not None and not refresh:
+        return cached
+
+    ftp.cwd(ftp_dir)
+    names = sorted(os.path.basename(f) for f in ftp.nlst() if f.endswith(FULL_DISK_SUFFIX))
+    with _listing_lock:
+        _listing_cache[ftp_dir] = names
+        _listed_this_session.add(ftp_dir)
+    return names
+
+
 # --- Core Download and Process Functions ---
 def find_remote_file(ftp, date_obj, hour_str):
-    """Navigates FTP and finds the filename for a given timestamp."""
+    """Finds the remote path of the full-disk file for a given timestamp."""
     y, m, d = date_obj.strftime("%Y"), date_obj.strftime("%m"), date_obj.strftime("%d")
     ftp_dir = f"/jma/netcdf/{y}{m}/{d}/"
-    ftp.cwd(ftp_dir)
-    
-    all_files = ftp.nlst()
-    
-    # Filter for the specific file matching the hour and full-disk type
-    matching_files = [
-        f for f in all_files
-        if f"_{hour_str}_" in f and f.endswith("06001_06001.nc")
-    ]
-    
+
+    # Filter for the specific file matching the hour (the cache only holds full-disk files)
+    matching_files = [f for f in list_day_folder(ftp, ftp_dir) if f"_{hour_str}_" in f]
+
+    if not matching_files and ftp_dir not in _listed_this_session:
+        # The cached listing may predate the file's upload; look again once.
+        matching_files = [f for f in list_day_folder(ftp, ftp_dir, refresh=True) if f"_{hour_str}_" in f]
+
     if not matching_files:
         raise FileNotFoundError(f"Could not find main data file for {date_obj.date()} {hour_str} in {ftp_dir}")
         
-    return matching_files[0] # Return the found filename
+    return ftp_dir + matching_files[0] # Return the found remote path
+
+def resolve_remote_files(ftp, timestamps):
+    """
+    Resolves the remote paths of many "YYYYMMDD_HHMM" timestamps up front.
+
+    Each day folder is listed at most once for the whole batch. Returns
+    ({timestamp: remote_path}, [timestamps with no file on the server]).
+    """
+    listed_before = len(_listed_this_session)
+    resolved, missing = {}, []
+    for timestamp_str in timestamps:
+        date_obj = datetime.strptime(timestamp_str[:8], '%Y%m%d')
+        try:
+            resolved[timestamp_str] = find_remote_file(ftp, date_obj, timestamp_str[9:])
+        except FileNotFoundError:
+            missing.append(timestamp_str)
 
-def download_file(ftp, remote_filename, local_path):
-    """Downloads a single file from the current FTP directory."""
-    with open(local_path, 'wb') as f:
-        ftp.retrbinary(f"RETR {remote_filename}", f.write)
+    print(f"📂 Resolved {len(resolved)} remote path(s) with {len(_listed_this_session) - listed_before} folder listing(s).")
+    if missing:
+        print(f"⚠️ No main data file on the server for {len(missing)} timestamp(s): {', '.join(missing[:10])}")
+    return resolved, missing
+
+def download_file(ftp, remote_path, local_path):
+    """
+    Downloads a single file over an already logged-in FTP session. An
+    interrupted transfer leaves <local_path>.part, which the next call resumes.
+    """
+    ftp.cwd(os.path.dirname(remote_path))
+    retrieve(ftp, os.path.basename(remote_path), local_path)
+
+def select_region(ds):
+    """The REGION box of a full-disk dataset, keeping only KEEP_VARIABLES."""
+    ds_region = ds.sel(
+        latitude=slice(REGION["lat_max"], REGION["lat_min"]),
+        longitude=slice(REGION["lon_min"], REGION["lon_max"])
+    )
+    return trim_encoding.select_variables(ds_region, KEEP_VARIABLES)
 
 def crop_nc_file(nc_path, output_path, delete_original=False):
     """Crops the NetCDF file and deletes the original."""
     ds = xr.open_dataset(nc_path, decode_timedelta=False)
     try:
-        ds_trimmed = ds.sel(
-            latitude=slice(REGION["lat_max"], REGION["lat_min"]),
-            longitude=slice(REGION["lon_min"], REGION["lon_max"])
-        )
-        ds_trimmed.to_netcdf(output_path, encoding={var: {"zlib": True} for var in ds_trimmed.data_vars})
+        ds_trimmed = select_region(ds)
+        if STORAGE_MODE == "chips":
+            ds_trimmed = station_chips.cut_chips_for_masks(ds_trimmed, MASKS_PATH, "main")
+        max_error = PACK_MAX_ERROR if PACK_TO_INT16 else None
+        if max_error:
+            ds_trimmed = ds_trimmed.load()  # Read once for packing, writing and the error check
+        # Written under a .part name first, so a crash never leaves a trimmed file that looks complete
+        partial_path = f"{output_path}.part"
+        try:
+            ds_trimmed.to_netcdf(partial_path, encoding=trim_encoding.encoding_for(ds_trimmed, max_error=max_error))
+            if max_error:
+                trim_encoding.check_packing(partial_path, ds_trimmed, max_error)
+            os.replace(partial_path, output_path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
         print(f"✂️  Trimmed and saved to {output_path}")
     finally:
         ds.close()
@@ -122,6 +241,51 @@ def crop_nc_file(nc_path, output_path, delete_original=False):
             print(f"❗️ Error deleting original file: {e}")
 
 
+# --- Per-Timestamp Steps (also used by run_downloader.py) ---
+def remote_file_for(ftp, timestamp_str):
+    """Remote path of the main data file of one "YYYYMMDD_HHMM" timestamp."""
+    date_obj = datetime.strptime(timestamp_str[:8], '%Y%m%d')
+    return find_remote_file(ftp, date_obj, timestamp_str[9:])
+
+def remote_size(ftp, timestamp_str):
+    """Size in bytes of the (untrimmed) remote main data file."""
+    remote_path = remote_file_for(ftp, timestamp_str)
+    ftp.voidcmd("TYPE I")  # SIZE is only answered in binary mode
+    return ftp.size(remote_path)
+
+def download_raw(ftp, timestamp_str):
+    """Downloads the untrimmed main data file as temp_<name> and returns its local path."""
+    remote_path = remote_file_for(ftp, timestamp_str)
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    local_temp_path = os.path.join(OUTPUT_DIR, f"temp_{os.path.basename(remote_path)}")
+    download_file(ftp, remote_path, local_temp_path)
+    return local_temp_path
+
+def trim_raw(local_temp_path):
+    """Trims a downloaded temp_ file to trimmed_<name> and returns that path; a file that fails to trim is removed. Safe to run in a worker process."""
+    remote_filename = os.path.basename(local_temp_path)[len("temp_"):]
+    trimmed_output_path = os.path.join(os.path.dirname(local_temp_path), f"trimmed_{remote_filename}")
+    try:
+        crop_nc_file(local_temp_path, trimmed_output_path, delete_original=DELETE_ORIGINAL_AFTER_TRIM)
+    except BaseException:
+        if os.path.exists(local_temp_path):
+            os.remove(local_temp_path)
+        raise
+    return trimmed_output_path
+
+def fetch_timestamp(ftp, timestamp_str, trim_lock=contextlib.nullcontext()):
+    """
+    Finds, downloads and trims the main data file of one "YYYYMMDD_HHMM" timestamp.
+
+    The HDF5 library is not thread-safe, so callers downloading from several
+    threads pass a shared `trim_lock` to run one trim at a time.
+    """
+    local_temp_path = download_raw(ftp, timestamp_str)
+    with trim_lock:
+        trim_raw(local_temp_path)
+
+
 # --- Main Download Session Logic ---
 def run_download_session(year_to_download, num_files_to_download, all_timestamps, progress):
     timestamps_for_year = all_timestamps.get(year_to_download)
@@ -140,29 +304,28 @@ def run_download_session(year_to_download, num_files_to_download, all_timestamps
     print(f"Queue: {len(timestamps_for_year)} files | Current Progress: {start_index}")
     print(f"Attempting to download {end_index - start_index} file(s).")
     
-    ftp = FTP(FTP_SERVER)
-    ftp.login(USERNAME, PASSWORD)
+    # One scan of the output folder tells which timestamps are already trimmed.
+    already_trimmed = scan_timestamps(OUTPUT_DIR, prefix="trimmed_")
+
+    ftp = connect(FTP_SERVER, FTP_PORT, USERNAME, PASSWORD)
+
+    # Resolve every queued remote path first: one listing per day folder.
+    if PERSIST_LISTING_CACHE:
+        load_listing_cache(LISTING_CACHE_FILE)
+    pending = [ts for ts in timestamps_for_year[start_index:end_index] if ts not in already_trimmed]
+    resolve_remote_files(ftp, pending)
+    if PERSIST_LISTING_CACHE:
+        save_listing_cache(LISTING_CACHE_FILE)
 
     for i in range(start_index, end_index):
         timestamp_str = timestamps_for_year[i]
         print(f"\n[{i + 1}/{len(timestamps_for_year)}] Processing: {timestamp_str}")
         
-        local_temp_path = None
         try:
-            date_obj = datetime.strptime(timestamp_str[:8], '%Y%m%d')
-            hour_str = timestamp_str[9:]
-            
-            remote_filename = find_remote_file(ftp, date_obj, hour_str)
-            
-            os.makedirs(OUTPUT_DIR, exist_ok=True)
-            local_temp_path = os.path.join(OUTPUT_DIR, f"temp_{remote_filename}")
-            trimmed_output_path = os.path.join(OUTPUT_DIR, f"trimmed_{remote_filename}")
-
-            if os.path.exists(trimmed_output_path):
+            if timestamp_str in already_trimmed:
                 print("⏭️  Trimmed file already exists. Skipping.")
             else:
-                download_file(ftp, remote_filename, local_temp_path)
-                crop_nc_file(local_temp_path, trimmed_output_path, delete_original=DELETE_ORIGINAL_AFTER_TRIM)
+                fetch_timestamp(ftp, timestamp_str)
             
             progress[year_to_download][POINTER_KEY] = i + 1
             save_progress(PROGRESS_FILE, progress)
@@ -171,11 +334,9 @@ def run_download_session(year_to_download, num_files_to_download, all_timestamps
         except Exception as e:
             print(f"❗️ ERROR on file {timestamp_str}: {e}")
             print("Stopping session. You can rerun the script to retry.")
-            if local_temp_path and os.path.exists(local_temp_path):
-                os.remove(local_temp_path)
             break
     
-    ftp.quit()
+    close_quietly(ftp)
     print("\n--- Download Session Finished ---")
 
 
@@ -197,5 +358,8 @@ if __name__ == "__main__":
 
     all_timestamps = load_and_split_timestamps(TIMESTAMPS_FILE)
     progress_data = load_progress(PROGRESS_FILE)
+    if adopt_list(progress_data, year, list_identity(TIMESTAMPS_FILE)):
+        print(f"📋 The {year} pointers counted positions in another list than {os.path.basename(TIMESTAMPS_FILE)}; starting it from the top.")
+        save_progress(PROGRESS_FILE, progress_data)
     
     run_download_session(year, num_files, all_timestamps, progress_data)
\ No newline at end of file
@@ -0,0 +1,100 @@
+import os
+import io
+import sys
+import time
+import shutil
+import tempfile
+import contextlib
+import statistics
+import xarray as xr
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+import JAXA_PTree
+import jaxa_cloud_data_1
+import station_chips
+import trim_encoding
+
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "../../TOA reflectance and Cloud"))
+import main_v3
+
+# === Trim Settings Benchmark ===
+# Trims one raw main file and its cloud file with each configuration below,
+# then reports the bytes on disk and how long main_v3.py takes to extract the
+# stations from the result:
+#
+#   python benchmark_trim.py <raw_main.nc> <raw_cloud.nc> [repeats]
+#
+# Read times are measured with the files in the OS page cache, so they compare
+# decompression and chunk overhead rather than disk speed.
+
+MASKS_PATH = os.path.join(SCRIPT_DIR, "../../Pixels Close To Stations/precomputed_masks")
+REPEATS = 5
+
+CONFIGS = {
+    # What the downloaders wrote before: every variable, zlib with xarray's defaults
+    "baseline": {"keep": False, "chunk_sizes": None, "complevel": 4, "shuffle": True, "chips": False, "pack": False},
+    # The settings in JAXA_PTree.py / jaxa_cloud_data_1.py / trim_encoding.py
+    "tuned": {"keep": True, "chunk_sizes": trim_encoding.CHUNK_SIZES, "complevel": trim_encoding.COMPLEVEL, "shuffle": trim_encoding.SHUFFLE, "chips": False, "pack": False},
+    "tuned + int16": {"keep": True, "chunk_sizes": trim_encoding.CHUNK_SIZES, "complevel": trim_encoding.COMPLEVEL, "shuffle": trim_encoding.SHUFFLE, "chips": False, "pack": True},
+    "tuned + chips": {"keep": True, "chunk_sizes": trim_encoding.CHUNK_SIZES, "complevel": trim_encoding.COMPLEVEL, "shuffle": trim_encoding.SHUFFLE, "chips": True, "pack": False},
+}
+
+
+def trim(raw_path, out_path, module, kind, config):
+    """Same steps as the downloaders' trim, with the settings of `config`."""
+    with xr.open_dataset(raw_path, decode_timedelta=False) as ds:
+        region = module.REGION
+        ds_trimmed = ds.sel(
+            latitude=slice(region["lat_max"], region["lat_min"]),
+            longitude=slice(region["lon_min"], region["lon_max"])
+        )
+        if config["keep"]:
+            ds_trimmed = trim_encoding.select_variables(ds_trimmed, module.KEEP_VARIABLES)
+        if config["chips"]:
+            ds_trimmed = station_chips.cut_chips_for_masks(ds_trimmed, MASKS_PATH, kind)
+        max_error = getattr(module, "PACK_MAX_ERROR", None) if config["pack"] else None
+        encoding = trim_encoding.encoding_for(ds_trimmed, config["chunk_sizes"], config["complevel"], config["shuffle"], max_error)
+        ds_trimmed.to_netcdf(out_path, encoding=encoding)
+        if max_error:
+            trim_encoding.check_packing(out_path, ds_trimmed, max_error)
+
+
+def time_extraction(main_path, cloud_path, plan, repeats):
+    """Median seconds to open a trimmed pair and extract every station from it."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            with xr.open_dataset(main_path) as ds, xr.open_dataset(cloud_path) as ds_cloud:
+                result = main_v3.extract_timestamp(ds, ds_cloud, plan, "", "")
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), 0 if result is None else len(result)
+
+
+def run_benchmark(raw_main, raw_cloud, repeats=REPEATS):
+    with contextlib.redirect_stdout(io.StringIO()):
+        plan = main_v3.load_plan(MASKS_PATH)
+    work_dir = tempfile.mkdtemp(prefix="trim_benchmark_")
+    try:
+        print(f"{'config':<16}{'main MB':>10}{'cloud MB':>10}{'read ms':>10}{'rows':>8}")
+        for name, config in CONFIGS.items():
+            main_path = os.path.join(work_dir, f"{len(os.listdir(work_dir))}_main.nc")
+            cloud_path = os.path.join(work_dir, f"{len(os.listdir(work_dir))}_cloud.nc")
+            trim(raw_main, main_path, JAXA_PTree, "main", config)
+            trim(raw_cloud, cloud_path, jaxa_cloud_data_1, "cloud", config)
+            seconds, rows = time_extraction(main_path, cloud_path, plan, repeats)
+            print(
+                f"{name:<16}{os.path.getsize(main_path) / 1e6:>10.2f}{os.path.getsize(cloud_path) / 1e6:>10.2f}"
+                f"{seconds * 1e3:>10.1f}{rows:>8}"
+            )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        print(f"Usage: python {os.path.basename(__file__)} <raw_main.nc> <raw_cloud.nc> [repeats]")
+        sys.exit(1)
+    run_benchmark(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) == 4 else REPEATS)
@@ -0,0 +1,283 @@
+import os
+import csv
+import time
+import socket
+import sqlite3
+import contextlib
+
+# === Per-Timestamp Download State ===
+# One SQLite row per (timestamp, product) replaces the single pointer per year
+# and product of download_progress.json:
+#
+#   state          pending -> in_flight -> done | failed | skipped
+#   attempts       claims so far; failed rows are retried until MAX_ATTEMPTS
+#   raw_bytes      size of the untrimmed file on the server
+#   trimmed_bytes  size of the trimmed file on disk
+#   lease_owner    "host:pid" of the session downloading it, while in_flight
+#   lease_expires  after this (unix time) another session may claim it again
+#
+# Sessions claim work in one write transaction, so several processes (or
+# machines sharing the folder) never download the same file twice while its
+# lease runs. Keep the database on a local disk or a file share with working
+# locks; SQLite is not safe on filesystems without them.
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_DB = os.getenv("DOWNLOAD_STATE_DB", os.path.join(SCRIPT_DIR, "download_state.sqlite"))
+
+LEASE_SECONDS = 30 * 60  # Renewed while the session is alive; a crashed session's files free up after this
+MAX_ATTEMPTS = 3  # Claims per file before a failure is left for a human to look at
+FINAL_STATES = ("done", "skipped")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS downloads (
+    timestamp     TEXT NOT NULL,
+    product       TEXT NOT NULL,
+    year          TEXT NOT NULL,
+    position      INTEGER NOT NULL,
+    state         TEXT NOT NULL DEFAULT 'pending'
+                  CHECK (state IN ('pending', 'in_flight', 'done', 'failed', 'skipped')),
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    raw_bytes     INTEGER,
+    trimmed_bytes INTEGER,
+    lease_owner   TEXT,
+    lease_expires REAL,
+    detail        TEXT,
+    updated_at    REAL,
+    PRIMARY KEY (timestamp, product)
+);
+CREATE INDEX IF NOT EXISTS downloads_by_position ON downloads (year, position);
+"""
+
+# Rows a session may take: new, retryable, or abandoned by a session whose lease
+# ran out, as long as they are in the current timestamp list.
+CLAIMABLE = """(
+    position >= 0 AND (
+        state = 'pending'
+        OR (state = 'failed' AND attempts < :max_attempts)
+        OR (state = 'in_flight' AND lease_expires < :now)
+    )
+)"""
+
+
+def session_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class DownloadState:
+    """The download state database of one machine or shared folder. Use from one thread."""
+
+    def __init__(self, path=STATE_DB, owner=None, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.owner = owner or session_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Autocommit; writes that must be atomic open their own transaction.
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE takes the write lock up front, so two claims never interleave."""
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    # --- Setup and Migration ---
+    def add_timestamps(self, year, timestamps, products):
+        """
+        Registers every (timestamp, product) of the year as pending and gives
+        each row its place in the list; existing rows keep their state.
+
+        Rows of the year that are not in the list get position -1 and are
+        neither claimed nor counted, so switching to another list (such as
+        the ranked queue of plan_downloads.py) follows the new order and
+        does not fetch the rest of the old one. Finished rows stay finished
+        by timestamp, whatever their new position.
+        """
+        now = time.time()
+        with self._transaction():
+            self.db.execute("UPDATE downloads SET position = -1 WHERE year = ?", (year,))
+            self.db.executemany(
+                "INSERT INTO downloads (timestamp, product, year, position, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (timestamp, product) DO UPDATE SET position = excluded.position",
+                [(ts, product, year, i, now) for i, ts in enumerate(timestamps) for product in products],
+            )
+
+    def import_pointers(self, progress, year, products):
+        """
+        Marks everything below the download_progress.json pointers as done.
+
+        Runs on every start, so the first run migrates the JSON and later runs
+        pick up pointers moved by the standalone downloaders or a teammate.
+        The pointers must count positions in the current list (see
+        timestamp_lists.pointers_match). Returns the number of rows changed.
+        """
+        changed = 0
+        with self._transaction():
+            for product in products:
+                pointer = progress.get(year, {}).get(product, 0)
+                changed += self.db.execute(
+                    "UPDATE downloads SET state = 'done', detail = 'download_progress.json', updated_at = ? "
+                    "WHERE year = ? AND product = ? AND position >= 0 AND position < ? AND state IN ('pending', 'failed')",
+                    (time.time(), year, product, pointer),
+                ).rowcount
+        return changed
+
+    def import_skip_log(self, skip_log_path):
+        """Marks the downloads listed in skipped_timestamps.csv as skipped. Returns the number of rows changed."""
+        if not os.path.exists(skip_log_path):
+            return 0
+        with open(skip_log_path, newline="") as f:
+            rows = [(row["reason"], time.time(), row["timestamp"], row["product"]) for row in csv.DictReader(f)]
+        with self._transaction():
+            return sum(
+                self.db.execute(
+                    "UPDATE downloads SET state = 'skipped', detail = ?, updated_at = ? "
+                    "WHERE timestamp = ? AND product = ? AND state IN ('pending', 'failed')",
+                    row,
+                ).rowcount
+                for row in rows
+            )
+
+    # --- Claiming Work ---
+    def claim(self, year, batch_size):
+        """
+        Leases the claimable downloads of the first `batch_size` timestamps
+        that have any, in list order. Returns [(position, timestamp, product)].
+
+        Both products of a timestamp are claimed together, so a product that
+        fell behind is picked up with no separate catch-up step.
+        """
+        now = time.time()
+        params = {"year": year, "now": now, "max_attempts": self.max_attempts, "limit": batch_size}
+        with self._transaction():
+            rows = self.db.execute(
+                f"SELECT position, timestamp, product FROM downloads "
+                f"WHERE year = :year AND {CLAIMABLE} AND position IN ("
+                f"    SELECT DISTINCT position FROM downloads WHERE year = :year AND {CLAIMABLE} "
+                f"    ORDER BY position LIMIT :limit"
+                f") ORDER BY position, product",
+                params,
+            ).fetchall()
+            self.db.executemany(
+                "UPDATE downloads SET state = 'in_flight', attempts = attempts + 1, lease_owner = ?, "
+                "lease_expires = ?, updated_at = ? WHERE timestamp = ? AND product = ?",
+                [(self.owner, now + self.lease_seconds, now, ts, product) for _, ts, product in rows],
+            )
+        return rows
+
+    def renew_leases(self):
+        """Pushes back the expiry of every download this session holds."""
+        now = time.time()
+        self.db.execute(
+            "UPDATE downloads SET lease_expires = ? WHERE lease_owner = ? AND state = 'in_flight'",
+            (now + self.lease_seconds, self.owner),
+        )
+
+    def release(self, timestamp, product):
+        """Hands back a claim that was never attempted (e.g. cancelled); it does not count as an attempt."""
+        self._finish(timestamp, product, "pending", attempts_delta=-1)
+
+    def release_all(self):
+        """Hands back every claim this session still holds (end of session)."""
+        self.db.execute(
+            "UPDATE downloads SET state = 'pending', attempts = MAX(attempts - 1, 0), lease_owner = NULL, "
+            "lease_expires = NULL, updated_at = ? WHERE lease_owner = ? AND state = 'in_flight'",
+            (time.time(), self.owner),
+        )
+
+    # --- Outcomes ---
+    def mark_done(self, timestamp, product, raw_bytes=None, trimmed_bytes=None, detail=None):
+        self._finish(timestamp, product, "done", raw_bytes=raw_bytes, trimmed_bytes=trimmed_bytes, detail=detail)
+
+    def mark_skipped(self, timestamp, product, detail):
+        self._finish(timestamp, product, "skipped", detail=detail)
+
+    def mark_failed(self, timestamp, product, error):
+        self._finish(timestamp, product, "failed", detail=str(error)[:500])
+
+    def _finish(self, timestamp, product, state, attempts_delta=0, raw_bytes=None, trimmed_bytes=None, detail=None):
+        # Only the lease holder may record an outcome, so a session whose lease
+        # expired cannot overwrite the row of the session that took over.
+        self.db.execute(
+            "UPDATE downloads SET state = ?, attempts = MAX(attempts + ?, 0), lease_owner = NULL, lease_expires = NULL, "
+            "raw_bytes = COALESCE(?, raw_bytes), trimmed_bytes = COALESCE(?, trimmed_bytes), "
+            "detail = COALESCE(?, detail), updated_at = ? "
+            "WHERE timestamp = ? AND product = ? AND lease_owner = ? AND state = 'in_flight'",
+            (state, attempts_delta, raw_bytes, trimmed_bytes, detail, time.time(), timestamp, product, self.owner),
+        )
+
+    def used_up(self, timestamp, product):
+        """True if the download failed and has no attempts left, so no session will claim it again."""
+        row = self.db.execute(
+            "SELECT state, attempts FROM downloads WHERE timestamp = ? AND product = ?", (timestamp, product)
+        ).fetchone()
+        return row is not None and row[0] == "failed" and row[1] >= self.max_attempts
+
+    def retry_failed(self, year):
+        """Gives failed downloads that used up their attempts a fresh set. Returns the number of rows changed."""
+        return self.db.execute(
+            "UPDATE downloads SET state = 'pending', attempts = 0, updated_at = ? WHERE year = ? AND state = 'failed' AND position >= 0",
+            (time.time(), year),
+        ).rowcount
+
+    # --- Reporting ---
+    def counts(self, year):
+        """{product: {state: count}} for the timestamps of one year in the current list."""
+        counts = {}
+        for product, state, n in self.db.execute(
+            "SELECT product, state, COUNT(*) FROM downloads WHERE year = ? AND position >= 0 GROUP BY product, state", (year,)
+        ):
+            counts.setdefault(product, {})[state] = n
+        return counts
+
+    def pointers(self, year, products):
+        """
+        Per product, the number of leading timestamps that are done or skipped:
+        the pointer download_progress.json would hold.
+        """
+        pointers = {}
+        for product in products:
+            first_open = self.db.execute(
+                f"SELECT MIN(position) FROM downloads WHERE year = ? AND product = ? AND position >= 0 "
+                f"AND state NOT IN ({', '.join('?' * len(FINAL_STATES))})",
+                (year, product, *FINAL_STATES),
+            ).fetchone()[0]
+            if first_open is None:
+                first_open = self.db.execute(
+                    "SELECT COUNT(*) FROM downloads WHERE year = ? AND product = ? AND position >= 0", (year, product)
+                ).fetchone()[0]
+            pointers[product] = first_open
+        return pointers
+
+
+
+# Usage: python download_state.py <year> [--retry-failed]
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) not in (2, 3) or (len(sys.argv) == 3 and sys.argv[2] != "--retry-failed"):
+        print(f"Usage: python {os.path.basename(__file__)} <year> [--retry-failed]")
+        sys.exit(1)
+
+    with DownloadState() as state:
+        year = sys.argv[1]
+        if len(sys.argv) == 3:
+            print(f"🔁 {state.retry_failed(year)} failed download(s) of {year} queued again")
+        for product, states in sorted(state.counts(year).items()):
+            print(f"📊 {product}: " + ", ".join(f"{name} {n}" for name, n in sorted(states.items())))
+        for product, pointer in state.pointers(year, ("cloud", "main")).items():
+            print(f"📍 {product}: first {pointer} timestamp(s) finished")
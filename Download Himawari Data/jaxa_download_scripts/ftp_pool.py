@@ -0,0 +1,194 @@
+import os
+import time
+import queue
+import threading
+import contextlib
+import ftplib
+from ftplib import FTP
+
+# === Pool of Logged-In FTP Sessions ===
+# Logging in to the JAXA server costs a TCP connect plus several control
+# round trips, so download threads borrow already logged-in sessions from a
+# bounded pool instead of opening one connection per file. Sessions that
+# break are dropped and replaced by a fresh login on the next borrow.
+
+FTP_TIMEOUT = 120  # Seconds without data before a session counts as dead
+MAX_RETRIES = 5  # Reconnects per task; transfers resume, so a retry only fetches the missing bytes
+RETRY_BACKOFF = 2.0  # Seconds before the first retry, doubled for each further one
+MAX_BACKOFF = 60.0
+
+
+class IncompleteTransfer(ConnectionError):
+    """The local file does not have the remote size after a transfer ended."""
+
+
+# Errors after which a session is reconnected and the task retried. Permanent
+# replies (550 file not found, 530 login refused, ...) are raised straight away.
+CONNECTION_ERRORS = (ConnectionError, TimeoutError, EOFError, ftplib.error_temp, ftplib.error_reply, ftplib.error_proto)
+
+# Replies to REST from servers that cannot resume (syntax error / not implemented).
+REST_UNSUPPORTED = ("500", "501", "502", "504")
+
+
+def connect(host, port, user, password, timeout=FTP_TIMEOUT):
+    """Opens and logs into a single FTP session."""
+    ftp = FTP()
+    ftp.connect(host, port, timeout=timeout)
+    ftp.login(user, password)
+    return ftp
+
+
+def close_quietly(ftp):
+    try:
+        ftp.quit()
+    except Exception:
+        ftp.close()
+
+
+def retrieve(ftp, remote_path, local_path):
+    """
+    Downloads `remote_path` (relative to the session's current folder) to
+    `local_path`, resuming from a `<local_path>.part` left by an interrupted
+    transfer.
+
+    The bytes go to the .part file, which is only renamed to `local_path`
+    once its size matches the remote SIZE. If the transfer breaks, the .part
+    file is kept, and the next call continues it with REST instead of
+    starting over; the raised error carries `partial_path` and
+    `partial_bytes` (None and 0 when nothing was kept), so callers can
+    account for the bytes left on disk. Returns the number of bytes fetched
+    in this call.
+    """
+    partial_path = f"{local_path}.part"
+    ftp.voidcmd("TYPE I")  # SIZE is only answered in binary mode
+    expected = ftp.size(remote_path)
+
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    if offset > expected:
+        offset = 0  # Left over from a different version of the file
+    if offset:
+        print(f"⏯️  Resuming {os.path.basename(local_path)} at {offset / 1e6:.1f} of {expected / 1e6:.1f} MB")
+
+    command = f"RETR {remote_path}"
+    try:
+        with open(partial_path, "r+b" if offset else "wb") as f:
+            f.seek(offset)
+            f.truncate()
+            try:
+                ftp.retrbinary(command, f.write, rest=offset or None)
+            except ftplib.error_perm as e:
+                if not (offset and str(e).startswith(REST_UNSUPPORTED)):
+                    raise
+                print(f"⚠️ Server cannot resume ({e}); downloading {os.path.basename(local_path)} from the start")
+                f.seek(0)
+                f.truncate()
+                offset = 0
+                ftp.retrbinary(command, f.write)
+    except BaseException as e:
+        kept = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        if kept:
+            print(f"⏸️  Kept {kept / 1e6:.1f} MB of {os.path.basename(local_path)} for resuming")
+        elif os.path.exists(partial_path):
+            os.remove(partial_path)  # Nothing to resume from
+        _with_partial(e, partial_path, kept)
+        raise
+
+    received = os.path.getsize(partial_path)
+    if received != expected:
+        if received > expected:
+            os.remove(partial_path)
+        error = IncompleteTransfer(f"{os.path.basename(local_path)}: {received} of {expected} bytes")
+        raise _with_partial(error, partial_path, received if received < expected else 0)
+    os.replace(partial_path, local_path)
+    return expected - offset
+
+
+def _with_partial(error, partial_path, kept):
+    """Tags a failed transfer's error with the .part file it left on disk."""
+    error.partial_path = partial_path if kept else None
+    error.partial_bytes = kept
+    return error
+
+
+class FTPPool:
+    """
+    Holds at most `size` logged-in sessions shared by any number of threads.
+
+    `session()` lends one out (blocking while all are busy), so `size` is also
+    the limit on concurrent transfers. Sessions are opened lazily.
+    """
+
+    def __init__(self, host, port, user, password, size=4, timeout=FTP_TIMEOUT, max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF):
+        self.host, self.port = host, port
+        self.user, self.password = user, password
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+        self._closed = False
+
+    @contextlib.contextmanager
+    def session(self):
+        """Borrows a session; it is dropped instead of returned if the block fails on a connection error."""
+        self._slots.acquire()
+        ftp = None
+        try:
+            try:
+                ftp = self._idle.get_nowait()
+            except queue.Empty:
+                ftp = connect(self.host, self.port, self.user, self.password, self.timeout)
+            yield ftp
+        except CONNECTION_ERRORS:
+            if ftp is not None:
+                ftp.close()
+                ftp = None
+            raise
+        finally:
+            if ftp is not None:
+                if self._closed:
+                    close_quietly(ftp)
+                else:
+                    self._idle.put(ftp)
+            self._slots.release()
+
+    def run(self, task, *args):
+        """
+        Calls task(ftp, *args) on a pooled session.
+
+        On a connection error the broken session is discarded and the task is
+        retried on a fresh one, up to max_retries times, waiting `backoff`
+        seconds before the first retry and twice as long before each next one.
+        The error that ends the task carries the .part file kept by the last
+        broken transfer (see retrieve), even if it was raised elsewhere.
+        """
+        broken = None  # Last error that left a .part file
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.session() as ftp:
+                    return task(ftp, *args)
+            except BaseException as e:
+                if hasattr(e, "partial_path"):
+                    broken = e
+                elif broken is not None:
+                    _with_partial(e, broken.partial_path, broken.partial_bytes)
+                if not isinstance(e, CONNECTION_ERRORS) or attempt == self.max_retries:
+                    raise
+                delay = min(self.backoff * 2**attempt, MAX_BACKOFF)
+                print(f"🔌 FTP connection lost ({str(e) or type(e).__name__}); reconnecting in {delay:g}s (retry {attempt + 1}/{self.max_retries})")
+                time.sleep(delay)
+
+    def close(self):
+        """Logs out of every idle session; sessions still lent out are closed when returned."""
+        self._closed = True
+        while True:
+            try:
+                close_quietly(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
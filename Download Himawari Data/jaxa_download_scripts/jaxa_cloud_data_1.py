@@ -1,7 +1,7 @@
 import os
 import sys
 import json
-from ftplib import FTP
+import contextlib
 import xarray as xr
 from datetime import datetime
 from dotenv import load_dotenv
@@ -11,7 +11,8 @@ load_dotenv()
 # 🔐 FTP Credentials
 USERNAME = os.getenv("FTP_USERNAME")
 PASSWORD = os.getenv("FTP_PWD")
-FTP_SERVER = "ftp.ptree.jaxa.jp"
+FTP_SERVER = os.getenv("FTP_SERVER", "ftp.ptree.jaxa.jp")  # Override to test against a local stand-in
+FTP_PORT = int(os.getenv("FTP_PORT", "21"))
 
 # --- NEW: Pointer key for this specific script ---
 POINTER_KEY = "cloud"
@@ -21,10 +22,17 @@ DELETE_ORIGINAL_AFTER_TRIM = True # <-- Change this to False to keep the origina
 # --- Get the absolute path to the directory where this script is located ---
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
-TIMESTAMPS_FILE = os.path.join(SCRIPT_DIR, "../List of Files needed/himawari_timestamps_to_download_filtered.txt")
+from timestamp_lists import TIMESTAMPS_FILE, list_identity, adopt_list  # Which list to download, set in timestamp_lists.py
 PROGRESS_FILE = os.path.join(SCRIPT_DIR, "download_progress.json")
 OUTPUT_DIR = os.path.join(SCRIPT_DIR, "../../TOA reflectance and Cloud/Cloud Mask Data")
 
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "../../TOA reflectance and Cloud"))
+from file_index import scan_timestamps
+from ftp_pool import connect, close_quietly, retrieve
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "../../Pixels Close To Stations"))
+import station_chips
+import trim_encoding
+
 # 🌍 Region of Interest for trimming
 REGION = {
     "lat_min": 17,
@@ -33,6 +41,14 @@ REGION = {
     "lon_max": 130
 }
 
+# 📦 What each trimmed file keeps: "region" (the whole REGION box) or "chips"
+# (only a small window around every station, see station_chips.py; needs MASKS_PATH)
+STORAGE_MODE = "region"
+MASKS_PATH = os.path.join(SCRIPT_DIR, "../../Pixels Close To Stations/precomputed_masks")
+
+# 🧾 Variables kept in the trimmed files (None keeps everything); main_v3.py reads only CLTYPE
+KEEP_VARIABLES = ["CLTYPE"]
+
 
 # --- MODIFIED: Progress Management Functions to handle nested structure ---
 def load_progress(filepath):
@@ -84,35 +100,43 @@ def get_remote_path(date_obj, hour_str):
     remote_path = f"/pub/himawari/L2/CLP/010/{year_month}/{day}/{hour_str[:2]}/{filename}"
     return remote_path, filename
 
-def download_file(remote_path, filename):
-    """Connects to FTP and downloads a single file."""
-    print(f"📡 Connecting to FTP for {filename}...")
-    ftp = FTP(FTP_SERVER)
-    ftp.login(USERNAME, PASSWORD)
-    
+def download_file(ftp, remote_path, filename):
+    """Downloads a single file over an already logged-in FTP session, resuming an interrupted one."""
     directory = os.path.dirname(remote_path)
     ftp.cwd(directory)
     
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     local_filepath = os.path.join(OUTPUT_DIR, filename)
     
-    with open(local_filepath, 'wb') as f:
-        ftp.retrbinary(f"RETR {filename}", f.write)
-        
-    ftp.quit()
+    retrieve(ftp, filename, local_filepath)
+
     print(f"✅ Downloaded {filename}")
     return local_filepath
 
+def select_region(ds):
+    """The REGION box of a full-disk dataset, keeping only KEEP_VARIABLES."""
+    ds_region = ds.sel(
+        latitude=slice(REGION["lat_max"], REGION["lat_min"]),
+        longitude=slice(REGION["lon_min"], REGION["lon_max"])
+    )
+    return trim_encoding.select_variables(ds_region, KEEP_VARIABLES)
+
 def trim_file(local_filepath, delete_original=False):
-    """Trims the downloaded NetCDF file and optionally deletes the original."""
+    """Trims the downloaded NetCDF file, optionally deletes the original, and returns the trimmed path."""
     ds = xr.open_dataset(local_filepath, decode_timedelta=False)
     try:
-        ds_trimmed = ds.sel(
-            latitude=slice(REGION["lat_max"], REGION["lat_min"]),
-            longitude=slice(REGION["lon_min"], REGION["lon_max"])
-        )
+        ds_trimmed = select_region(ds)
+        if STORAGE_MODE == "chips":
+            ds_trimmed = station_chips.cut_chips_for_masks(ds_trimmed, MASKS_PATH, "cloud")
         trimmed_filepath = os.path.join(os.path.dirname(local_filepath), f"trimmed_{os.path.basename(local_filepath)}")
-        ds_trimmed.to_netcdf(trimmed_filepath, encoding={var: {"zlib": True} for var in ds_trimmed.data_vars})
+        # Written under a .part name first, so a crash never leaves a trimmed file that looks complete
+        partial_path = f"{trimmed_filepath}.part"
+        try:
+            ds_trimmed.to_netcdf(partial_path, encoding=trim_encoding.encoding_for(ds_trimmed))
+            os.replace(partial_path, trimmed_filepath)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
         print(f"✂️  Trimmed and saved to {trimmed_filepath}")
     finally:
         ds.close()
@@ -124,6 +148,47 @@ def trim_file(local_filepath, delete_original=False):
         except OSError as e:
             print(f"❗️ Error deleting original file: {e}")
 
+    return trimmed_filepath
+
+
+# --- Per-Timestamp Steps (also used by run_downloader.py) ---
+def remote_file_for(timestamp_str):
+    """Remote path and filename of the cloud file of one "YYYYMMDD_HHMM" timestamp."""
+    date_obj = datetime.strptime(timestamp_str[:8], '%Y%m%d')
+    return get_remote_path(date_obj, timestamp_str[9:])
+
+def remote_size(ftp, timestamp_str):
+    """Size in bytes of the (untrimmed) remote cloud file."""
+    remote_path, _ = remote_file_for(timestamp_str)
+    ftp.voidcmd("TYPE I")  # SIZE is only answered in binary mode
+    return ftp.size(remote_path)
+
+def download_raw(ftp, timestamp_str):
+    """Downloads the untrimmed cloud file and returns its local path."""
+    remote_path, filename = remote_file_for(timestamp_str)
+    return download_file(ftp, remote_path, filename)
+
+def trim_raw(local_filepath):
+    """Trims a downloaded cloud file and returns the trimmed path; a file that fails to trim is removed. Safe to run in a worker process."""
+    try:
+        return trim_file(local_filepath, delete_original=DELETE_ORIGINAL_AFTER_TRIM)
+    except BaseException:
+        if os.path.exists(local_filepath):
+            os.remove(local_filepath)
+            print(f"🧹 Cleaned up downloaded file: {local_filepath}")
+        raise
+
+def fetch_timestamp(ftp, timestamp_str, trim_lock=contextlib.nullcontext()):
+    """
+    Downloads and trims the cloud file of one "YYYYMMDD_HHMM" timestamp.
+
+    Callers downloading from several threads pass a shared `trim_lock`, since
+    the HDF5 library is not thread-safe.
+    """
+    local_filepath = download_raw(ftp, timestamp_str)
+    with trim_lock:
+        trim_raw(local_filepath)
+
 
 # --- Main Download Session Logic ---
 def run_download_session(year_to_download, num_files_to_download, all_timestamps, progress):
@@ -144,19 +209,24 @@ def run_download_session(year_to_download, num_files_to_download, all_timestamps
     print(f"Queue: {len(timestamps_for_year)} files | Current Progress: {start_index}")
     print(f"Attempting to download {end_index - start_index} file(s).")
 
+    # One scan of the output folder tells which timestamps are already trimmed.
+    already_trimmed = scan_timestamps(OUTPUT_DIR, prefix="trimmed_")
+
+    # One logged-in session for the whole session instead of a login per file
+    ftp = None
+
     for i in range(start_index, end_index):
         timestamp_str = timestamps_for_year[i]
         print(f"\n[{i + 1}/{len(timestamps_for_year)}] Processing: {timestamp_str}")
         
-        local_filepath = None
         try:
-            date_obj = datetime.strptime(timestamp_str[:8], '%Y%m%d')
-            hour_str = timestamp_str[9:]
-            remote_path, filename = get_remote_path(date_obj, hour_str)
-            
-            local_filepath = download_file(remote_path, filename)
-            
-            trim_file(local_filepath, delete_original=DELETE_ORIGINAL_AFTER_TRIM)
+            if timestamp_str in already_trimmed:
+                print("⏭️  Trimmed file already exists. Skipping.")
+            else:
+                if ftp is None:
+                    print("📡 Connecting to FTP...")
+                    ftp = connect(FTP_SERVER, FTP_PORT, USERNAME, PASSWORD)
+                fetch_timestamp(ftp, timestamp_str)
             
             # --- MODIFIED: Update the nested pointer for this script's key ---
             progress[year_to_download][POINTER_KEY] = i + 1
@@ -166,11 +236,10 @@ def run_download_session(year_to_download, num_files_to_download, all_timestamps
         except Exception as e:
             print(f"❗️ ERROR on file {timestamp_str}: {e}")
             print("Stopping session. Please check the error. You can rerun the script to retry.")
-            if local_filepath and os.path.exists(local_filepath):
-                os.remove(local_filepath)
-                print(f"🧹 Cleaned up partially downloaded file: {local_filepath}")
             break
             
+    if ftp is not None:
+        close_quietly(ftp)
     print("\n--- Download Session Finished ---")
 
 
@@ -192,5 +261,8 @@ if __name__ == "__main__":
 
     all_timestamps = load_and_split_timestamps(TIMESTAMPS_FILE)
     progress_data = load_progress(PROGRESS_FILE)
+    if adopt_list(progress_data, year, list_identity(TIMESTAMPS_FILE)):
+        print(f"📋 The {year} pointers counted positions in another list than {os.path.basename(TIMESTAMPS_FILE)}; starting it from the top.")
+        save_progress(PROGRESS_FILE, progress_data)
     
     run_download_session(year, num_files, all_timestamps, progress_data)
\ No newline at end of file
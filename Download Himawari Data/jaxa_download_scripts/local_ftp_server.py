@@ -0,0 +1,183 @@
+import os
+import sys
+import numpy as np
+import xarray as xr
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# === Local Stand-In for the JAXA FTP Server ===
+# Serves small synthetic Himawari / L2CLP files under the same folder layout
+# as ftp.ptree.jaxa.jp, so the downloaders can be run and timed offline:
+#
+#   python local_ftp_server.py <root_folder> <year> <count> [port] [drop_after_mb]
+#
+# then, in another terminal (same FTP_USERNAME / FTP_PWD as the server):
+#
+#   FTP_SERVER=127.0.0.1 FTP_PORT=2121 python run_downloader.py <year> <count>
+#
+# With drop_after_mb, every transfer is cut off (control connection included,
+# like a network drop) after that many MB, to test resumed downloads.
+#
+# Needs pyftpdlib (pip install -r requirements-dev.txt), which is only used here.
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+from timestamp_lists import TIMESTAMPS_FILE
+
+DEFAULT_PORT = 2121
+USERNAME = os.getenv("FTP_USERNAME") or "user"
+PASSWORD = os.getenv("FTP_PWD") or "password"
+
+# Synthetic grids (degrees). Coarser than the real 0.02° / 0.05° grids to keep
+# the files small, but they cover the trimming REGION of the downloaders.
+MAIN_GRID = {"lat": (50.0, 10.0), "lon": (75.0, 135.0), "step": 0.1}
+CLOUD_GRID = {"lat": (50.0, 10.0), "lon": (75.0, 135.0), "step": 0.25}
+CLOUD_FREE_FRACTION = 0.3
+OVERCAST_EVERY = 3  # Every n-th timestamp gets a fully cloudy cloud file (exercises cloud gating)
+DROP_AFTER_BYTES = None  # Cut every transfer off after this many bytes (None = never)
+
+MAIN_VARS = (
+    [f"albedo_0{i}" for i in range(1, 7)]
+    + [f"tbb_{i:02}" for i in range(7, 17)]
+    + ["SOZ", "SAA", "SOA", "SAZ"]
+)
+
+
+# --- Synthetic Files ---
+def grid_coords(grid):
+    lat = np.arange(grid["lat"][0], grid["lat"][1] - 1e-9, -grid["step"]).astype("float32")
+    lon = np.arange(grid["lon"][0], grid["lon"][1] + 1e-9, grid["step"]).astype("float32")
+    return lat, lon
+
+
+def synthetic_main(seed=0):
+    """A full-disk-like main file: smooth albedo/tbb fields and plausible angles."""
+    rng = np.random.default_rng(seed)
+    lat, lon = grid_coords(MAIN_GRID)
+    lat_2d, lon_2d = np.meshgrid(lat, lon, indexing="ij")
+    variables = {}
+    for name in MAIN_VARS:
+        phase = rng.random() * np.pi
+        wave = np.sin(np.radians(lat_2d) * 3 + phase) * np.cos(np.radians(lon_2d) * 2 - phase)
+        if name.startswith("albedo"):
+            values = 0.2 + 0.1 * wave
+        elif name.startswith("tbb"):
+            values = 280 + 15 * wave
+        elif name in ("SOZ", "SAZ"):
+            values = 40 + 30 * wave
+        else:
+            values = 180 + 170 * wave
+        variables[name] = (("latitude", "longitude"), values.astype("float32"))
+    return xr.Dataset(variables, coords={"latitude": lat, "longitude": lon})
+
+
+def synthetic_cloud(seed=0, cloud_free_fraction=CLOUD_FREE_FRACTION):
+    """A cloud product file whose CLTYPE is 0 (clear) on `cloud_free_fraction` of the pixels."""
+    rng = np.random.default_rng(seed)
+    lat, lon = grid_coords(CLOUD_GRID)
+    cltype = rng.integers(1, 10, (len(lat), len(lon))).astype("int8")
+    cltype[rng.random(cltype.shape) < cloud_free_fraction] = 0
+    return xr.Dataset({"CLTYPE": (("latitude", "longitude"), cltype)}, coords={"latitude": lat, "longitude": lon})
+
+
+def remote_paths(timestamp_str):
+    """Paths of the main file (plus a second-resolution decoy) and the cloud file of one timestamp."""
+    date_obj = datetime.strptime(timestamp_str[:8], "%Y%m%d")
+    ymd, hour_str = date_obj.strftime("%Y%m%d"), timestamp_str[9:]
+    main_dir = f"jma/netcdf/{date_obj:%Y%m}/{date_obj:%d}"
+    cloud_dir = f"pub/himawari/L2/CLP/010/{date_obj:%Y%m}/{date_obj:%d}/{hour_str[:2]}"
+    return {
+        "main": f"{main_dir}/NC_H08_{ymd}_{hour_str}_R21_FLDK.06001_06001.nc",
+        "decoy": f"{main_dir}/NC_H08_{ymd}_{hour_str}_R21_FLDK.02401_02401.nc",
+        "cloud": f"{cloud_dir}/NC_H08_{ymd}_{hour_str}_L2CLP010_FLDK.02401_02401.nc",
+    }
+
+
+def build_tree(root, timestamps):
+    """
+    Writes one synthetic main file and two cloud files (partly clear and
+    overcast) and hard-links them under the remote path of every timestamp
+    (copies if hard links are not supported).
+    """
+    templates = os.path.join(root, "_templates")
+    os.makedirs(templates, exist_ok=True)
+    sources = {
+        "main": os.path.join(templates, "main.nc"),
+        "cloud": os.path.join(templates, "cloud.nc"),
+        "overcast": os.path.join(templates, "cloud_overcast.nc"),
+    }
+    sources["decoy"] = sources["cloud"]
+    if not os.path.exists(sources["main"]):
+        synthetic_main().to_netcdf(sources["main"])
+    if not os.path.exists(sources["cloud"]):
+        synthetic_cloud().to_netcdf(sources["cloud"])
+    if not os.path.exists(sources["overcast"]):
+        synthetic_cloud(cloud_free_fraction=0.0).to_netcdf(sources["overcast"])
+
+    for n, timestamp_str in enumerate(timestamps):
+        overcast = OVERCAST_EVERY and n % OVERCAST_EVERY == OVERCAST_EVERY - 1
+        for kind, rel_path in remote_paths(timestamp_str).items():
+            path = os.path.join(root, rel_path)
+            if os.path.exists(path):
+                continue
+            source = sources["overcast"] if kind == "cloud" and overcast else sources[kind]
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                os.link(source, path)
+            except OSError:
+                with open(source, "rb") as src, open(path, "wb") as dst:
+                    dst.write(src.read())
+    print(f"🗂️  Synthetic tree for {len(timestamps)} timestamp(s) ready in {root}")
+
+
+# --- FTP Server ---
+def make_server(root, port=DEFAULT_PORT, user=USERNAME, password=PASSWORD, host="127.0.0.1", drop_after_bytes=DROP_AFTER_BYTES):
+    """
+    Returns a threaded pyftpdlib server (one thread per session) serving `root`
+    read-only. With `drop_after_bytes`, each transfer drops the session after
+    sending that many bytes (REST still works, so downloads can resume).
+    """
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, DTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(user, password, root, perm="elr")
+
+    class DroppingDTPHandler(DTPHandler):
+        def send(self, data):
+            sent = super().send(data)
+            if self.tot_bytes_sent >= drop_after_bytes and not self._closed:
+                # No "426 transfer aborted" reply: the client just sees both connections vanish.
+                self.cmd_channel.close()
+                self.close()
+            return sent
+
+    attributes = {"authorizer": authorizer, "banner": "JAXA stand-in ready."}
+    if drop_after_bytes:
+        # sendfile() would bypass DTPHandler.send
+        attributes.update(dtp_handler=DroppingDTPHandler, use_sendfile=False)
+    handler = type("StandInHandler", (FTPHandler,), attributes)
+    return ThreadedFTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (4, 5, 6):
+        print(f"Usage: python {os.path.basename(__file__)} <root_folder> <year> <count> [port] [drop_after_mb]")
+        sys.exit(1)
+
+    root_folder, year, count = sys.argv[1], sys.argv[2], int(sys.argv[3])
+    port = int(sys.argv[4]) if len(sys.argv) >= 5 else DEFAULT_PORT
+    drop_after_bytes = int(float(sys.argv[5]) * 1e6) if len(sys.argv) == 6 else DROP_AFTER_BYTES
+
+    with open(TIMESTAMPS_FILE) as f:
+        year_timestamps = [line.strip() for line in f if line.strip().startswith(year)]
+    build_tree(root_folder, year_timestamps[:count])
+
+    server = make_server(os.path.abspath(root_folder), port, drop_after_bytes=drop_after_bytes)
+    print(f"📡 Serving {root_folder} on ftp://127.0.0.1:{port} (user {USERNAME})")
+    if drop_after_bytes:
+        print(f"✂️  Dropping every transfer after {drop_after_bytes / 1e6:g} MB")
+    server.serve_forever()
@@ -1,108 +1,562 @@
 import os
 import sys
-import json
-import subprocess
+import csv
+import time
+import glob
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 # This script assumes it is in the same directory as the downloaders.
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.abspath(os.path.join(SCRIPT_DIR, "../.."))
+sys.path.insert(0, SCRIPT_DIR)
 
-CLOUD_SCRIPT_PATH = os.path.join(SCRIPT_DIR, "jaxa_cloud_data_1.py")
-MAIN_SCRIPT_PATH = os.path.join(SCRIPT_DIR, "JAXA_PTree.py")
+import jaxa_cloud_data_1
+import JAXA_PTree
+from file_index import scan_timestamps
+from ftp_pool import FTPPool
+from download_state import DownloadState, MAX_ATTEMPTS
+from timestamp_lists import TIMESTAMPS_FILE, list_identity, pointers_match, set_pointer_list
 
 PROGRESS_FILE = os.path.join(SCRIPT_DIR, "download_progress.json")
 
+# Product name (pointer key in download_progress.json) -> downloader module for that product
+PRODUCTS = {
+    "cloud": jaxa_cloud_data_1,
+    "main": JAXA_PTree,
+}
 
-# --- Progress Management Function ---
-def load_progress(filepath):
-    """Loads and validates the nested download progress from the JSON file."""
-    if not os.path.exists(filepath):
-        print("Progress file not found. Please run one of the download scripts once to create it.")
-        return None
-    with open(filepath, 'r') as f:
-        return json.load(f)
+# Number of logged-in FTP sessions, i.e. files transferred at the same time.
+# Keep it modest: the JAXA server limits concurrent logins per account.
+DOWNLOAD_WORKERS = 4
+TRIM_WORKERS = 2  # Processes trimming downloaded files while the next ones transfer
+MAX_RAW_BYTES = 8 * 1024**3  # Untrimmed files allowed on disk at once; downloads wait for room
 
-# --- Main Orchestrator Logic ---
-def run_orchestrator(year, batch_size):
+# Cloud-gated mode: download each timestamp's (small) cloud file first and only
+# fetch the (large) main file when at least one station has a cloud-free pixel.
+# Needs the station masks of "Pixels Close To Stations".
+CLOUD_GATED = False
+MASKS_PATH = os.path.join(PROJECT_DIR, "Pixels Close To Stations/precomputed_masks")
+SKIP_LOG_FILE = os.path.join(SCRIPT_DIR, "skipped_timestamps.csv")
+
+# Streaming mode: as soon as both files of a timestamp are downloaded, extract
+# the station pixels from them (as main_v3.py does) in a trim worker, write the
+# rows to main_v3.py's output, and delete the files. Nothing piles up in the
+# data folders; disk use stays within MAX_RAW_BYTES. main_v3.py's relative
+# output paths are taken from the project root. Needs the station masks.
+STREAM_EXTRACT = False
+
+LEASE_RENEW_SECONDS = 60  # How often a running session pushes back the leases of its downloads
+
+
+# --- Station Pixels (Cloud Gate and Streaming) ---
+def import_main_v3():
+    """Imports main_v3.py with its relative folders anchored at the project root, whatever the working directory."""
+    toa_dir = os.path.join(PROJECT_DIR, "TOA reflectance and Cloud")
+    if toa_dir not in sys.path:
+        sys.path.insert(0, toa_dir)
+    import main_v3
+
+    for name in ("output_folder", "store_folder", "masks_path"):
+        setattr(main_v3, name, os.path.join(PROJECT_DIR, getattr(main_v3, name)))
+    return main_v3
+
+
+def load_station_plan():
+    """Loads the station masks into the same extraction plan main_v3.py uses."""
+    plan = import_main_v3().load_plan(MASKS_PATH)
+    if plan is None:
+        raise ValueError(f"No station in the masks at {MASKS_PATH}; cannot gate or extract")
+    return plan
+
+
+def region_view(product, ds, path):
+    """A downloaded file as main_v3.py expects it: trimmed files as they are, raw files cut to the REGION box in memory."""
+    if os.path.basename(path).startswith("trimmed_"):
+        return ds
+    return PRODUCTS[product].select_region(ds)
+
+
+def cloud_free_stations(cloud_path, plan):
+    """Names of the stations with at least one cloud-free pixel (CLTYPE == 0) in a cloud file (trimmed or raw)."""
+    import xarray as xr
+    from main_v3 import read_cloud_types
+
+    with xr.open_dataset(cloud_path) as ds_cloud:
+        is_cloud_free = read_cloud_types(region_view("cloud", ds_cloud, cloud_path), plan) == 0
+    return [name for name, points in plan["station_points"].items() if is_cloud_free[points].any()]
+
+
+def record_skip(timestamp_str, product, reason, detail=""):
+    """Appends a skipped download to SKIP_LOG_FILE (timestamp, product, reason, detail)."""
+    is_new = not os.path.exists(SKIP_LOG_FILE)
+    with open(SKIP_LOG_FILE, "a", newline="") as f:
+        writer = csv.writer(f)
+        if is_new:
+            writer.writerow(["timestamp", "product", "reason", "detail"])
+        writer.writerow([timestamp_str, product, reason, detail])
+
+
+# --- Pipelined Download Engine ---
+# Download threads only transfer raw files; trimming (zlib recompression,
+# CPU-bound) runs in a separate process pool, so file i is trimmed while file
+# i+1 is still downloading. Raw files waiting for a trim are bounded by
+# MAX_RAW_BYTES: a download does not start until its file fits the budget.
+# The .part files kept by broken transfers count too: those on disk when a
+# session starts, and those its failed downloads leave, stay reserved.
+class BudgetClosed(RuntimeError):
+    """Raised in threads waiting for disk room when the session is shutting down."""
+
+
+class DiskBudget:
+    """Bytes of raw (untrimmed) files allowed on disk at once."""
+
+    def __init__(self, limit_bytes, used=0):
+        self.limit = limit_bytes
+        self.used = used
+        self.closed = False
+        self._changed = threading.Condition()
+
+    def reserve(self, nbytes):
+        """
+        Blocks until `nbytes` fit. A file larger than the whole budget may go
+        once the disk is empty. Raises BudgetClosed once close() was called.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.closed or self.used == 0 or self.used + nbytes <= self.limit)
+            if self.closed:
+                raise BudgetClosed("session is shutting down")
+            self.used += nbytes
+
+    def close(self):
+        """Wakes every waiting reserve() with BudgetClosed, so download threads can exit."""
+        with self._changed:
+            self.closed = True
+            self._changed.notify_all()
+
+    def release(self, nbytes):
+        with self._changed:
+            self.used -= nbytes
+            self._changed.notify_all()
+
+
+def partial_bytes_on_disk():
+    """Bytes of the .part files left in the products' output folders by broken transfers."""
+    return sum(
+        os.path.getsize(path)
+        for module in PRODUCTS.values()
+        for path in glob.glob(os.path.join(glob.escape(module.OUTPUT_DIR), "*.part"))
+    )
+
+
+def new_budget():
+    """A DiskBudget for one session, with the .part files already on disk counted as used."""
+    return DiskBudget(MAX_RAW_BYTES, used=partial_bytes_on_disk())
+
+
+def download_job(pool, budget, product, timestamp_str):
     """
-    Manages the download process by synchronizing and then batch-downloading
-    both cloud and main data files.
+    Download stage: waits for room on disk, then fetches the raw file. Returns
+    (raw_path, nbytes). On failure, the bytes of the .part file kept for
+    resuming stay reserved.
     """
-    print("--- 🚀 Starting Download Orchestrator ---")
+    module = PRODUCTS[product]
+    nbytes = pool.run(module.remote_size, timestamp_str)
+    budget.reserve(nbytes)  # No FTP session is held while waiting
+    try:
+        return pool.run(module.download_raw, timestamp_str), nbytes
+    except BaseException as e:
+        budget.release(nbytes - getattr(e, "partial_bytes", 0))
+        raise
 
-    # --- 1. Catch-up Phase ---
-    print("\n--- 🔍 Phase 1: Checking and Synchronizing Pointers ---")
-    
-    while True:
-        progress = load_progress(PROGRESS_FILE)
-        if not progress: return
 
-        cloud_ptr = progress[year].get("cloud", 0)
-        main_ptr = progress[year].get("main", 0)
+def drop_dead_partial(state, budget, error, timestamp_str, products):
+    """
+    Deletes the .part file a failed download kept once its row has used up
+    MAX_ATTEMPTS (no later session resumes it), and frees its bytes.
+    """
+    path = getattr(error, "partial_path", None)
+    if path and os.path.exists(path) and any(state.used_up(timestamp_str, product) for product in products):
+        os.remove(path)
+        budget.release(error.partial_bytes)
+        print(f"🧹 {timestamp_str}: out of attempts, removed {os.path.basename(path)}")
 
-        if cloud_ptr == main_ptr:
-            print(f"✅ Pointers are synchronized for {year} at index {cloud_ptr}.")
-            break
 
-        if cloud_ptr < main_ptr:
-            print(f"🟡 Cloud data is behind by {main_ptr - cloud_ptr} file(s). Catching up...")
-            script_to_run = CLOUD_SCRIPT_PATH
-            lagging_type = "Cloud"
+def resolve_main_paths(pool, main_timestamps):
+    """Lists each remote day folder once for all queued main files, before any download starts."""
+    if JAXA_PTree.PERSIST_LISTING_CACHE:
+        JAXA_PTree.load_listing_cache(JAXA_PTree.LISTING_CACHE_FILE)
+
+    pool.run(JAXA_PTree.resolve_remote_files, main_timestamps)
+
+    if JAXA_PTree.PERSIST_LISTING_CACHE:
+        JAXA_PTree.save_listing_cache(JAXA_PTree.LISTING_CACHE_FILE)
+
+
+def run_jobs(claims, state, workers):
+    """
+    Runs the claimed (position, timestamp, product) downloads through the
+    download -> trim pipeline.
+
+    Up to `workers` transfers are in flight over pooled FTP sessions while
+    TRIM_WORKERS processes trim finished downloads. Every outcome is written
+    to the state database as it happens. A failed file is recorded and the
+    others go on; it is retried by a later session, up to MAX_ATTEMPTS times.
+
+    With CLOUD_GATED, a main file is only queued once its timestamp's cloud
+    file is trimmed and shows a cloud-free pixel at some station; otherwise
+    it is recorded as skipped (also in SKIP_LOG_FILE).
+    """
+    # One scan per output folder tells which timestamps are already trimmed.
+    already_trimmed = {product: scan_timestamps(module.OUTPUT_DIR, prefix="trimmed_") for product, module in PRODUCTS.items()}
+    finished, failed, skipped = [], [], []
+
+    to_fetch = []
+    for _, timestamp_str, product in claims:
+        if timestamp_str in already_trimmed[product]:
+            print(f"⏭️  {timestamp_str} ({product}): trimmed file already exists. Skipping.")
+            state.mark_done(timestamp_str, product, trimmed_bytes=os.path.getsize(already_trimmed[product][timestamp_str]))
+            finished.append((timestamp_str, product))
         else:
-            print(f"🟡 Main data is behind by {cloud_ptr - main_ptr} file(s). Catching up...")
-            script_to_run = MAIN_SCRIPT_PATH
-            lagging_type = "Main"
-            
-        # Construct the full, quoted path for the command
-        command_path = f'"{script_to_run}"'
-
-        print(f"Executing: {os.path.basename(sys.executable)} {os.path.basename(script_to_run)} {year} 1")
-        
-        result = subprocess.run([sys.executable, script_to_run, year, "1"], capture_output=True, text=True)
-
-        if result.returncode != 0:
-            print(f"❌ ERROR while running {lagging_type} script to catch up.")
-            print(result.stderr)
-            return
-    
-    # --- 2. Batch Download Phase ---
-    print(f"\n--- 🔄 Phase 2: Starting Batch Download for {batch_size} Pairs ---")
-    
-    current_progress = load_progress(PROGRESS_FILE)[year]['cloud'] # Get latest progress
-    
-    for i in range(batch_size):
-        print(f"\n--- Downloading Pair {i + 1}/{batch_size} (Index {current_progress + i}) ---")
-
-        print("Downloading Cloud Data...")
-        result_cloud = subprocess.run([sys.executable, CLOUD_SCRIPT_PATH, year, "1"], capture_output=True, text=True)
-        if result_cloud.returncode != 0:
-            print("❌ ERROR downloading cloud file. Stopping batch.")
-            print(result_cloud.stderr)
-            return
-            
-        print("Downloading Main Data...")
-        result_main = subprocess.run([sys.executable, MAIN_SCRIPT_PATH, year, "1"], capture_output=True, text=True)
-        if result_main.returncode != 0:
-            print("❌ ERROR downloading main data file. Stopping batch.")
-            print(result_main.stderr)
+            to_fetch.append((timestamp_str, product))
+    if not to_fetch:
+        return finished, failed
+
+    gate_plan = load_station_plan() if CLOUD_GATED else None
+    cloud_pending = {ts for ts, product in to_fetch if product == "cloud"}
+    main_waiting = set()  # Main jobs waiting for their cloud file
+
+    budget = new_budget()
+    pool = FTPPool(JAXA_PTree.FTP_SERVER, JAXA_PTree.FTP_PORT, JAXA_PTree.USERNAME, JAXA_PTree.PASSWORD, size=workers)
+    downloads = ThreadPoolExecutor(max_workers=workers)
+    # "spawn" keeps the trim processes clear of the download threads' locks (and matches Windows)
+    trims = ProcessPoolExecutor(max_workers=TRIM_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    in_flight = {}  # future -> (stage, timestamp, product, raw bytes reserved)
+
+    def submit_download(timestamp_str, product):
+        in_flight[downloads.submit(download_job, pool, budget, product, timestamp_str)] = ("download", timestamp_str, product, 0)
+
+    def gate_main(timestamp_str, cloud_path):
+        """Queues the main file of a timestamp unless every station is cloudy."""
+        clear = cloud_free_stations(cloud_path, gate_plan)
+        if clear:
+            submit_download(timestamp_str, "main")
             return
+        print(f"☁️  {timestamp_str}: every station is cloudy. Skipping main file.")
+        record_skip(timestamp_str, "main", "all_stations_cloudy", os.path.basename(cloud_path))
+        state.mark_skipped(timestamp_str, "main", "all_stations_cloudy")
+        skipped.append(timestamp_str)
+
+    try:
+        resolve_main_paths(pool, [ts for ts, product in to_fetch if product == "main"])
+
+        for timestamp_str, product in to_fetch:
+            if product == "main" and gate_plan is not None:
+                if timestamp_str in cloud_pending:
+                    main_waiting.add(timestamp_str)
+                    continue
+                if timestamp_str in already_trimmed["cloud"]:
+                    gate_main(timestamp_str, already_trimmed["cloud"][timestamp_str])
+                    continue
+                print(f"⚠️ {timestamp_str}: no cloud file to gate on; downloading the main file anyway.")
+            submit_download(timestamp_str, product)
 
+        last_renewal = time.monotonic()
+        while in_flight:
+            done, _ = wait(in_flight, timeout=LEASE_RENEW_SECONDS, return_when=FIRST_COMPLETED)
+            if time.monotonic() - last_renewal >= LEASE_RENEW_SECONDS:
+                state.renew_leases()
+                last_renewal = time.monotonic()
+
+            for future in done:
+                stage, timestamp_str, product, nbytes = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if stage == "trim":
+                        budget.release(nbytes)
+                    print(f"❗️ ERROR ({stage}) on {timestamp_str} ({product}): {e}")
+                    state.mark_failed(timestamp_str, product, f"{stage}: {e}")
+                    failed.append((timestamp_str, product))
+                    drop_dead_partial(state, budget, e, timestamp_str, [product])
+                    if product == "cloud" and timestamp_str in main_waiting:
+                        # Nothing to gate on; the main file waits for a later session.
+                        main_waiting.discard(timestamp_str)
+                        state.release(timestamp_str, "main")
+                    continue
+
+                if stage == "download":
+                    raw_path, nbytes = result
+                    in_flight[trims.submit(PRODUCTS[product].trim_raw, raw_path)] = ("trim", timestamp_str, product, nbytes)
+                    continue
+
+                budget.release(nbytes)
+                print(f"✅ {timestamp_str} ({product}) done")
+                state.mark_done(timestamp_str, product, raw_bytes=nbytes, trimmed_bytes=os.path.getsize(result))
+                finished.append((timestamp_str, product))
+                if product == "cloud" and timestamp_str in main_waiting:
+                    main_waiting.discard(timestamp_str)
+                    gate_main(timestamp_str, result)
+    finally:
+        budget.close()  # Nothing frees room once this loop is gone
+        downloads.shutdown(wait=True, cancel_futures=True)
+        trims.shutdown(wait=True)
+        pool.close()
+
+    if gate_plan is not None:
+        print(f"☁️  Cloud gate: {len(skipped)} main file(s) skipped (logged in {os.path.basename(SKIP_LOG_FILE)}).")
+    return finished, failed
+
+
+# --- Streaming Mode ---
+# Files of a timestamp are downloaded under one disk reservation and handed to
+# a trim worker together, which extracts the station rows and deletes them.
+HDF5_LOCK = threading.Lock()  # The gate reads NetCDF in download threads here; HDF5 is not thread-safe
+_stream_plan = None  # Extraction plan, loaded once per trim worker process
+
+
+def remove_files(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def stream_download_job(pool, budget, timestamp_str, products, partners, gate_plan):
+    """
+    Download stage of streaming mode: fetches the raw `products` of one
+    timestamp, reserving room for all of them at once so that no timestamp
+    holds half its files while waiting for disk. `partners` maps products
+    already on disk to their trimmed files.
+
+    Returns (paths by product, raw sizes by product); paths is None when the
+    cloud gate skipped the main file (the cloud file is then deleted).
+    """
+    sizes = {product: pool.run(PRODUCTS[product].remote_size, timestamp_str) for product in products}
+    budget.reserve(sum(sizes.values()))
+    paths = dict(partners)
+    try:
+        for product in products:
+            if product == "main" and gate_plan is not None:
+                with HDF5_LOCK:
+                    clear = cloud_free_stations(paths["cloud"], gate_plan)
+                if not clear:
+                    remove_files(paths[p] for p in products if p in paths)
+                    budget.release(sum(sizes.values()))
+                    return None, sizes
+            paths[product] = pool.run(PRODUCTS[product].download_raw, timestamp_str)
+    except BaseException as e:
+        remove_files(paths[p] for p in products if p in paths)
+        budget.release(sum(sizes.values()) - getattr(e, "partial_bytes", 0))
+        raise
+    return paths, sizes
+
+
+def extract_pair(timestamp_str, paths, delete_paths):
+    """
+    Extraction stage of streaming mode (runs in a trim worker): writes the
+    station rows of one timestamp to main_v3.py's output, then deletes
+    `delete_paths` whether or not it succeeded. Returns "saved" or "empty".
+    """
+    global _stream_plan
+    import xarray as xr
+
+    try:
+        if _stream_plan is None:
+            _stream_plan = load_station_plan()
+        main_v3 = import_main_v3()
+        os.makedirs(main_v3.store_folder if main_v3.output_format == "parquet" else main_v3.output_folder, exist_ok=True)
+        with xr.open_dataset(paths["main"]) as ds, xr.open_dataset(paths["cloud"]) as ds_cloud:
+            return main_v3.extract_and_save(
+                timestamp_str,
+                region_view("main", ds, paths["main"]),
+                region_view("cloud", ds_cloud, paths["cloud"]),
+                _stream_plan,
+            )
+    finally:
+        remove_files(delete_paths)
+
+
+def run_stream_jobs(claims, state, workers):
+    """
+    Streaming counterpart of run_jobs: downloads the claimed files timestamp
+    by timestamp, extracts each timestamp's station rows as soon as its main
+    and cloud files are both on disk, and deletes the files.
+
+    A trimmed file already on disk is used (and kept) instead of downloading
+    its product again. A timestamp whose other product is neither claimed
+    nor on disk cannot be extracted, and is marked failed. Outcomes are only
+    recorded for the products this session claimed.
+    """
+    already_trimmed = {product: scan_timestamps(module.OUTPUT_DIR, prefix="trimmed_") for product, module in PRODUCTS.items()}
+    claimed = {}
+    for _, timestamp_str, product in claims:
+        claimed.setdefault(timestamp_str, set()).add(product)
+    finished, failed, skipped, statuses = [], [], [], {}
+
+    gate_plan = load_station_plan() if CLOUD_GATED else None
+    budget = new_budget()
+    pool = FTPPool(JAXA_PTree.FTP_SERVER, JAXA_PTree.FTP_PORT, JAXA_PTree.USERNAME, JAXA_PTree.PASSWORD, size=workers)
+    downloads = ThreadPoolExecutor(max_workers=workers)
+    trims = ProcessPoolExecutor(max_workers=TRIM_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    in_flight = {}  # future -> (stage, timestamp, raw sizes by product)
+
+    def fail(timestamp_str, reason):
+        for product in claimed[timestamp_str]:
+            state.mark_failed(timestamp_str, product, reason)
+            failed.append((timestamp_str, product))
+
+    try:
+        main_to_fetch = []
+        for timestamp_str, products in claimed.items():
+            partners = {p: already_trimmed[p][timestamp_str] for p in PRODUCTS if timestamp_str in already_trimmed[p]}
+            missing = [p for p in PRODUCTS if p not in products and p not in partners]
+            if missing:
+                print(f"⚠️ {timestamp_str}: no {missing[0]} file on disk to extract with; cannot stream it.")
+                fail(timestamp_str, f"stream: no {missing[0]} file on disk")
+                continue
+            to_download = [p for p in PRODUCTS if p in products and p not in partners]
+            if not to_download:
+                in_flight[trims.submit(extract_pair, timestamp_str, partners, [])] = ("extract", timestamp_str, {})
+                continue
+            main_to_fetch += [timestamp_str] if "main" in to_download else []
+            future = downloads.submit(stream_download_job, pool, budget, timestamp_str, to_download, partners, gate_plan)
+            in_flight[future] = ("download", timestamp_str, {})
+        resolve_main_paths(pool, main_to_fetch)
+
+        last_renewal = time.monotonic()
+        while in_flight:
+            done, _ = wait(in_flight, timeout=LEASE_RENEW_SECONDS, return_when=FIRST_COMPLETED)
+            if time.monotonic() - last_renewal >= LEASE_RENEW_SECONDS:
+                state.renew_leases()
+                last_renewal = time.monotonic()
+
+            for future in done:
+                stage, timestamp_str, sizes = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if stage == "extract":
+                        budget.release(sum(sizes.values()))
+                    print(f"❗️ ERROR ({stage}) on {timestamp_str}: {e}")
+                    fail(timestamp_str, f"{stage}: {e}")
+                    drop_dead_partial(state, budget, e, timestamp_str, claimed[timestamp_str])
+                    continue
+
+                if stage == "download":
+                    paths, sizes = result
+                    if paths is None:
+                        print(f"☁️  {timestamp_str}: every station is cloudy. Skipping main file.")
+                        record_skip(timestamp_str, "main", "all_stations_cloudy", "streamed")
+                        state.mark_skipped(timestamp_str, "main", "all_stations_cloudy")
+                        skipped.append(timestamp_str)
+                        if "cloud" in claimed[timestamp_str]:
+                            state.mark_done(timestamp_str, "cloud", raw_bytes=sizes.get("cloud"), detail="streamed")
+                            finished.append((timestamp_str, "cloud"))
+                        continue
+                    downloaded = [paths[product] for product in sizes]
+                    in_flight[trims.submit(extract_pair, timestamp_str, paths, downloaded)] = ("extract", timestamp_str, sizes)
+                    continue
+
+                budget.release(sum(sizes.values()))
+                statuses[result] = statuses.get(result, 0) + 1
+                print(f"✅ {timestamp_str} extracted ({result})")
+                for product in claimed[timestamp_str]:
+                    state.mark_done(timestamp_str, product, raw_bytes=sizes.get(product), detail=f"streamed ({result})")
+                    finished.append((timestamp_str, product))
+    finally:
+        budget.close()  # Nothing frees room once this loop is gone
+        downloads.shutdown(wait=True, cancel_futures=True)
+        trims.shutdown(wait=True)
+        pool.close()
+
+    print(f"🌊 Streamed: {statuses.get('saved', 0)} timestamp(s) with rows, {statuses.get('empty', 0)} without cloud-free pixels.")
+    if gate_plan is not None:
+        print(f"☁️  Cloud gate: {len(skipped)} main file(s) skipped (logged in {os.path.basename(SKIP_LOG_FILE)}).")
+    return finished, failed
+
+
+# --- Main Orchestrator Logic ---
+def run_orchestrator(year, batch_size, workers=DOWNLOAD_WORKERS):
+    """
+    Claims the next `batch_size` timestamps of `year` that still have a
+    cloud or main file to fetch and downloads them in this process.
+
+    The state database is the record of what is done; download_progress.json
+    is brought in on every start and rewritten at the end with the matching
+    pointers, for the standalone downloaders and for sharing through Git.
+    Pointers written for another timestamp list are not brought in.
+    """
+    print("--- 🚀 Starting Download Orchestrator ---")
+
+    timestamps = JAXA_PTree.load_and_split_timestamps(TIMESTAMPS_FILE)[year]
+    identity = list_identity(TIMESTAMPS_FILE)
+    progress = JAXA_PTree.load_progress(PROGRESS_FILE)
+
+    with DownloadState() as state:
+        print("\n--- 🔍 Checking Download State ---")
+        state.add_timestamps(year, timestamps, PRODUCTS)
+        # Skips first, so gated main files listed there are not imported as done.
+        imported = state.import_skip_log(SKIP_LOG_FILE)
+        if pointers_match(progress, year, identity):
+            imported += state.import_pointers(progress, year, PRODUCTS)
+        else:
+            print(f"📋 The {year} pointers in {os.path.basename(PROGRESS_FILE)} count positions in another list than {identity[0]} "
+                  f"as it is now: not imported. They are rewritten for it at the end of this session.")
+        if imported:
+            print(f"🗃️  Imported {imported} finished download(s) from {os.path.basename(PROGRESS_FILE)} / {os.path.basename(SKIP_LOG_FILE)}")
+
+        claims = state.claim(year, batch_size)
+        try:
+            if claims:
+                print(f"\n--- 🔄 Downloading {len(claims)} file(s) with {workers} concurrent FTP session(s), {TRIM_WORKERS} trim worker(s) ---")
+                finished, failed = (run_stream_jobs if STREAM_EXTRACT else run_jobs)(claims, state, workers)
+            else:
+                finished, failed = [], []
+        finally:
+            state.release_all()  # Anything not finished goes back to pending
+            progress[year] = state.pointers(year, PRODUCTS)
+            set_pointer_list(progress, year, identity)
+            JAXA_PTree.save_progress(PROGRESS_FILE, progress)
+
+        counts = state.counts(year)
+
+    for product in PRODUCTS:
+        summary = ", ".join(f"{name} {n}" for name, n in sorted(counts.get(product, {}).items()))
+        print(f"📊 {product}: {summary}")
+    if not claims:
+        if any(counts.get(product, {}).get("failed") for product in PRODUCTS):
+            print(f"⚠️ Nothing left to claim for {year}, but some files failed {MAX_ATTEMPTS} times (python download_state.py {year} --retry-failed).")
+            return False
+        print(f"🎉 All files for {year} have already been downloaded (or are being downloaded by another session)!")
+        return True
+
+    print(f"\n📊 {len(finished)} file(s) finished, {len(failed)} failed this session.")
+    if failed:
+        print("\n--- ❌ Batch Download Session Finished With Errors (rerun to retry) ---")
+        return False
     print("\n--- ✅ Batch Download Session Finished Successfully! ---")
+    return True
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print(f"Usage: python {os.path.basename(__file__)} <year> <batch_size>")
+    if len(sys.argv) not in (3, 4):
+        print(f"Usage: python {os.path.basename(__file__)} <year> <batch_size> [workers]")
         print("Example: python run_downloader.py 2017 10")
         sys.exit(1)
-        
+
     try:
         target_year = sys.argv[1]
         target_batch_size = int(sys.argv[2])
+        target_workers = int(sys.argv[3]) if len(sys.argv) == 4 else DOWNLOAD_WORKERS
         if target_year not in ['2016', '2017', '2018', '2019']:
             raise ValueError("Year must be one of 2016, 2017, 2018, or 2019.")
+        if target_workers < 1:
+            raise ValueError("Workers must be at least 1.")
     except (ValueError, IndexError) as e:
         print(f"❌ Invalid arguments: {e}")
         sys.exit(1)
 
-    run_orchestrator(target_year, target_batch_size)
\ No newline at end of file
+    if not run_orchestrator(target_year, target_batch_size, target_workers):
+        sys.exit(1)
@@ -0,0 +1,66 @@
+import os
+import hashlib
+
+# === Timestamp List ===
+# The one setting for which list of timestamps the downloaders work through,
+# in order. JAXA_PTree.py, jaxa_cloud_data_1.py, run_downloader.py and
+# local_ftp_server.py all read it from here.
+#
+#   himawari_timestamps_to_download_filtered.txt   every 5th timestamp (subsample_list.py)
+#   himawari_download_queue.txt                    ranked queue (plan_downloads.py)
+#
+# HIMAWARI_TIMESTAMPS_FILE overrides it (a file in "List of Files needed" or a path).
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+LISTS_DIR = os.path.join(SCRIPT_DIR, "../List of Files needed")
+
+TIMESTAMPS_LIST = "himawari_timestamps_to_download_filtered.txt"
+TIMESTAMPS_FILE = os.path.join(LISTS_DIR, os.getenv("HIMAWARI_TIMESTAMPS_FILE", TIMESTAMPS_LIST))
+
+
+# --- Pointer Lists ---
+# The pointers of download_progress.json are positions in one list, so each
+# year records the list they count in next to them:
+#
+#   "2017": {"cloud": 120, "main": 118, "list": {"name": ..., "sha256": ...}}
+#
+# The file is shared through Git, so the record travels with the pointers.
+
+POINTER_PRODUCTS = ("cloud", "main")
+
+
+def list_identity(path=TIMESTAMPS_FILE):
+    """(file name, SHA-256 of the content) of a timestamp list."""
+    with open(path, "rb") as f:
+        return os.path.basename(path), hashlib.sha256(f.read()).hexdigest()
+
+
+def pointers_match(progress, year, identity):
+    """
+    True if the year's pointers count positions in the list `identity`.
+    Pointers saved without a list predate this record and belong to the
+    default filtered list.
+    """
+    stored = progress.get(year, {}).get("list")
+    if stored is None:
+        return identity[0] == TIMESTAMPS_LIST
+    return (stored.get("name"), stored.get("sha256")) == tuple(identity)
+
+
+def set_pointer_list(progress, year, identity):
+    """Records that the year's pointers now count positions in `identity`."""
+    progress.setdefault(year, {})["list"] = {"name": identity[0], "sha256": identity[1]}
+
+
+def adopt_list(progress, year, identity):
+    """
+    For the standalone downloaders: if the year's pointers count positions
+    in another list, starts them over at 0 in this one (files already
+    trimmed are skipped on the way). Returns True if they were reset.
+    """
+    reset = not pointers_match(progress, year, identity)
+    if reset:
+        for product in POINTER_PRODUCTS:
+            progress[year][product] = 0
+    set_pointer_list(progress, year, identity)
+    return reset
@@ -0,0 +1,95 @@
+import numpy as np
+import xarray as xr
+
+# === How Trimmed Files Are Written ===
+# Shared by both downloaders: which variables a trimmed file keeps, and the
+# NetCDF4 chunking and compression they are stored with.
+#
+# main_v3.py reads a few pixels around each station from every file, so small
+# square chunks mean only the chunks around the stations get decompressed,
+# instead of whole rows of the region box.
+
+CHUNK_SIZES = {"latitude": 64, "longitude": 64}  # Dimensions not listed are stored in one chunk
+COMPLEVEL = 4  # zlib level 1-9: higher is smaller but slower to write
+SHUFFLE = True  # Byte shuffle before zlib; compresses float fields noticeably better
+
+# --- int16 Packing ---
+# A packed variable is stored as int16 with a scale_factor / add_offset that
+# xarray decodes on read. The scale factor is the variable's maximum error, so
+# rounding is off by at most half of it and float32 decoding stays well inside.
+PACK_DTYPE = "int16"
+PACK_FILL_VALUE = -32768  # NaN on read; valid packed values are -32767..32767
+PACK_LIMIT = 32767
+
+
+def select_variables(ds, keep):
+    """Drops every data variable not in `keep` (None keeps them all). Coordinates always stay."""
+    if keep is None:
+        return ds
+    missing = [var for var in keep if var not in ds.data_vars]
+    if missing:
+        print(f"⚠️ Not in file, cannot keep: {', '.join(missing)}")
+    return ds[[var for var in keep if var in ds.data_vars]]
+
+
+def packing_for(da, max_error):
+    """
+    The int16 encoding of `da` for a maximum absolute error of `max_error`,
+    or None if its value range is too wide for int16 at that precision.
+    """
+    values = np.asarray(da.values, dtype="float64")
+    finite = values[np.isfinite(values)]
+    low, high = (float(finite.min()), float(finite.max())) if len(finite) else (0.0, 0.0)
+    offset = np.float32((low + high) / 2)
+    if max(high - offset, offset - low) / max_error > PACK_LIMIT:
+        return None
+    return {
+        "dtype": PACK_DTYPE,
+        "scale_factor": np.float32(max_error),
+        "add_offset": offset,
+        "_FillValue": np.int16(PACK_FILL_VALUE),
+    }
+
+
+def encoding_for(ds, chunk_sizes=CHUNK_SIZES, complevel=COMPLEVEL, shuffle=SHUFFLE, max_error=None):
+    """
+    The to_netcdf encoding for every data variable of `ds` (chunk_sizes=None
+    leaves chunking to netCDF4). Variables listed in `max_error` are packed to
+    int16 with that maximum error when their range allows it.
+    """
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        encoding[name] = {"zlib": True, "complevel": complevel, "shuffle": shuffle}
+        if max_error and name in max_error:
+            packing = packing_for(var, max_error[name])
+            if packing is None:
+                print(f"⚠️ {name} spans too wide a range for int16 at ±{max_error[name]:g}; stored unpacked")
+            else:
+                encoding[name].update(packing)
+        if chunk_sizes is not None and var.ndim > 0:
+            encoding[name]["chunksizes"] = tuple(
+                min(chunk_sizes.get(dim, size), size) for dim, size in zip(var.dims, var.shape)
+            )
+    return encoding
+
+
+def check_packing(path, source, max_error):
+    """
+    Reopens a written file and compares every packed variable with the
+    unpacked `source` dataset. Raises ValueError if any error exceeds its bound.
+    """
+    problems = []
+    with xr.open_dataset(path) as written:
+        for name in max_error:
+            if name not in written or written[name].encoding.get("dtype") != np.dtype(PACK_DTYPE):
+                continue
+            expected = np.asarray(source[name].values, dtype="float64")
+            actual = np.asarray(written[name].values, dtype="float64")
+            if not np.array_equal(np.isnan(expected), np.isnan(actual)):
+                problems.append(f"{name}: missing values differ")
+                continue
+            error = np.nanmax(np.abs(actual - expected), initial=0.0)
+            if error > max_error[name]:
+                problems.append(f"{name}: error {error:.3g} > {max_error[name]:g}")
+    if problems:
+        raise ValueError(f"Packed file {path} exceeds its error bounds ({'; '.join(problems)})")
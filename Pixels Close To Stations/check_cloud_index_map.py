@@ -0,0 +1,72 @@
+import os
+import sys
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from precompute_station_masks import nearest_cloud_indices
+
+# === Cloud Index Map Check ===
+# Checks that gathering CLTYPE through the cloud index map gives exactly the
+# same values as the nearest-neighbour interpolation used before. Runs on
+# synthetic grids laid out like the real full-disk ones (main grid 0.02°,
+# 06001x06001, cloud grid 0.05°, 02401x02401, both starting at 60°N 80°E,
+# stored as float32), so it needs no precomputed_masks bundle or data files:
+#
+#   python "Pixels Close To Stations/check_cloud_index_map.py"
+#
+# Exits with status 1 if any pixel differs.
+
+MAIN_STEP, CLOUD_STEP = 0.02, 0.05
+FULL_DISK_LAT0, FULL_DISK_LON0 = 60.0, 80.0
+
+
+def full_disk_axis(start, step, first, count):
+    """`count` coordinates of a full-disk axis from index `first`, as the files store them (float32)."""
+    return (start + step * np.arange(first, first + count)).astype("float32")
+
+
+def check_cloud_index_map(seed=0):
+    """Returns (pixels checked, pixels outside the cloud grid); raises AssertionError on a mismatch."""
+    rng = np.random.default_rng(seed)
+
+    # A region like the trimmed files (39.9°N, 80.24°E and 600x800 pixels from
+    # there), inside a cloud-grid window that covers it with a margin.
+    main_lat = full_disk_axis(FULL_DISK_LAT0, -MAIN_STEP, 1005, 600)
+    main_lon = full_disk_axis(FULL_DISK_LON0, MAIN_STEP, 12, 800)
+    cloud_lat = full_disk_axis(FULL_DISK_LAT0, -CLOUD_STEP, 390, 270)
+    cloud_lon = full_disk_axis(FULL_DISK_LON0, CLOUD_STEP, 0, 340)
+
+    cltype = xr.DataArray(
+        rng.integers(0, 10, (len(cloud_lat), len(cloud_lon))).astype("float32"),
+        coords={"latitude": cloud_lat, "longitude": cloud_lon},
+        dims=("latitude", "longitude"),
+    )
+
+    # Every pixel of the main grid, plus a few points outside the cloud grid.
+    lon_2d, lat_2d = np.meshgrid(main_lon, main_lat)
+    lats = np.concatenate([lat_2d.ravel(), np.array([48.0, 30.0], dtype="float32")])
+    lons = np.concatenate([lon_2d.ravel(), np.array([100.0, 79.0], dtype="float32")])
+
+    expected = cltype.interp(
+        latitude=xr.DataArray(lats, dims="points"),
+        longitude=xr.DataArray(lons, dims="points"),
+        method="nearest"
+    ).values
+
+    indices = nearest_cloud_indices(cloud_lat, cloud_lon, lats, lons)
+    inside = indices[:, 0] >= 0
+    gathered = np.full(len(lats), np.nan, dtype=expected.dtype)
+    gathered[inside] = cltype.values[indices[inside, 0], indices[inside, 1]]
+
+    assert np.array_equal(expected, gathered, equal_nan=True), "Cloud index map differs from CLTYPE interpolation"
+    return len(lats), int(np.sum(~inside))
+
+
+if __name__ == "__main__":
+    try:
+        checked, outside = check_cloud_index_map()
+    except AssertionError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    print(f"✅ Cloud index map matches CLTYPE interpolation on {checked} synthetic pixels ({outside} outside)")
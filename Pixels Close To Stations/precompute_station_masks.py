@@ -2,7 +2,7 @@ import xarray as xr
 import numpy as np
 import pandas as pd
 import os
-import pickle
+from station_masks import grid_signature, save_masks
 
 # === Haversine Distance Function ===
 def haversine_np(lat1, lon1, lat2, lon2):
@@ -14,6 +14,88 @@ def haversine_np(lat1, lon1, lat2, lon2):
     c = 2 * np.arcsin(np.sqrt(a))
     return R * c
 
+# === Candidate Window Functions ===
+def index_range(coord, lo, hi, pad=2):
+    """Index slice of a monotonic 1D coordinate covering [lo, hi], padded by `pad` cells."""
+    ascending = coord[-1] >= coord[0]
+    values = coord if ascending else coord[::-1]
+    start = np.searchsorted(values, lo, side="left")
+    stop = np.searchsorted(values, hi, side="right")
+    if not ascending:
+        start, stop = len(coord) - stop, len(coord) - start
+    return slice(max(start - pad, 0), min(stop + pad, len(coord)))
+
+
+def candidate_window(lat_vals, lon_vals, lat_c, lon_c, max_distance_km):
+    """
+    Returns (row_slice, col_slice) of the only grid cells that can lie within
+    max_distance_km of the station.
+
+    A point at distance d is at most d/R radians away in latitude, and at most
+    2*arcsin(sin(d/2R) / cos(lat)) radians away in longitude, where lat is the
+    most poleward latitude of the window. The exact haversine check then only
+    runs on this window instead of the whole grid.
+    """
+    R = 6371.0
+    dlat = np.degrees(max_distance_km / R)
+    rows = index_range(lat_vals, lat_c - dlat, lat_c + dlat)
+
+    cos_lat = np.cos(np.radians(min(abs(lat_c) + dlat, 90.0)))
+    s = np.sin(max_distance_km / (2 * R)) / cos_lat if cos_lat > 0 else np.inf
+    if s >= 1:
+        return rows, slice(0, len(lon_vals))  # Close to a pole: every longitude can be in range
+    dlon = np.degrees(2 * np.arcsin(s))
+    return rows, index_range(lon_vals, lon_c - dlon, lon_c + dlon)
+
+
+def station_mask(lat_vals, lon_vals, lat_c, lon_c, max_distance_km):
+    """
+    Finds the grid pixels within max_distance_km of a station.
+
+    Returns (lats, lons, mask_indices, distances) exactly as a full-grid
+    haversine mask would, or None when no pixel is close enough. `distances`
+    holds each pixel's distance to the station in km (float32).
+    """
+    rows, cols = candidate_window(lat_vals, lon_vals, lat_c, lon_c, max_distance_km)
+    lon_2d, lat_2d = np.meshgrid(lon_vals[cols], lat_vals[rows])
+
+    distances = haversine_np(lat_c, lon_c, lat_2d, lon_2d)
+    mask = distances <= max_distance_km
+    if not np.any(mask):
+        return None
+
+    mask_indices = np.argwhere(mask) + np.array([rows.start, cols.start])
+    return lat_2d[mask].flatten(), lon_2d[mask].flatten(), mask_indices, distances[mask].astype("float32")
+
+
+# === Nearest Cloud-Grid Index Function ===
+def nearest_cloud_indices(cloud_lat, cloud_lon, lats, lons):
+    """
+    Finds the nearest (row, col) on the cloud product grid for each pixel.
+
+    The lookup is done with the same xarray nearest-neighbour interpolation that
+    main_v3.py used on CLTYPE, applied to a grid holding each cell's flat index,
+    so gathering CLTYPE at these indices reproduces that interpolation exactly.
+    Pixels outside the cloud grid get (-1, -1).
+    """
+    shape = (len(cloud_lat), len(cloud_lon))
+    index_grid = xr.DataArray(
+        np.arange(shape[0] * shape[1], dtype="float64").reshape(shape),
+        coords={"latitude": cloud_lat, "longitude": cloud_lon},
+        dims=("latitude", "longitude"),
+    )
+    flat = index_grid.interp(
+        latitude=xr.DataArray(lats, dims="points"),
+        longitude=xr.DataArray(lons, dims="points"),
+        method="nearest"
+    ).values
+
+    outside = np.isnan(flat)
+    rows, cols = np.unravel_index(np.where(outside, 0, flat).astype("int64"), shape)
+    indices = np.stack([rows, cols], axis=1)
+    indices[outside] = -1
+    return indices
+
 # === Station Coordinates ===
 station_coords = {
     "Chiayi": (23.452, 120.255),
@@ -43,41 +125,59 @@ station_coords = {
 }
 
 # === Settings ===
-max_distance_km = 2.0
+# Search radii in km. Several radii give nested distance rings computed in one
+# pass (e.g. [2.0, 5.0, 10.0, 25.0]); the masks cover the largest one.
+radii_km = [2.0]
+max_distance_km = max(radii_km)
 himawari_nc_path = "../TOA reflectance and Cloud/Himawari Data/trimmed_NC_H08_20191202_0200_R21_FLDK.06001_06001.nc"
-output_mask_file = "precomputed_masks.pkl"
+cloud_nc_path = "../TOA reflectance and Cloud/Cloud Mask Data/trimmed_NC_H08_20191202_0200_L2CLP010_FLDK.02401_02401.nc"
+output_mask_dir = "precomputed_masks"
 
-# === Load Himawari Data ===
-ds = xr.open_dataset(himawari_nc_path)
-lat_vals = ds["latitude"].values
-lon_vals = ds["longitude"].values
-lon_2d, lat_2d = np.meshgrid(lon_vals, lat_vals)
 
-# === Precompute Masks ===
-precomputed = {
-    "_grid_shape": lat_2d.shape
-}
+def main():
+    # === Load Himawari Data ===
+    ds = xr.open_dataset(himawari_nc_path)
+    lat_vals = ds["latitude"].values
+    lon_vals = ds["longitude"].values
 
-for name, (lat_c, lon_c) in station_coords.items():
-    distances = haversine_np(lat_c, lon_c, lat_2d, lon_2d)
-    mask = distances <= max_distance_km
-    if not np.any(mask):
-        print(f"🚫 No nearby pixels found for {name}. Skipping.")
-        continue
+    # === Load Cloud Product Grid ===
+    ds_cloud = xr.open_dataset(cloud_nc_path)
+    cloud_lat = ds_cloud["latitude"].values
+    cloud_lon = ds_cloud["longitude"].values
+
+    # === Precompute Masks ===
+    precomputed = {}
+
+    for name, (lat_c, lon_c) in station_coords.items():
+        nearby = station_mask(lat_vals, lon_vals, lat_c, lon_c, max_distance_km)
+        if nearby is None:
+            print(f"🚫 No nearby pixels found for {name}. Skipping.")
+            continue
+
+        lats, lons, mask_indices, distances = nearby
+
+        precomputed[name] = {
+            "lat": lats,
+            "lon": lons,
+            "mask_indices": mask_indices,  # (row, col) on the main grid
+            "cloud_indices": nearest_cloud_indices(cloud_lat, cloud_lon, lats, lons),  # (row, col) on the CLTYPE grid
+            "distance_km": distances
+        }
 
-    lats = lat_2d[mask].flatten()
-    lons = lon_2d[mask].flatten()
+        rings = ", ".join(f"{np.sum(distances <= r)} within {r:g} km" for r in sorted(radii_km))
+        print(f"✅ {name}: {len(lats)} nearby pixels found ({rings})")
 
-    precomputed[name] = {
-        "lat": lats,
-        "lon": lons,
-        "mask_indices": np.argwhere(mask)  # Optional: can help in debugging or advanced use
-    }
+    # === Save to File ===
+    save_masks(
+        output_mask_dir,
+        precomputed,
+        grid=grid_signature(lat_vals, lon_vals),
+        radii_km=radii_km,
+        cloud_grid=grid_signature(cloud_lat, cloud_lon),
+    )
 
-    print(f"✅ {name}: {len(lats)} nearby pixels found")
+    print(f"\n💾 Precomputed masks saved to: {output_mask_dir}")
 
-# === Save to File ===
-with open(output_mask_file, "wb") as f:
-    pickle.dump(precomputed, f)
 
-print(f"\n💾 Precomputed masks saved to: {output_mask_file}")
+if __name__ == "__main__":
+    main()
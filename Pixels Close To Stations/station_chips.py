@@ -0,0 +1,147 @@
+import json
+import numpy as np
+import xarray as xr
+from station_masks import load_masks, station_slice, grid_mismatch
+
+# === Station Chip Layout ===
+# Instead of the whole region box, a chip file keeps one small window per
+# station, padded around that station's mask pixels, for every variable:
+#
+#   dims        station, y, x             (all windows share one size)
+#   row0, col0  int32 (station) coords    window origin on the region grid
+#   latitude    (station, y), longitude (station, x)
+#   attrs       layout = "station-chips", chip_grid = JSON grid signature
+#
+# Windows are cut from the same grid the masks were computed on, so a mask
+# pixel (row, col) is found at (row - row0, col - col0) of a chip covering it.
+
+CHIP_LAYOUT = "station-chips"
+CHIP_PADDING = 2  # Extra pixels kept around each station's mask on every side
+
+_masks_cache = {}
+
+
+def chip_windows(masks, kind="main", pad=CHIP_PADDING):
+    """
+    Computes one window per station on the main (`kind="main"`) or cloud
+    (`kind="cloud"`) grid of a mask bundle.
+
+    All windows get the size of the largest mask extent plus `pad` on each
+    side, clipped to the grid.
+    """
+    if kind == "main":
+        flat, grid = masks["flat_index"], masks["grid"]
+    elif masks["cloud_index"] is not None:
+        flat, grid = masks["cloud_index"], masks["cloud_grid"]
+    else:
+        raise ValueError("Chip mode needs masks with a cloud index map; rerun precompute_station_masks.py")
+
+    shape = tuple(grid["shape"])
+    names, boxes = [], []
+    for name in masks["stations"]:
+        indices = np.asarray(flat[station_slice(masks, name)])
+        indices = indices[indices >= 0]  # Pixels outside the cloud grid
+        if len(indices) == 0:
+            continue
+        rows, cols = np.unravel_index(indices, shape)
+        names.append(name)
+        boxes.append((rows.min(), rows.max(), cols.min(), cols.max()))
+
+    boxes = np.array(boxes, dtype="int64").reshape(-1, 4)
+    height = min(int((boxes[:, 1] - boxes[:, 0]).max(initial=0)) + 1 + 2 * pad, shape[0])
+    width = min(int((boxes[:, 3] - boxes[:, 2]).max(initial=0)) + 1 + 2 * pad, shape[1])
+    return {
+        "stations": names,
+        "row0": np.clip(boxes[:, 0] - pad, 0, shape[0] - height).astype("int32"),
+        "col0": np.clip(boxes[:, 2] - pad, 0, shape[1] - width).astype("int32"),
+        "height": height,
+        "width": width,
+        "grid": grid,
+    }
+
+
+def cut_chips(ds, windows):
+    """Cuts the station windows out of a region-grid dataset into the chip layout."""
+    rows = windows["row0"][:, None] + np.arange(windows["height"])
+    cols = windows["col0"][:, None] + np.arange(windows["width"])
+    chips = ds.isel(
+        latitude=xr.DataArray(rows, dims=("station", "y")),
+        longitude=xr.DataArray(cols, dims=("station", "x")),
+    )
+    # row0/col0 are coordinates so every variable read on its own still carries them.
+    chips = chips.assign_coords(
+        station=windows["stations"],
+        row0=("station", windows["row0"]),
+        col0=("station", windows["col0"]),
+    )
+    chips.attrs.update(layout=CHIP_LAYOUT, chip_grid=json.dumps(windows["grid"]))
+    return chips
+
+
+def cut_chips_for_masks(ds, masks_path, kind="main", pad=CHIP_PADDING):
+    """
+    Checks that `ds` is on the grid of the masks at `masks_path`, then cuts
+    its station chips. The masks are loaded once per process.
+    """
+    if masks_path not in _masks_cache:
+        _masks_cache[masks_path] = load_masks(masks_path)
+    masks = _masks_cache[masks_path]
+
+    windows = chip_windows(masks, kind, pad)
+    mismatch = grid_mismatch(windows["grid"], ds["latitude"].values, ds["longitude"].values)
+    if mismatch:
+        raise ValueError(f"Cannot cut station chips: {kind} grid does not match the masks ({mismatch})")
+    return cut_chips(ds, windows)
+
+
+# === Reading Chip Files ===
+def is_chip_file(ds):
+    return ds.attrs.get("layout") == CHIP_LAYOUT
+
+
+def is_chip_variable(da):
+    return "station" in da.dims and "row0" in da.coords
+
+
+def parent_grid_mismatch(ds, signature):
+    """Like grid_mismatch, for the region grid a chip file was cut from."""
+    stored = json.loads(ds.attrs["chip_grid"])
+    if "lat0" not in stored:
+        return None if list(stored["shape"]) == list(signature["shape"]) else f"shape {tuple(stored['shape'])} != {tuple(signature['shape'])}"
+    n_lat, n_lon = stored["shape"]
+    lat_vals = stored["lat0"] + stored["dlat"] * np.arange(n_lat)
+    lon_vals = stored["lon0"] + stored["dlon"] * np.arange(n_lon)
+    return grid_mismatch(signature, lat_vals, lon_vals)
+
+
+def locate(ds, rows, cols):
+    """
+    Maps region-grid pixels to (chip, y, x) positions in a chip file (or one
+    of its variables).
+
+    Raises ValueError when a pixel is in no chip, i.e. the file was cut with
+    other masks than the ones being used to read it.
+    """
+    row0, col0 = ds["row0"].values.astype("int64"), ds["col0"].values.astype("int64")
+    rows, cols = np.asarray(rows, dtype="int64"), np.asarray(cols, dtype="int64")
+    inside = (
+        (rows[:, None] >= row0) & (rows[:, None] < row0 + ds.sizes["y"])
+        & (cols[:, None] >= col0) & (cols[:, None] < col0 + ds.sizes["x"])
+    )
+    covered = inside.any(axis=1)
+    if not covered.all():
+        raise ValueError(
+            f"{np.sum(~covered)} pixel(s) are outside the station chips of this file; "
+            f"it was cut with different masks"
+        )
+    chip = inside.argmax(axis=1)
+    return chip, rows - row0[chip], cols - col0[chip]
+
+
+def read_chip_points(da, chip, y, x):
+    """Reads the values at (chip, y, x) positions of a chip-layout variable."""
+    return da.isel(
+        station=xr.DataArray(chip, dims="points"),
+        y=xr.DataArray(y, dims="points"),
+        x=xr.DataArray(x, dims="points"),
+    ).values
@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import pickle
+import numpy as np
+
+# === Station Mask Bundle ===
+# A folder of plain .npy arrays plus a small meta.json:
+#
+#   meta.json            format version, station names, grid signatures, radius
+#   offsets.npy          int64, station i owns entries offsets[i]:offsets[i+1]
+#   flat_index.npy       int32, flat (row * n_cols + col) index on the main grid
+#   lat.npy, lon.npy     float32, pixel coordinates
+#   cloud_index.npy      int32, flat index on the cloud grid (-1 outside), optional
+#   distance_km.npy      float32, distance from pixel to station, optional
+#
+# All stations share the same contiguous arrays, and loading memory-maps them
+# instead of unpickling Python objects.
+
+MASK_FORMAT = "station-masks"
+MASK_FORMAT_VERSION = 1
+
+# Tolerances (degrees) when comparing a grid against a stored signature.
+ORIGIN_TOLERANCE = 1e-4
+EXTENT_TOLERANCE = 1e-3
+
+
+def grid_signature(lat_vals, lon_vals):
+    """Describes a regular lat/lon grid by its origin, spacing and shape."""
+    lat_vals = np.asarray(lat_vals, dtype="float64")
+    lon_vals = np.asarray(lon_vals, dtype="float64")
+    return {
+        "shape": [len(lat_vals), len(lon_vals)],
+        "lat0": float(lat_vals[0]),
+        "lon0": float(lon_vals[0]),
+        "dlat": float((lat_vals[-1] - lat_vals[0]) / max(len(lat_vals) - 1, 1)),
+        "dlon": float((lon_vals[-1] - lon_vals[0]) / max(len(lon_vals) - 1, 1)),
+    }
+
+
+def grid_mismatch(signature, lat_vals, lon_vals):
+    """Returns a description of how a grid differs from `signature`, or None if it matches."""
+    actual = grid_signature(lat_vals, lon_vals)
+    if actual["shape"] != list(signature["shape"]):
+        return f"shape {tuple(actual['shape'])} != {tuple(signature['shape'])}"
+
+    for axis, n in (("lat", actual["shape"][0]), ("lon", actual["shape"][1])):
+        origin, spacing = f"{axis}0", f"d{axis}"
+        if origin not in signature:
+            continue  # Signatures converted from the old pickle only know the cloud grid's shape
+        if abs(actual[origin] - signature[origin]) > ORIGIN_TOLERANCE:
+            return f"{origin} {actual[origin]:.5f} != {signature[origin]:.5f}"
+        end, expected_end = actual[origin] + actual[spacing] * (n - 1), signature[origin] + signature[spacing] * (n - 1)
+        if abs(end - expected_end) > EXTENT_TOLERANCE:
+            return f"{axis} spacing {actual[spacing]:.6f} != {signature[spacing]:.6f}"
+    return None
+
+
+def save_masks(path, stations, grid, radii_km, cloud_grid=None):
+    """
+    Writes a mask bundle.
+
+    `stations` maps each name to a dict with "lat", "lon", "mask_indices" and
+    optionally "cloud_indices" ((N, 2) rows/cols) and "distance_km".
+    `grid` and `cloud_grid` are grid signatures; `radii_km` lists the nested
+    ring radii, the largest being the radius the masks were computed for.
+    """
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(os.path.join(path, "meta.json")):
+        os.remove(os.path.join(path, "meta.json"))
+    names = list(stations)
+    counts = [len(stations[name]["lat"]) for name in names]
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype("int64")
+
+    def flat(indices, shape):
+        indices = np.asarray(indices).reshape(-1, 2)
+        inside = indices[:, 0] >= 0
+        out = np.full(len(indices), -1, dtype="int64")
+        out[inside] = np.ravel_multi_index((indices[inside, 0], indices[inside, 1]), shape)
+        return out.astype("int32")
+
+    def stacked(key, convert):
+        return np.concatenate([convert(stations[n][key]) for n in names]) if names else np.empty(0)
+
+    arrays = {
+        "offsets": offsets,
+        "flat_index": stacked("mask_indices", lambda v: flat(v, grid["shape"])).astype("int32"),
+        "lat": stacked("lat", np.asarray).astype("float32"),
+        "lon": stacked("lon", np.asarray).astype("float32"),
+    }
+    has_cloud = cloud_grid is not None and all(stations[n].get("cloud_indices") is not None for n in names)
+    if has_cloud:
+        arrays["cloud_index"] = stacked("cloud_indices", lambda v: flat(v, cloud_grid["shape"])).astype("int32")
+    has_distance = all(stations[n].get("distance_km") is not None for n in names)
+    if has_distance:
+        arrays["distance_km"] = stacked("distance_km", np.asarray).astype("float32")
+
+    for key in ("cloud_index", "distance_km"):
+        if key not in arrays and os.path.exists(os.path.join(path, f"{key}.npy")):
+            os.remove(os.path.join(path, f"{key}.npy"))
+
+    for key, values in arrays.items():
+        np.save(os.path.join(path, f"{key}.npy"), values)
+
+    meta = {
+        "format": MASK_FORMAT,
+        "version": MASK_FORMAT_VERSION,
+        "stations": names,
+        "radius_km": max(radii_km),
+        "radii_km": sorted(radii_km),
+        "grid": grid,
+        "cloud_grid": cloud_grid if has_cloud else None,
+        "has_distance": has_distance,
+    }
+    # meta.json is written last, so a bundle is only readable once complete.
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=4)
+
+
+def load_masks(path):
+    """Memory-maps a mask bundle. Returns a dict with the meta fields and the arrays."""
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        raise FileNotFoundError(f"No station mask bundle at {path} (run precompute_station_masks.py)")
+    with open(meta_path) as f:
+        masks = json.load(f)
+    if masks.get("format") != MASK_FORMAT or masks.get("version") != MASK_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported mask bundle {path}: {masks.get('format')} v{masks.get('version')} "
+            f"(expected {MASK_FORMAT} v{MASK_FORMAT_VERSION}); rerun precompute_station_masks.py"
+        )
+
+    for key in ("offsets", "flat_index", "lat", "lon"):
+        masks[key] = np.load(os.path.join(path, f"{key}.npy"), mmap_mode="r")
+    cloud_path = os.path.join(path, "cloud_index.npy")
+    masks["cloud_index"] = np.load(cloud_path, mmap_mode="r") if masks["cloud_grid"] else None
+    distance_path = os.path.join(path, "distance_km.npy")
+    masks["distance_km"] = np.load(distance_path, mmap_mode="r") if masks.get("has_distance") else None
+    masks.setdefault("radii_km", [masks["radius_km"]])
+    masks["station_index"] = {name: i for i, name in enumerate(masks["stations"])}
+    return masks
+
+
+def station_slice(masks, name):
+    """The slice of the shared arrays that belongs to one station."""
+    i = masks["station_index"][name]
+    return slice(int(masks["offsets"][i]), int(masks["offsets"][i + 1]))
+
+
+# === Migration From precomputed_masks.pkl ===
+def infer_axis(indices, values):
+    """Fits value = origin + index * spacing from the stored pixels of every station."""
+    spacing, origin = np.polyfit(indices.astype("float64"), values.astype("float64"), 1)
+    return float(origin), float(spacing)
+
+
+def convert_legacy_pickle(pkl_path, path, radius_km):
+    """
+    Converts the old pickled dict of per-station arrays into a mask bundle.
+
+    The pickle only stored the grid shape, so the grid origin and spacing are
+    fitted from the stations' (row, col) indices and coordinates.
+    """
+    with open(pkl_path, "rb") as f:
+        legacy = pickle.load(f)
+
+    names = [name for name in legacy if not name.startswith("_")]
+    rows = np.concatenate([np.asarray(legacy[n]["mask_indices"])[:, 0] for n in names])
+    cols = np.concatenate([np.asarray(legacy[n]["mask_indices"])[:, 1] for n in names])
+    lat0, dlat = infer_axis(rows, np.concatenate([legacy[n]["lat"] for n in names]))
+    lon0, dlon = infer_axis(cols, np.concatenate([legacy[n]["lon"] for n in names]))
+    grid = {"shape": list(legacy["_grid_shape"]), "lat0": lat0, "lon0": lon0, "dlat": dlat, "dlon": dlon}
+
+    cloud_grid = None
+    if "_cloud_grid_shape" in legacy:
+        # The cloud grid's coordinates were never stored; keep its shape only.
+        cloud_grid = {"shape": list(legacy["_cloud_grid_shape"])}
+
+    stations = {n: legacy[n] for n in names}
+    save_masks(path, stations, grid, [radius_km], cloud_grid=cloud_grid)
+    print(f"💾 Converted {len(names)} stations from {pkl_path} to {path}")
+
+
+# Usage: python station_masks.py <precomputed_masks.pkl> <output_folder> <radius_km>
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print(f"Usage: python {os.path.basename(__file__)} <precomputed_masks.pkl> <output_folder> <radius_km>")
+        sys.exit(1)
+    convert_legacy_pickle(sys.argv[1], sys.argv[2], float(sys.argv[3]))
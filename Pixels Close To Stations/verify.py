@@ -1,12 +1,26 @@
-import pickle
+import numpy as np
+from check_cloud_index_map import check_cloud_index_map
+from station_masks import load_masks, station_slice
 
-with open("precomputed_masks.pkl", "rb") as f:
-    data = pickle.load(f)
+data = load_masks("precomputed_masks")
 
-print("Available stations:", list(data.keys()))  # Exclude _grid_shape
-print("Grid shape used:", data["_grid_shape"])
+print(f"Mask format: {data['format']} v{data['version']}, radii {data['radii_km']} km")
+print("Available stations:", data["stations"])
+print("Grid used:", data["grid"])
 
 # Check one station
-kanpur = data["Kanpur"]
-print(f"Kanpur: {len(kanpur['lat'])} lat/lon pairs")
-print("Sample lat/lon:", list(zip(kanpur["lat"], kanpur["lon"]))[:5])
+kanpur = station_slice(data, "Kanpur")
+print(f"Kanpur: {kanpur.stop - kanpur.start} lat/lon pairs")
+print("Sample lat/lon:", list(zip(data["lat"][kanpur], data["lon"][kanpur]))[:5])
+if data["cloud_index"] is not None:
+    print("Cloud grid used:", data["cloud_grid"])
+    print("Sample cloud flat indices:", data["cloud_index"][kanpur][:5].tolist())
+else:
+    print("No cloud index map in this bundle (rerun precompute_station_masks.py to add it).")
+if data["distance_km"] is not None:
+    print("Sample distances (km):", np.round(data["distance_km"][kanpur][:5], 3).tolist())
+
+
+# Cloud index map against CLTYPE interpolation (standalone: check_cloud_index_map.py)
+checked, outside = check_cloud_index_map()
+print(f"Cloud index map matches CLTYPE interpolation on {checked} synthetic pixels ({outside} outside)")
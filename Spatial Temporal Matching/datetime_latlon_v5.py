@@ -1,9 +1,16 @@
 import os
+import sys
 import pandas as pd
 import numpy as np
 from glob import glob
 import warnings
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TOA reflectance and Cloud"))
+import pixel_store
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Aeronet Merging AOD FMF"))
+import ground_store
+
 # Ignore the specific warning from the previous step if it appears
 warnings.filterwarnings("ignore", message="invalid value encountered in cast")
 
@@ -24,96 +31,269 @@ def haversine_np(lat1, lon1, lat2, lon2):
 
 # === 1. SETUP: Define Paths and Parameters ===
 satellite_data_folder = "toa_filtered_near_stations"
+satellite_data_format = "csv"  # "csv" or "parquet" (the columnar store written by main_v3.py)
+satellite_store_folder = "toa_filtered_store"
 ground_data_folder = "Aeronet Merging AOD FMF/Merged Ground Truth"
+ground_data_format = "csv"  # "csv" or "store" (the binary ground-truth store written by aeronet_v3.py)
+ground_store_folder = "Aeronet Merging AOD FMF/Merged Ground Truth/ground_truth_store"
 output_file = "Final_Matched_Data.csv"
 TIME_DELTA_MINUTES = 30
 TIME_WINDOW = pd.Timedelta(minutes=TIME_DELTA_MINUTES)
+SATELLITE_CHUNK_FILES = 500  # CSV files loaded and aggregated together in one pass
+# Extra per-(Datetime, Station) satellite aggregates computed in the same pass,
+# e.g. ["std", "median"] adds rho_01_std, rho_01_median, ... columns.
+EXTRA_SATELLITE_STATS = []
+ADD_PIXEL_COUNT = False  # Adds a num_pixels column (cloud-free pixels averaged per match)
+# Collocation radii (km) for sensitivity studies, e.g. [2, 5, 10, 25]. Needs
+# satellite data extracted with multi-radius masks (distance_km column); each
+# radius is matched in the same pass and saved as Final_Matched_Data_<r>km.csv.
+# Empty = average all extracted pixels into output_file, as before.
+MATCH_RADII_KM = []
+# Ground window means are computed for all rows of a station at once. True
+# averages each window in a Python loop instead, summing in the ground file's
+# row order so the means match filtering the DataFrame bit for bit (slower).
+EXACT_GROUND_MEANS = False
 
 # === 2. LOAD THE SINGLE GROUND DATA FILE ===
-print("🔄 Loading the combined AERONET ground station data file...")
+if ground_data_format == "store":
+    # Memory-mapped columns, already sorted by station and time: nothing to parse.
+    print("🔄 Opening the binary AERONET ground-truth store...")
+    ground_data = ground_store.open_store(ground_store_folder)
+    print(f"✅ Loaded data for {len(ground_data['stations'])} stations from the ground-truth store.")
+else:
+    print("🔄 Loading the combined AERONET ground station data file...")
 
-# 👉 Please update this to the exact name of your single CSV file
-ground_data_filename = "AERONET_groundtruth_ALL.csv" # <--- EXAMPLE FILENAME
-ground_data_file_path = os.path.join(ground_data_folder, ground_data_filename)
+    # 👉 Please update this to the exact name of your single CSV file
+    ground_data_filename = "AERONET_groundtruth_ALL.csv" # <--- EXAMPLE FILENAME
+    ground_data_file_path = os.path.join(ground_data_folder, ground_data_filename)
 
-if not os.path.exists(ground_data_file_path):
-    raise FileNotFoundError(
-        f"Error: The ground data file was not found at {ground_data_file_path}\n"
-        f"Please make sure the `ground_data_filename` is correct."
-    )
+    if not os.path.exists(ground_data_file_path):
+        raise FileNotFoundError(
+            f"Error: The ground data file was not found at {ground_data_file_path}\n"
+            f"Please make sure the `ground_data_filename` is correct."
+        )
 
-master_ground_df = pd.read_csv(ground_data_file_path)
+    master_ground_df = pd.read_csv(ground_data_file_path)
 
-# *** MODIFICATION START ***
-# Rename lowercase 'datetime' and 'station' columns to the expected names
-master_ground_df.rename(columns={'datetime': 'Datetime', 'station': 'Station'}, inplace=True)
+    # *** MODIFICATION START ***
+    # Rename lowercase 'datetime' and 'station' columns to the expected names
+    master_ground_df.rename(columns={'datetime': 'Datetime', 'station': 'Station'}, inplace=True)
 
-# Convert the existing 'Datetime' column to a proper datetime object
-master_ground_df['Datetime'] = pd.to_datetime(master_ground_df['Datetime'], errors='coerce')
+    # Convert the existing 'Datetime' column to a proper datetime object
+    master_ground_df['Datetime'] = pd.to_datetime(master_ground_df['Datetime'], errors='coerce')
 
-# Drop rows with invalid dates and the now-redundant original columns
-master_ground_df.dropna(subset=['Datetime'], inplace=True)
-# Use errors='ignore' in case the 'Date'/'Time' columns don't exist
-master_ground_df.drop(columns=['Date', 'Time'], inplace=True, errors='ignore')
-# *** MODIFICATION END ***
+    # Drop rows with invalid dates and the now-redundant original columns
+    master_ground_df.dropna(subset=['Datetime'], inplace=True)
+    # Use errors='ignore' in case the 'Date'/'Time' columns don't exist
+    master_ground_df.drop(columns=['Date', 'Time'], inplace=True, errors='ignore')
+    # *** MODIFICATION END ***
 
-print(f"✅ Loaded data for {master_ground_df['Station'].nunique()} stations from the master file.")
+    print(f"✅ Loaded data for {master_ground_df['Station'].nunique()} stations from the master file.")
 
 
-# === 3. PROCESS SATELLITE FILES AND FIND MATCHES ===
-satellite_files = sorted(glob(os.path.join(satellite_data_folder, "*.csv")))
-final_matches = []
+# === 2b. INDEX THE GROUND DATA BY STATION AND TIME ===
+GROUND_COLUMNS = ['AOD', 'AE', 'FMF']
 
-print(f"\n🛰️  Processing {len(satellite_files)} satellite files to find matches...")
 
-for sat_file in satellite_files:
-    sat_df = pd.read_csv(sat_file)
-    if sat_df.empty:
-        continue
+def build_ground_index(ground_df):
+    """
+    Splits the ground data by station and sorts each station by Datetime.
+
+    For every station we keep the sorted times, the permutation that sorted
+    them and the AOD/AE/FMF values in their original row order and in time
+    order, so a time window is found with a binary search instead of a scan
+    of all rows.
+    """
+    index = {}
+    for station, group in ground_df.groupby('Station', sort=False):
+        times = group['Datetime'].to_numpy()
+        order = np.argsort(times, kind='stable')
+        values = {col: group[col].to_numpy(dtype='float64') for col in GROUND_COLUMNS}
+        index[station] = {
+            'times': times[order],
+            'order': order,
+            'values': values,
+            'sorted_values': {col: column[order] for col, column in values.items()},
+        }
+    return index
+
+
+def build_ground_index_from_store(store):
+    """
+    The index of build_ground_index, built from the ground-truth store.
+
+    The store's rows are already sorted by station and time, so times and
+    values are views of the memory-mapped files and no permutation is needed.
+    """
+    index = {}
+    for station in store['stations']:
+        rows = ground_store.read_station(store, station, columns=GROUND_COLUMNS)
+        index[station] = {
+            'times': rows['times'],
+            'order': None,
+            'values': {col: rows[col] for col in GROUND_COLUMNS},
+            'sorted_values': {col: rows[col] for col in GROUND_COLUMNS},
+        }
+    return index
+
+
+def nanmean(values):
+    """Mean ignoring NaN, summed the same way as pandas' DataFrame.mean()."""
+    values = np.asarray(values, dtype='float64')  # The store keeps float32
+    count = np.count_nonzero(~np.isnan(values))
+    return np.nansum(values) / count if count else np.nan
+
+
+def window_means(values, lo, hi):
+    """
+    Mean ignoring NaN of values[lo[i]:hi[i]] for every window, NaN for empty
+    ones. The sums and counts of all windows come from one np.add.reduceat
+    each, over the bounds interleaved as lo0, hi0, lo1, hi1, ...
+    """
+    values = np.asarray(values, dtype='float64')  # The store keeps float32
+    valid = ~np.isnan(values)
+    # reduceat bounds must be valid indices, so a trailing zero stands in for hi == len(values)
+    filled = np.append(np.where(valid, values, 0.0), 0.0)
+    valid = np.append(valid, False).astype('int64')
+    bounds = np.column_stack([lo, hi]).ravel()
+    sums = np.add.reduceat(filled, bounds)[::2]
+    counts = np.add.reduceat(valid, bounds)[::2]
+    # reduceat gives the element at lo for an empty window, hence the explicit mask
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where((hi > lo) & (counts > 0), sums / counts, np.nan)
+
+
+def attach_ground_windows(sat_means, ground_index):
+    """
+    Adds the ground window aggregates to every (Datetime_sat, Station) row.
+
+    The window bounds of all rows of a station are found with one vectorized
+    searchsorted and the window means with window_means (or one nanmean per
+    row with EXACT_GROUND_MEANS); rows without any ground measurement get
+    num_ground_matches 0.
+    """
+    sat_times = sat_means['Datetime_sat'].to_numpy()
+    num_matches = np.zeros(len(sat_means), dtype='int64')
+    ground_means = {col: np.full(len(sat_means), np.nan) for col in GROUND_COLUMNS}
+
+    for station_name, rows in sat_means.groupby('Station', sort=False).indices.items():
+        entry = ground_index.get(station_name)
+        if entry is None:
+            continue
+
+        lo = np.searchsorted(entry['times'], sat_times[rows] - TIME_WINDOW.to_timedelta64(), side='left')
+        hi = np.searchsorted(entry['times'], sat_times[rows] + TIME_WINDOW.to_timedelta64(), side='right')
+        num_matches[rows] = hi - lo
+
+        if not EXACT_GROUND_MEANS:
+            for col, values in entry['sorted_values'].items():
+                ground_means[col][rows] = window_means(values, lo, hi)
+            continue
+
+        for row, start, stop in zip(rows, lo, hi):
+            if start == stop:
+                continue
+            # Average the window's rows in their original order so the sums
+            # are identical to filtering the full DataFrame.
+            window_rows = slice(start, stop) if entry['order'] is None else np.sort(entry['order'][start:stop])
+            for col, values in entry['values'].items():
+                ground_means[col][row] = nanmean(values[window_rows])
+
+    return sat_means.assign(
+        AOD_ground_mean=ground_means['AOD'],
+        AE_ground_mean=ground_means['AE'],
+        FMF_ground_mean=ground_means['FMF'],
+        num_ground_matches=num_matches,
+    )
+
+
+if ground_data_format == "store":
+    ground_index = build_ground_index_from_store(ground_data)
+else:
+    ground_index = build_ground_index(master_ground_df)
+
 
+# === 3. AGGREGATE SATELLITE PIXELS AND FIND MATCHES ===
+def read_satellite_csvs(sat_files):
+    """Loads a chunk of satellite CSVs into one DataFrame with a Datetime column."""
+    frames = [pd.read_csv(sat_file) for sat_file in sat_files]
+    frames = [df for df in frames if not df.empty]
+    if not frames:
+        return pd.DataFrame()
+
+    sat_df = pd.concat(frames, ignore_index=True)
     # Create the satellite datetime column
     sat_df['Datetime'] = pd.to_datetime(
         sat_df['Date'] + ' ' + sat_df['Time'],
         format="%d:%m:%Y %H:%M:%S"
     )
+    return sat_df.drop(columns=['Date', 'Time'])
 
-    for station_name, station_pixels_df in sat_df.groupby('Station'):
-        # Average the satellite data
-        closest_pixel_data = station_pixels_df.mean(numeric_only=True).to_dict()
-        closest_pixel_data['Station'] = station_name
-        sat_time = station_pixels_df['Datetime'].iloc[0]
-        closest_pixel_data['Datetime_sat'] = sat_time
-
-        # Define time window
-        start_time = sat_time - TIME_WINDOW
-        end_time = sat_time + TIME_WINDOW
-
-        # Select ground data for the current station within the time window
-        temporal_matches = master_ground_df[
-            (master_ground_df['Station'] == station_name) &
-            (master_ground_df['Datetime'] >= start_time) &
-            (master_ground_df['Datetime'] <= end_time)
-        ]
-
-        if temporal_matches.empty:
-            continue
 
-        # Aggregate ground data
-        aggregated_ground_data = temporal_matches[['AOD', 'AE', 'FMF']].mean().to_dict()
-        aggregated_ground_data = {
-            'AOD_ground_mean': aggregated_ground_data['AOD'],
-            'AE_ground_mean': aggregated_ground_data['AE'],
-            'FMF_ground_mean': aggregated_ground_data['FMF'],
-            'num_ground_matches': len(temporal_matches)
-        }
+def aggregate_satellite(sat_df):
+    """
+    Averages the pixels of every (Datetime, Station) in a single groupby.
+
+    EXTRA_SATELLITE_STATS and ADD_PIXEL_COUNT are computed in the same pass.
+    """
+    value_cols = [col for col in sat_df.select_dtypes('number').columns if col not in pixel_store.RING_COLUMNS]
+    grouped = sat_df.groupby(['Datetime', 'Station'], sort=False)[value_cols]
+
+    parts = [grouped.mean()]
+    for stat in EXTRA_SATELLITE_STATS:
+        parts.append(grouped.agg(stat).add_suffix(f'_{stat}'))
+    if ADD_PIXEL_COUNT:
+        parts.append(grouped.size().rename('num_pixels'))
+
+    sat_means = pd.concat(parts, axis=1).reset_index()
+    return sat_means.rename(columns={'Datetime': 'Datetime_sat'})
+
+
+if satellite_data_format == "parquet":
+    # One columnar scan of the whole store instead of one CSV parse per timestamp.
+    sat_df = pixel_store.read_store(satellite_store_folder)
+    sat_df = sat_df.astype({col: "float64" for col in pixel_store.FLOAT_COLUMNS + pixel_store.RING_COLUMNS if col in sat_df.columns})
+    print(f"\n🛰️  Processing {len(sat_df)} satellite pixels from {satellite_store_folder} to find matches...")
+    satellite_chunks = [sat_df]
+else:
+    satellite_files = sorted(glob(os.path.join(satellite_data_folder, "*.csv")))
+    print(f"\n🛰️  Processing {len(satellite_files)} satellite files to find matches...")
+    satellite_chunks = (
+        read_satellite_csvs(satellite_files[i:i + SATELLITE_CHUNK_FILES])
+        for i in range(0, len(satellite_files), SATELLITE_CHUNK_FILES)
+    )
+
+# Output file per radius (None = all extracted pixels)
+if MATCH_RADII_KM:
+    output_files = {r: f"{os.path.splitext(output_file)[0]}_{r:g}km.csv" for r in sorted(MATCH_RADII_KM)}
+else:
+    output_files = {None: output_file}
+final_matches = {radius: [] for radius in output_files}
+
+for sat_df in satellite_chunks:
+    if sat_df.empty:
+        continue
+    if MATCH_RADII_KM and 'distance_km' not in sat_df.columns:
+        raise ValueError(
+            "MATCH_RADII_KM needs a distance_km column; rerun precompute_station_masks.py "
+            "with several radii_km and re-extract the satellite data"
+        )
+
+    for radius in final_matches:
+        pixels = sat_df if radius is None else sat_df[sat_df['distance_km'] <= radius]
+        if pixels.empty:
+            continue
+        matched = attach_ground_windows(aggregate_satellite(pixels), ground_index)
+        final_matches[radius].append(matched[matched['num_ground_matches'] > 0])
 
-        # Combine satellite and ground data
-        final_row = {**closest_pixel_data, **aggregated_ground_data}
-        final_matches.append(final_row)
 
 # === 4. SAVE FINAL DATASET ===
-if final_matches:
-    final_df = pd.DataFrame(final_matches)
+def save_matches(matches, path):
+    final_df = pd.concat(matches, ignore_index=True) if matches else pd.DataFrame()
+
+    if final_df.empty:
+        print(f"\n❌ No matches found between satellite and ground data for {path}.")
+        return
 
     # Define and reorder columns for a clean output
     cols_to_keep = [
@@ -124,11 +304,17 @@ if final_matches:
         'latitude', 'longitude',
         'AOD_ground_mean', 'AE_ground_mean', 'FMF_ground_mean', 'num_ground_matches'
     ]
+    # Optional extra satellite aggregates go after the standard columns
+    cols_to_keep += [col for col in final_df.columns if col not in cols_to_keep and (
+        col == 'num_pixels' or any(col.endswith(f'_{stat}') for stat in EXTRA_SATELLITE_STATS)
+    )]
     final_cols = [col for col in cols_to_keep if col in final_df.columns]
     final_df = final_df[final_cols]
     
     final_df.sort_values(by=['Datetime_sat', 'Station'], inplace=True)
-    final_df.to_csv(output_file, index=False)
-    print(f"\n✅ Success! Saved {len(final_df)} matched records to {output_file}")
-else:
-    print("\n❌ No matches found between satellite and ground data.")
\ No newline at end of file
+    final_df.to_csv(path, index=False)
+    print(f"\n✅ Success! Saved {len(final_df)} matched records to {path}")
+
+
+for radius, path in output_files.items():
+    save_matches(final_matches[radius], path)
\ No newline at end of file
@@ -0,0 +1,76 @@
+import os
+import re
+
+# === Timestamp Index of Himawari / Cloud Mask Folders ===
+# One directory scan per folder maps "YYYYMMDD_HHMM" to the file on disk, so
+# pairing main and cloud files (or checking what is already downloaded) costs
+# one pass over the folder instead of one glob per file.
+
+TIMESTAMP_PATTERN = re.compile(r'(\d{8})_(\d{4})')
+
+# Prefixes of files that are still being written by the downloaders.
+PARTIAL_PREFIXES = ("temp_",)
+
+
+def scan_timestamps(folder, suffix=".nc", prefix=""):
+    """
+    Returns {timestamp: path} for every finished file in `folder`.
+
+    Only names starting with `prefix` and ending with `suffix` are indexed.
+    When several files share a timestamp (e.g. an original and its trimmed
+    copy), the `trimmed_` file wins. A missing folder gives an empty index.
+    """
+    index = {}
+    if not os.path.isdir(folder):
+        return index
+
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            name = entry.name
+            if not (name.startswith(prefix) and name.endswith(suffix)) or name.startswith(PARTIAL_PREFIXES):
+                continue
+            if not entry.is_file():
+                continue
+            match = TIMESTAMP_PATTERN.search(name)
+            if not match:
+                continue
+            timestamp = f"{match.group(1)}_{match.group(2)}"
+
+            current = index.get(timestamp)
+            if current is None or _preferred(name, os.path.basename(current)):
+                index[timestamp] = entry.path
+    return index
+
+
+def _preferred(name, current_name):
+    is_trimmed, current_trimmed = name.startswith("trimmed_"), current_name.startswith("trimmed_")
+    if is_trimmed != current_trimmed:
+        return is_trimmed
+    return name < current_name
+
+
+def build_pair_index(main_folder, cloud_folder):
+    """
+    Pairs main and cloud files by timestamp with one scan of each folder.
+
+    Returns (pairs, main_only, cloud_only) where `pairs` maps each timestamp
+    to (main_path, cloud_path) in time order and the other two list the
+    timestamps present in only one folder.
+    """
+    main_files = scan_timestamps(main_folder)
+    cloud_files = scan_timestamps(cloud_folder)
+
+    pairs = {ts: (main_files[ts], cloud_files[ts]) for ts in sorted(main_files.keys() & cloud_files.keys())}
+    main_only = sorted(main_files.keys() - cloud_files.keys())
+    cloud_only = sorted(cloud_files.keys() - main_files.keys())
+    return pairs, main_only, cloud_only
+
+
+def report_unpaired(main_only, cloud_only, max_listed=10):
+    """Prints the unpaired timestamps in bulk instead of one line per file."""
+    for label, timestamps in (("☁️ No cloud mask file for", main_only), ("🛰️ No Himawari file for", cloud_only)):
+        if not timestamps:
+            continue
+        listed = ", ".join(timestamps[:max_listed])
+        more = f" (+{len(timestamps) - max_listed} more)" if len(timestamps) > max_listed else ""
+        print(f"{label} {len(timestamps)} timestamp(s): {listed}{more}")
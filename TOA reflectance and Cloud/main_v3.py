@@ -2,10 +2,18 @@ import xarray as xr
 import numpy as np
 import pandas as pd
 import os
-import re
-import pickle
+import io
+import sys
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from glob import glob
 import warnings
+import pixel_store
+from file_index import build_pair_index, report_unpaired
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Pixels Close To Stations"))
+from station_masks import load_masks, station_slice, grid_mismatch
+import station_chips
 
 warnings.filterwarnings("ignore", category=FutureWarning)
 
@@ -42,136 +50,391 @@ station_coords = {
 input_folder = "TOA reflectance and Cloud/Himawari Data"
 cloud_folder = "TOA reflectance and Cloud/Cloud Mask Data"
 output_folder = "toa_filtered_near_stations"
-os.makedirs(output_folder, exist_ok=True)
+masks_path = "Pixels Close To Stations/precomputed_masks"
+num_workers = 1  # Set > 1 (or pass it on the command line) to process files in parallel
+output_format = "csv"  # "csv" (one file per timestamp) or "parquet" (columnar store, see pixel_store.py)
+store_folder = "toa_filtered_store"
+
+# === Variables Read From Each Himawari File ===
+ALBEDO_VARS = [f"albedo_0{i}" for i in range(1, 7)]
+TBB_VARS = [f"tbb_{i:02}" for i in range(7, 17)]
+ANGLE_VARS = ["SOZ", "SAA", "SOA", "SAZ"]
+
+
+# === Extraction Plan ===
+def build_extraction_plan(masks, station_names):
+    """
+    Merges the pixel masks of all stations into one set of unique pixels.
+
+    Stations that share pixels (e.g. Beijing and Beijing-CAMS) only contribute
+    them once, so every Himawari variable can be read a single time per file.
+    For each station, `station_points` holds the positions of its pixels inside
+    the unique set, in the same order as its original mask.
+
+    When the masks carry a cloud index map, the plan also holds the nearest
+    (row, col) of each unique pixel on the CLTYPE grid; otherwise it is None
+    and the cloud mask falls back to nearest-neighbour interpolation.
+
+    Masks computed for several radii also give each station's pixel distances
+    (`station_distance`), used to tag every pixel with its distance ring.
+    """
+    grid_shape = tuple(masks["grid"]["shape"])
+
+    names, slices = [], []
+    for name in station_names:
+        if name not in masks["station_index"]:
+            print(f"⚠️ Skipping {name} (not found in precomputed masks)")
+            continue
+        names.append(name)
+        slices.append(station_slice(masks, name))
+
+    if not names:
+        return None
+
+    all_flat = np.concatenate([masks["flat_index"][sl] for sl in slices])
+    unique_flat, first_pos, inverse = np.unique(all_flat, return_index=True, return_inverse=True)
+    rows, cols = np.unravel_index(unique_flat, grid_shape)
+
+    splits = np.cumsum([sl.stop - sl.start for sl in slices])[:-1]
+    station_points = dict(zip(names, np.split(inverse, splits)))
+
+    cloud_indices = None
+    if masks["cloud_index"] is not None:
+        cloud_flat = np.concatenate([masks["cloud_index"][sl] for sl in slices])[first_pos].astype("int64")
+        inside = cloud_flat >= 0
+        cloud_indices = np.full((len(cloud_flat), 2), -1, dtype="int64")
+        cloud_indices[inside] = np.stack(np.unravel_index(cloud_flat[inside], tuple(masks["cloud_grid"]["shape"])), axis=1)
+
+    # A shared pixel lies at a different distance from each station, so these stay per station.
+    station_distance = None
+    if masks["distance_km"] is not None and len(masks["radii_km"]) > 1:
+        station_distance = {name: np.asarray(masks["distance_km"][sl]) for name, sl in zip(names, slices)}
+
+    return {
+        "rows": rows,
+        "cols": cols,
+        "lat": np.concatenate([masks["lat"][sl] for sl in slices])[first_pos],
+        "lon": np.concatenate([masks["lon"][sl] for sl in slices])[first_pos],
+        "station_points": station_points,
+        "cloud_indices": cloud_indices,
+        "station_distance": station_distance,
+        "radii_km": np.asarray(masks["radii_km"], dtype="float64"),
+        "grid": masks["grid"],
+        "cloud_grid": masks["cloud_grid"],
+    }
+
+
+def check_grid(ds, signature, label):
+    """Fails fast when a dataset's grid differs from the one the masks were computed on."""
+    if station_chips.is_chip_file(ds):
+        mismatch = station_chips.parent_grid_mismatch(ds, signature)
+    else:
+        mismatch = grid_mismatch(signature, ds["latitude"].values, ds["longitude"].values)
+    if mismatch:
+        raise ValueError(
+            f"{label} grid does not match the precomputed masks ({mismatch}); "
+            f"rerun precompute_station_masks.py for this grid"
+        )
+
+
+def read_points(da, rows, cols):
+    """
+    Reads only the requested (row, col) pixels of a 2D variable.
+
+    Works on region files and on station-chip files alike: for chips, the
+    pixels are first located in the station windows that hold them.
+    """
+    if station_chips.is_chip_variable(da):
+        return station_chips.read_chip_points(da, *station_chips.locate(da, rows, cols))
+    indexers = dict(zip(da.dims, (
+        xr.DataArray(rows, dims="points"),
+        xr.DataArray(cols, dims="points"),
+    )))
+    return da.isel(indexers).values
+
+
+def read_cloud_types(ds_cloud, plan):
+    """Returns the CLTYPE value of every unique pixel in the plan as int."""
+    cltype = ds_cloud["CLTYPE"]
+
+    if plan["cloud_indices"] is None:
+        if station_chips.is_chip_file(ds_cloud):
+            raise ValueError("Station-chip cloud files need masks with a cloud index map; rerun precompute_station_masks.py")
+        # Older masks without a cloud index map: interpolate on the coordinates.
+        return cltype.interp(
+            latitude=xr.DataArray(plan["lat"], dims="points"),
+            longitude=xr.DataArray(plan["lon"], dims="points"),
+            method="nearest"
+        ).values.astype("int")
+
+    check_grid(ds_cloud, plan["cloud_grid"], "Cloud mask")
+
+    # Pixels outside the cloud grid are marked -1 and therefore never cloud-free.
+    cloud_rows, cloud_cols = plan["cloud_indices"][:, 0], plan["cloud_indices"][:, 1]
+    inside = cloud_rows >= 0
+    cltype_vals = np.full(len(cloud_rows), -1)
+    cltype_vals[inside] = read_points(cltype, cloud_rows[inside], cloud_cols[inside]).astype("int")
+    return cltype_vals
+
+
+# === Per-Timestamp Extraction ===
+def extract_timestamp(ds, ds_cloud, plan, date_fmt, time_fmt):
+    """
+    Extracts the cloud-free pixels of every station from one Himawari file.
+
+    Returns a single DataFrame with the rows of all stations, or None when no
+    station has a cloud-free pixel.
+    """
+    check_grid(ds, plan["grid"], "Himawari")
+
+    # === 1. Get Cloud Mask for All Unique Pixels ===
+    is_cloud_free = (read_cloud_types(ds_cloud, plan) == 0)
+
+    # === 2. Read Each Variable Once, Only at Cloud-Free Pixels ===
+    cf_points = np.flatnonzero(is_cloud_free)
+    if len(cf_points) > 0:
+        cf_rows = plan["rows"][cf_points]
+        cf_cols = plan["cols"][cf_points]
+        values = {var: read_points(ds[var], cf_rows, cf_cols) for var in ALBEDO_VARS + TBB_VARS + ANGLE_VARS}
+
+        # Position of each unique pixel inside the cloud-free arrays above
+        cf_position = np.full(len(is_cloud_free), -1)
+        cf_position[cf_points] = np.arange(len(cf_points))
+
+    all_rows = []
+
+    for name, points in plan["station_points"].items():
+        station_cloud_free = is_cloud_free[points]
+
+        num_nearby = len(points)
+        num_cloud_free = np.sum(station_cloud_free)
+
+        print(f"📌 {name}: {num_nearby} pixels nearby | ☁️ {num_cloud_free} cloud-free")
+
+        if num_cloud_free == 0:
+            continue
+
+        # === 3. Split the Shared Arrays Back Out for This Station ===
+        sel = cf_position[points[station_cloud_free]]
+
+        # --- TOA Reflectance ---
+        soz_vals = values["SOZ"][sel]
+        cos_theta_s = np.cos(np.deg2rad(soz_vals))
+        cos_theta_s[cos_theta_s <= 0] = np.nan # Avoid division by zero
+
+        reflectance_all = {
+            f"rho_0{i}": values[f"albedo_0{i}"][sel] / cos_theta_s
+            for i in range(1, 7)
+        }
 
-# === Load Precomputed Pixel Masks ===
-with open("Pixels Close To Stations/precomputed_masks.pkl", "rb") as f:
-    precomputed_masks = pickle.load(f)
+        # --- Brightness Temperature ---
+        brightness = {
+            f"bt_{i:02}": values[f"tbb_{i:02}"][sel]
+            for i in range(7, 17)
+        }
 
-grid_shape = precomputed_masks["_grid_shape"]
-nc_files = glob(os.path.join(input_folder, "*.nc"))
+        # --- Angle Geometry ---
+        SAA = values["SAA"][sel]
+        SOA = values["SOA"][sel]
+        SAZ = values["SAZ"][sel] # Viewing Zenith Angle
 
-# === Process Each Himawari File ===
-for nc_path in nc_files:
-    print(f"\n📦 Processing {os.path.basename(nc_path)}")
+        RA = np.abs(SAA - SOA)
+        RA = np.where(RA > 180, 360 - RA, RA)
 
-    match = re.search(r'(\d{8})_(\d{4})', nc_path)
-    if not match:
-        print("⚠️ Skipping, date not found in filename")
-        continue
+        # === 4. Build the Final DataFrame ===
+        df = pd.DataFrame(reflectance_all)
+        df = df.assign(**brightness) # A clean way to add multiple columns from a dict
 
-    date_str, time_str = match.group(1), match.group(2)
+        df["SOZ"] = soz_vals
+        df["VZ"] = SAZ
+        df["RA"] = RA
+        df["latitude"] = plan["lat"][points[station_cloud_free]]
+        df["longitude"] = plan["lon"][points[station_cloud_free]]
+        if plan["station_distance"] is not None:
+            # Ring = smallest configured radius that contains the pixel
+            distance = plan["station_distance"][name][station_cloud_free]
+            df["distance_km"] = distance
+            df["ring_km"] = plan["radii_km"][np.searchsorted(plan["radii_km"], distance, side="left").clip(max=len(plan["radii_km"]) - 1)]
+        df["Station"] = name
+        df["Date"] = date_fmt
+        df["Time"] = time_fmt
+
+        all_rows.append(df)
+
+    if not all_rows:
+        return None
+    return pd.concat(all_rows)
+
+
+# === Per-File Processing ===
+def format_timestamp(timestamp):
+    """Returns the (Date, Time) strings written to the CSV for a "YYYYMMDD_HHMM" timestamp."""
+    date_str, time_str = timestamp.split("_")
     date_fmt = f"{date_str[6:8]}:{date_str[4:6]}:{date_str[0:4]}"
     time_fmt = f"{time_str[:2]}:{time_str[2:]}:00"
-    timestamp = f"{date_str}_{time_str}"
+    return date_fmt, time_fmt
+
 
-    out_path = os.path.join(output_folder, f"toa_filtered_{timestamp}.csv")
-    if os.path.exists(out_path):
-        print(f"⏭️ Already exists: {out_path}")
-        continue
+def output_path_for(timestamp):
+    return os.path.join(output_folder, f"toa_filtered_{timestamp}.csv")
 
-    cloud_match = glob(os.path.join(cloud_folder, f"*{timestamp}*.nc"))
-    if not cloud_match:
-        print(f"☁️ No cloud mask file found for {timestamp}")
-        continue
-    cloud_path = cloud_match[0]
 
+def completed_timestamps():
+    """Returns the timestamps that already have an output, for resuming."""
+    if output_format == "parquet":
+        return pixel_store.existing_timestamps(store_folder)
+    names = (os.path.basename(p) for p in glob(os.path.join(output_folder, "toa_filtered_*.csv")))
+    return {name[len("toa_filtered_"):-len(".csv")] for name in names}
+
+
+def write_csv_atomic(df, out_path):
+    """Writes a CSV through a temporary file so a crash never leaves a half-written output."""
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
     try:
-        ds = xr.open_dataset(nc_path)
-        ds_cloud = xr.open_dataset(cloud_path)
-
-        all_rows = []
-
-        for name in station_coords:
-            if name not in precomputed_masks:
-                print(f"⚠️ Skipping {name} (not found in precomputed masks)")
-                continue
-
-            # === 1. Load Precomputed Data for the Station ===
-            # These are the original coordinates and indices for ALL pixels near the station.
-            mask_indices = precomputed_masks[name]["mask_indices"] # Shape (N, 2)
-            lats_nearby = np.array(precomputed_masks[name]["lat"])       # Shape (N,)
-            lons_nearby = np.array(precomputed_masks[name]["lon"])       # Shape (N,)
-
-            # Unpack row and column indices for easier use.
-            row_idx_nearby = mask_indices[:, 0]
-            col_idx_nearby = mask_indices[:, 1]
-
-            # === 2. Get Cloud Mask for Nearby Pixels ===
-            # Interpolate the cloud data to the exact coordinates of our nearby pixels.
-            cltype_interp = ds_cloud["CLTYPE"].interp(
-                latitude=xr.DataArray(lats_nearby, dims="points"),
-                longitude=xr.DataArray(lons_nearby, dims="points"),
-                method="nearest"
-            ).values.astype("int")
-
-            # Create a boolean filter for cloud-free pixels (cloud type == 0).
-            is_cloud_free = (cltype_interp == 0)
-            
-            num_nearby = len(lats_nearby)
-            num_cloud_free = np.sum(is_cloud_free)
-
-            print(f"📌 {name}: {num_nearby} pixels nearby | ☁️ {num_cloud_free} cloud-free")
-
-            if num_cloud_free == 0:
-                continue
-            
-            # === 3. Filter Indices to Get ONLY Cloud-Free Pixels ===
-            # This is the key step! We select only the indices that correspond to cloud-free pixels.
-            cf_row_idx = row_idx_nearby[is_cloud_free]
-            cf_col_idx = col_idx_nearby[is_cloud_free]
-            
-            # === 4. Extract Data Using the Final, Filtered Indices ===
-            # Now we access the large Himawari arrays only once, using our small list of final indices.
-            # This is much more efficient.
-            
-            # --- TOA Reflectance ---
-            # Get Solar Zenith Angle for just the cloud-free pixels
-            soz_vals = ds["SOZ"].values[cf_row_idx, cf_col_idx]
-            cos_theta_s = np.cos(np.deg2rad(soz_vals))
-            cos_theta_s[cos_theta_s <= 0] = np.nan # Avoid division by zero
-
-            reflectance_all = {}
-            for i in range(1, 7):
-                albedo_vals = ds[f"albedo_0{i}"].values[cf_row_idx, cf_col_idx]
-                reflectance_all[f"rho_0{i}"] = albedo_vals / cos_theta_s
-                
-            # --- Brightness Temperature ---
-            brightness = {
-                f"bt_{i:02}": ds[f"tbb_{i:02}"].values[cf_row_idx, cf_col_idx]
-                for i in range(7, 17)
-            }
-
-            # --- Angle Geometry ---
-            SAA = ds["SAA"].values[cf_row_idx, cf_col_idx]
-            SOA = ds["SOA"].values[cf_row_idx, cf_col_idx]
-            SAZ = ds["SAZ"].values[cf_row_idx, cf_col_idx] # Viewing Zenith Angle
-
-            RA = np.abs(SAA - SOA)
-            RA = np.where(RA > 180, 360 - RA, RA)
-
-            # === 5. Build the Final DataFrame ===
-            df = pd.DataFrame(reflectance_all)
-            df = df.assign(**brightness) # A clean way to add multiple columns from a dict
-
-            df["SOZ"] = soz_vals
-            df["VZ"] = SAZ
-            df["RA"] = RA
-            # Filter the original lat/lon arrays to get the coordinates of the cloud-free pixels
-            df["latitude"] = lats_nearby[is_cloud_free]
-            df["longitude"] = lons_nearby[is_cloud_free]
-            df["Station"] = name
-            df["Date"] = date_fmt
-            df["Time"] = time_fmt
-
-            all_rows.append(df)
-
-        if all_rows:
-            pd.concat(all_rows).to_csv(out_path, index=False)
-            print(f"✅ Saved: {out_path}")
-        else:
-            print("🚫 No cloud-free pixels found near any station for this timestamp.")
+        df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def save_result(result, timestamp):
+    """Writes the rows of one timestamp in the configured output format and returns the path."""
+    if output_format == "parquet":
+        return pixel_store.write_timestamp(pixel_store.to_store_frame(result, timestamp), store_folder, timestamp)
+    out_path = output_path_for(timestamp)
+    write_csv_atomic(result, out_path)
+    return out_path
+
+
+def extract_and_save(timestamp, ds, ds_cloud, plan):
+    """Extracts one opened Himawari / cloud mask pair and saves its output. Returns "saved" or "empty"."""
+    date_fmt, time_fmt = format_timestamp(timestamp)
+    result = extract_timestamp(ds, ds_cloud, plan, date_fmt, time_fmt)
+
+    if result is None:
+        print("🚫 No cloud-free pixels found near any station for this timestamp.")
+        return "empty"
+
+    print(f"✅ Saved: {save_result(result, timestamp)}")
+    return "saved"
+
+
+def process_file(timestamp, nc_path, cloud_path, plan):
+    """
+    Extracts one Himawari file (with its paired cloud mask) and saves its output.
+
+    Returns one of "saved", "empty" or "error".
+    """
+    try:
+        with xr.open_dataset(nc_path) as ds, xr.open_dataset(cloud_path) as ds_cloud:
+            return extract_and_save(timestamp, ds, ds_cloud, plan)
 
     except Exception as e:
         # Using f-string with exception for more direct error message
-        print(f"❌ Error processing {os.path.basename(nc_path)}: {e}")
\ No newline at end of file
+        print(f"❌ Error processing {os.path.basename(nc_path)}: {e}")
+        return "error"
+
+
+def load_plan(path):
+    return build_extraction_plan(load_masks(path), station_coords)
+
+
+# === Parallel Workers ===
+# Each worker process loads the station masks once and keeps them in this global.
+_worker_plan = None
+
+
+def _init_worker(path):
+    global _worker_plan
+    with contextlib.redirect_stdout(io.StringIO()):
+        _worker_plan = load_plan(path)
+
+
+def _process_file_in_worker(timestamp, nc_path, cloud_path):
+    # Buffer the worker's output so each file's log is printed as one block.
+    buffer = io.StringIO()
+    with contextlib.redirect_stdout(buffer):
+        status = process_file(timestamp, nc_path, cloud_path, _worker_plan)
+    return status, buffer.getvalue()
+
+
+def run_parallel(pairs, workers):
+    """Processes {timestamp: (nc_path, cloud_path)} on a pool of worker processes and returns {nc_path: status}."""
+    statuses = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(masks_path,)) as executor:
+        futures = {
+            executor.submit(_process_file_in_worker, timestamp, nc_path, cloud_path): nc_path
+            for timestamp, (nc_path, cloud_path) in pairs.items()
+        }
+        for future in as_completed(futures):
+            nc_path = futures[future]
+            print(f"\n📦 Processed {os.path.basename(nc_path)}")
+            try:
+                status, log = future.result()
+                print(log, end="")
+            except Exception as e:
+                # The worker itself died (e.g. out of memory), not just the extraction.
+                print(f"❌ Worker failed on {os.path.basename(nc_path)}: {e}")
+                status = "error"
+            statuses[nc_path] = status
+    return statuses
+
+
+def main(workers=1):
+    os.makedirs(store_folder if output_format == "parquet" else output_folder, exist_ok=True)
+
+    # === Load Precomputed Pixel Masks ===
+    plan = load_plan(masks_path)
+    if plan is None:
+        print("🚫 No station in precomputed masks, nothing to extract.")
+        return
+    print(f"🧮 {len(plan['rows'])} unique pixels across {len(plan['station_points'])} stations")
+    if plan["cloud_indices"] is None:
+        print("⚠️ Masks have no cloud index map, falling back to CLTYPE interpolation. Rerun precompute_station_masks.py to add it.")
+
+    # === Pair Himawari and Cloud Mask Files (one scan of each folder) ===
+    pairs, main_only, cloud_only = build_pair_index(input_folder, cloud_folder)
+    print(f"🗂️ {len(pairs)} Himawari/cloud mask pair(s) found")
+    report_unpaired(main_only, cloud_only)
+
+    # Fail fast if the data is on a different grid than the masks.
+    if pairs:
+        first_main, first_cloud = next(iter(pairs.values()))
+        try:
+            with xr.open_dataset(first_main) as ds, xr.open_dataset(first_cloud) as ds_cloud:
+                check_grid(ds, plan["grid"], "Himawari")
+                if plan["cloud_indices"] is not None:
+                    check_grid(ds_cloud, plan["cloud_grid"], "Cloud mask")
+        except ValueError as e:
+            print(f"❌ {e}")
+            return
+
+    # Resume: only process timestamps that have no output yet.
+    done = completed_timestamps()
+    skipped = [timestamp for timestamp in pairs if timestamp in done]
+    if skipped:
+        print(f"⏭️ Already exists: {len(skipped)} timestamp(s)")
+    pending = {timestamp: paths for timestamp, paths in pairs.items() if timestamp not in done}
+
+    if workers > 1:
+        print(f"\n⚙️ Processing {len(pending)} file(s) with {workers} workers")
+        statuses = run_parallel(pending, workers)
+    else:
+        # === Process Each Himawari File ===
+        statuses = {}
+        for timestamp, (nc_path, cloud_path) in pending.items():
+            print(f"\n📦 Processing {os.path.basename(nc_path)}")
+            statuses[nc_path] = process_file(timestamp, nc_path, cloud_path, plan)
+
+    failed = sorted(os.path.basename(p) for p, status in statuses.items() if status == "error")
+    saved = sum(status == "saved" for status in statuses.values())
+    print(f"\n📊 {saved} file(s) saved, {len(failed)} failed")
+    for name in failed:
+        print(f"   ❌ {name}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        num_workers = int(sys.argv[1])
+    main(num_workers)
@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+from glob import glob
+from datetime import datetime
+import duckdb
+import numpy as np
+import pandas as pd
+
+# === Columnar Store for Extracted Near-Station Pixels ===
+# Layout: <store>/year=YYYY/month=MM/*.parquet, written and read with DuckDB.
+# Each row is one cloud-free pixel; bands and coordinates are float32 and the
+# observation time is an int64 `timestamp` (seconds since 1970-01-01 UTC).
+
+FLOAT_COLUMNS = (
+    [f"rho_0{i}" for i in range(1, 7)]
+    + [f"bt_{i:02}" for i in range(7, 17)]
+    + ["SOZ", "VZ", "RA", "latitude", "longitude"]
+)
+
+# Only present when the masks were computed for several radii.
+RING_COLUMNS = ["distance_km", "ring_km"]
+
+
+def _sql_path(path):
+    return path.replace("\\", "/").replace("'", "''")
+
+
+def timestamp_to_epoch(timestamp):
+    """Converts a "YYYYMMDD_HHMM" timestamp to int64 epoch seconds."""
+    return int((datetime.strptime(timestamp, "%Y%m%d_%H%M") - datetime(1970, 1, 1)).total_seconds())
+
+
+def partition_folder(store_folder, timestamp):
+    return os.path.join(store_folder, f"year={timestamp[:4]}", f"month={timestamp[4:6]}")
+
+
+def to_store_frame(df, timestamp):
+    """Turns an extracted pixel DataFrame (with Date/Time strings) into the typed store layout."""
+    out = pd.DataFrame({col: df[col].to_numpy(dtype="float32") for col in FLOAT_COLUMNS + RING_COLUMNS if col in df.columns})
+    out["Station"] = df["Station"].to_numpy()
+    out["timestamp"] = np.full(len(df), timestamp_to_epoch(timestamp), dtype="int64")
+    return out
+
+
+def write_timestamp(df, store_folder, timestamp):
+    """Writes one timestamp's pixels as a Parquet file in its year/month partition."""
+    folder = partition_folder(store_folder, timestamp)
+    os.makedirs(folder, exist_ok=True)
+    out_path = os.path.join(folder, f"toa_filtered_{timestamp}.parquet")
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+
+    con = duckdb.connect()
+    try:
+        con.register("pixels", df)
+        con.execute(f"COPY pixels TO '{_sql_path(tmp_path)}' (FORMAT PARQUET, COMPRESSION ZSTD)")
+        os.replace(tmp_path, out_path)
+    finally:
+        con.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return out_path
+
+
+# A month being compacted holds a marker naming its source files and the
+# size/mtime of the compacted file. Once that file is in place, the sources are
+# ignored by readers until they are deleted, so a crash between the two steps
+# never shows the month's rows twice.
+COMPACTION_MARKER = "_compaction.json"
+
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _compacted_sources(folder):
+    """Source files of a month whose compacted file is already in place (empty if none)."""
+    marker = os.path.join(folder, COMPACTION_MARKER)
+    if not os.path.exists(marker):
+        return set()
+    with open(marker) as f:
+        info = json.load(f)
+    out_path = os.path.join(folder, info["output"])
+    if not os.path.exists(out_path) or _file_stamp(out_path) != info["stamp"]:
+        return set()  # Interrupted before the compacted file replaced anything
+    return {os.path.join(folder, name) for name in info["sources"]}
+
+
+def _finish_compaction(folder):
+    """Deletes what an interrupted compaction left behind: superseded sources, the marker, temp files."""
+    for path in _compacted_sources(folder):
+        if os.path.exists(path):
+            os.remove(path)
+    for path in glob(os.path.join(folder, COMPACTION_MARKER)) + glob(os.path.join(folder, "*.parquet.*.tmp")):
+        os.remove(path)
+
+
+def _store_files(store_folder):
+    files = []
+    for folder in sorted(glob(os.path.join(store_folder, "year=*", "month=*"))):
+        superseded = _compacted_sources(folder)
+        files += [path for path in sorted(glob(os.path.join(folder, "*.parquet"))) if path not in superseded]
+    return files
+
+
+def _scan(store_folder):
+    file_list = ", ".join(f"'{_sql_path(path)}'" for path in _store_files(store_folder))
+    return f"read_parquet([{file_list}], hive_partitioning = true, union_by_name = true)"
+
+
+def existing_timestamps(store_folder):
+    """Returns the set of "YYYYMMDD_HHMM" timestamps already in the store."""
+    if not _store_files(store_folder):
+        return set()
+    epochs = duckdb.sql(f"SELECT DISTINCT timestamp FROM {_scan(store_folder)}").fetchnumpy()["timestamp"]
+    return set(pd.to_datetime(epochs, unit="s").strftime("%Y%m%d_%H%M"))
+
+
+def read_store(store_folder, columns=None, start=None, end=None, stations=None):
+    """
+    Loads pixels from the store into one DataFrame with a `Datetime` column.
+
+    `start`/`end` (inclusive, datetime-like) and `stations` narrow the scan;
+    DuckDB skips partitions and row groups outside the time range. Without
+    `columns`, every stored column is returned (including the ring columns
+    when present).
+    """
+    if not _store_files(store_folder):
+        return pd.DataFrame(columns=(columns or FLOAT_COLUMNS + ["Station"]) + ["Datetime"])
+
+    select = ", ".join(f'"{col}"' for col in columns) + ", timestamp" if columns else "* EXCLUDE (year, month)"
+    year_month = "CAST(year AS INTEGER) * 100 + CAST(month AS INTEGER)"
+    conditions, params = [], []
+    if start is not None:
+        start = pd.Timestamp(start)
+        conditions.append(f"timestamp >= ? AND {year_month} >= ?")
+        params += [int(start.value // 10**9), start.year * 100 + start.month]
+    if end is not None:
+        end = pd.Timestamp(end)
+        conditions.append(f"timestamp <= ? AND {year_month} <= ?")
+        params += [int(end.value // 10**9), end.year * 100 + end.month]
+    if stations is not None:
+        conditions.append("list_contains(?, Station)")
+        params.append(list(stations))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    df = duckdb.execute(f"SELECT {select} FROM {_scan(store_folder)} {where}", params).df()
+    df["Datetime"] = pd.to_datetime(df.pop("timestamp"), unit="s")
+    return df
+
+
+def compact_store(store_folder):
+    """Merges each month's per-timestamp files into a single Parquet file sorted by time and station."""
+    for folder in sorted(glob(os.path.join(store_folder, "year=*", "month=*"))):
+        _finish_compaction(folder)
+        files = sorted(glob(os.path.join(folder, "*.parquet")))
+        if len(files) < 2:
+            continue
+
+        year, month = (os.path.basename(p).split("=")[1] for p in (os.path.dirname(folder), folder))
+        out_path = os.path.join(folder, f"toa_filtered_{year}{month}.parquet")
+        tmp_path = f"{out_path}.{os.getpid()}.tmp"
+        file_list = ", ".join(f"'{_sql_path(p)}'" for p in files)
+
+        duckdb.execute(
+            f"COPY (SELECT * FROM read_parquet([{file_list}], union_by_name = true) ORDER BY timestamp, Station) "
+            f"TO '{_sql_path(tmp_path)}' (FORMAT PARQUET, COMPRESSION ZSTD)"
+        )
+        marker = os.path.join(folder, COMPACTION_MARKER)
+        with open(marker, "w") as f:
+            json.dump({
+                "output": os.path.basename(out_path),
+                "stamp": _file_stamp(tmp_path),  # os.replace keeps size and mtime
+                "sources": [os.path.basename(p) for p in files if p != out_path],
+            }, f)
+        os.replace(tmp_path, out_path)
+        _finish_compaction(folder)
+        print(f"🗜️ Compacted {len(files)} file(s) into {out_path}")
+
+
+def csv_folder_to_store(csv_folder, store_folder):
+    """Converts existing toa_filtered_*.csv files into the store, skipping timestamps already there."""
+    done = existing_timestamps(store_folder)
+    for csv_path in sorted(glob(os.path.join(csv_folder, "toa_filtered_*.csv"))):
+        timestamp = os.path.basename(csv_path)[len("toa_filtered_"):-len(".csv")]
+        if timestamp in done:
+            continue
+        df = pd.read_csv(csv_path)
+        if not df.empty:
+            write_timestamp(to_store_frame(df, timestamp), store_folder, timestamp)
+    compact_store(store_folder)
+
+
+# Usage: python pixel_store.py <csv_folder> <store_folder>   (convert CSV output)
+#        python pixel_store.py <store_folder>                (compact only)
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        csv_folder_to_store(sys.argv[1], sys.argv[2])
+    elif len(sys.argv) == 2:
+        compact_store(sys.argv[1])
+    else:
+        print(f"Usage: python {os.path.basename(__file__)} [<csv_folder>] <store_folder>")
+        sys.exit(1)